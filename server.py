@@ -5,33 +5,259 @@ Python implementation of server code for this project (originally in JavaScript)
 import os
 import json
 import asyncio
+import tempfile
 import uvicorn
 import fastapi as fast
-import traceback as tb
+import src.logs as logs
+import src.metrics as metrics
 import src.serverComms as sc
+from src.jobs import QueueFull, OverBudget
+from src.cache import getCache
+from src.config import settings
+from src.process import RESULT_MODES, hasPyarrow
+from pathlib import Path
 from fastapi import staticfiles
+from python_multipart.multipart import MultipartParser, parse_options_header
+from python_multipart.exceptions import FormParserError
 from typing import Any, Annotated
 from contextlib import asynccontextmanager
 
+log = logs.getLogger("server")
+
+def staleFrontend() -> bool:
+    '''Whether the built frontend in dist/ predates the websocket protocol this server speaks. Every bundle built from the current src/messages.ts contains its fetch_job header.'''
+    bundles = list(Path(dir, "dist", "assets").glob("*.js"))
+    return len(bundles) > 0 and not any(b"fetch_job" in bundle.read_bytes() for bundle in bundles)
+
 @asynccontextmanager
 async def lifespan(_: fast.FastAPI):
+    logs.setup()
+    if not hasPyarrow():
+        log.warning("pyarrow is not installed (it is in requirements.txt), so uploads are parsed by pandas' single-threaded parser and held as Python objects, which is slower and takes more memory.")
+    if staleFrontend():
+        log.warning("dist/ was built from older frontend sources and will not work with this server. Rebuild it with npm install, then npm run build.")
     asyncio.ensure_future(serverComms.start())
     yield
     await serverComms.stop()
+    logs.shutdown()
 
 app = fast.FastAPI(lifespan=lifespan)
 serverComms = sc.ServerComms()
 
+metrics.REGISTRY.add(metrics.Gauge("sentiment_connected_clients", "Open websocket connections.", lambda: len(serverComms.clients)))
+metrics.REGISTRY.add(metrics.Gauge("sentiment_queued_jobs", "Jobs waiting for a worker.", lambda: serverComms.jobs.queued))
+metrics.REGISTRY.add(metrics.Gauge("sentiment_running_jobs", "Jobs being analysed.", lambda: serverComms.jobs.running))
+metrics.REGISTRY.add(metrics.Gauge("sentiment_inflight_rows", "CSV rows of jobs that are queued or running.", lambda: serverComms.inflightRows))
+metrics.REGISTRY.add(metrics.Gauge("sentiment_memory_reserved_bytes", "Estimated memory of the jobs running now, reserved against SENTIMENT_MEMORYBUDGET.", lambda: serverComms.jobs.reserved))
+
+def checkReady():
+    '''Turn requests away with a 503 until the workers have loaded the model (see /health).'''
+    match serverComms.jobs.status():
+        case "warming up":
+            raise fast.HTTPException(status_code=503, detail="The model is still warming up. Please try again in a few seconds.", headers={"Retry-After": "5"})
+        case "failed":
+            raise fast.HTTPException(status_code=503, detail="The model failed to load. Please contact the administrator.")
+        case "stopped":
+            raise fast.HTTPException(status_code=503, detail="The server is not running.")
+
+@app.get("/health")
+async def health():
+    '''Readiness of the analysis workers, with each worker's cold-start timings (see src.inference.warmUp). 200 once all of them are ready, 503 before then.'''
+    jobs = serverComms.jobs
+    status = jobs.status()
+    body = {"status": status, "workers": jobs.workers, "warm": len(jobs.warmUps), "timings": jobs.warmUps, "errors": jobs.warmUpErrors, "queued": jobs.queued, "running": jobs.running, "memoryReserved": jobs.reserved, "memoryBudget": jobs.memoryBudget}
+    return fast.responses.JSONResponse(body, status_code=200 if status == "ready" else 503)
+
+def badRequest(detail: str) -> fast.HTTPException:
+    return fast.HTTPException(status_code=400, detail=detail)
+
 @app.post("/csv")
 async def handleCsv(msg: Annotated[Any, fast.Body()]):
+    checkReady()
     try:
         message = json.loads(msg)
         if "clientKey" in message:
-            await serverComms.handleCsv(message["clientKey"], message["data"], message["infer"], message["prodName"], message["revName"])
+            mode = message.get("mode", "full")
+            if mode not in RESULT_MODES:
+                raise badRequest(f"Unknown mode {mode}.")
+            jobId, position = await serverComms.handleCsv(message["clientKey"], message["data"], message["infer"], message["prodName"], message["revName"], message.get("stream", False), mode, message.get("includeReviews", False))
+            return {"jobId": jobId, "position": position}
         else:
-            print(f"Received malformed JSON: {message}")
+            log.warning("Received malformed JSON", message=logs.preview(str(message)))
+    except fast.HTTPException:
+        raise
+    except OverBudget as e:
+        raise fast.HTTPException(status_code=413, detail=str(e))
+    except QueueFull as e:
+        raise fast.HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        print(f"Error in CSV handling: {e}: {tb.format_tb(e.__traceback__)}") # Enable in production
+        log.exception("Error in CSV handling")
+
+def tempCsv() -> tuple[Path, Any]:
+    '''A new temporary file for an uploaded CSV, opened for binary writing.'''
+    file = tempfile.NamedTemporaryFile("wb", suffix=".csv", dir=settings.uploadDir, delete=False)
+    return Path(file.name), file
+
+def tooLarge() -> fast.HTTPException:
+    return fast.HTTPException(status_code=413, detail=f"File is too large (limit {settings.maxUploadBytes} bytes).")
+
+MAX_FIELD_BYTES = 1 << 20
+'''Limit on the form fields of a multipart upload, all together. They only hold parameters.'''
+
+class FormUpload:
+    '''A multipart/form-data upload, filled in by python_multipart's streaming parser (see callbacks()) as the body arrives: the "file" part is counted against settings.maxUploadBytes as a raw body is, and collected until flush() writes it to file, and the other parts are kept as form fields.'''
+    def __init__(self, file: Any):
+        self.file = file
+        self.size = 0
+        self._data: list[bytes] = []
+        self.hasFile = False
+        self.fields: dict[str, str] = {}
+        self._fieldBytes = 0
+        self._headerField = bytearray()
+        self._headerValue = bytearray()
+        self._disposition = b""
+        self._name: str | None = None # None while in the file part
+        self._value = bytearray()
+
+    def callbacks(self) -> dict[str, Any]:
+        return {
+            "on_part_begin": self._partBegin,
+            "on_header_field": lambda data, start, end: self._headerField.extend(data[start:end]),
+            "on_header_value": lambda data, start, end: self._headerValue.extend(data[start:end]),
+            "on_header_end": self._headerEnd,
+            "on_headers_finished": self._headersFinished,
+            "on_part_data": self._partData,
+            "on_part_end": self._partEnd,
+        }
+
+    def _partBegin(self):
+        self._disposition = b""
+        self._value.clear()
+
+    def _headerEnd(self):
+        if bytes(self._headerField).lower() == b"content-disposition":
+            self._disposition = bytes(self._headerValue)
+        self._headerField.clear()
+        self._headerValue.clear()
+
+    def _headersFinished(self):
+        _, options = parse_options_header(self._disposition)
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        if name == "file":
+            if self.hasFile:
+                raise badRequest("More than one file part in upload.")
+            self.hasFile = True
+            self._name = None
+        else:
+            self._name = name
+
+    def _partData(self, data: bytes, start: int, end: int):
+        if self._name is None:
+            self.size += end - start
+            if self.size > settings.maxUploadBytes:
+                raise tooLarge()
+            self._data.append(data[start:end])
+        else:
+            self._fieldBytes += end - start
+            if self._fieldBytes > MAX_FIELD_BYTES:
+                raise badRequest("Form fields are too large.")
+            self._value.extend(data[start:end])
+
+    async def flush(self):
+        '''Write the file data parsed so far, off the event loop.'''
+        if len(self._data) > 0:
+            data = b"".join(self._data)
+            self._data.clear()
+            await asyncio.to_thread(self.file.write, data)
+
+    def _partEnd(self):
+        if self._name is not None:
+            self.fields[self._name] = self._value.decode("utf-8", "replace")
+
+@app.post("/upload")
+async def handleUpload(request: fast.Request, clientKey: str | None = None, infer: bool = True, prodName: str = "", revName: str = "", stream: bool = False, mode: str = "full", includeReviews: bool = False):
+    '''Upload a CSV either as multipart/form-data (a "file" part, plus the other parameters as form fields) or as a raw text/csv body (parameters in the query string). <br />
+    Either way the body is streamed to a temporary file as it arrives, counting bytes as it goes and writing off the event loop so that other clients are not held up, and parsed from there, so the server never holds more of it in memory than the two selected columns. Uploads over settings.maxUploadBytes are rejected with a 413 as soon as they pass it, whether or not they declare a Content-Length.'''
+    checkReady()
+    length = request.headers.get("content-length")
+    try:
+        if length is not None and int(length) > settings.maxUploadBytes:
+            raise tooLarge()
+    except ValueError:
+        raise badRequest("Malformed Content-Length.")
+    contentType = request.headers.get("content-type", "")
+    path, file = await asyncio.to_thread(tempCsv)
+    try:
+        with file:
+            if contentType.startswith("multipart/form-data"):
+                boundary = parse_options_header(contentType)[1].get(b"boundary")
+                if not boundary:
+                    raise badRequest("No boundary in multipart Content-Type.")
+                form = FormUpload(file)
+                parser = MultipartParser(boundary, form.callbacks())
+                try:
+                    async for chunk in request.stream():
+                        parser.write(chunk)
+                        await form.flush()
+                    parser.finalize()
+                    await form.flush()
+                except FormParserError as e:
+                    raise badRequest(f"Malformed multipart body: {e}")
+                if not form.hasFile:
+                    raise badRequest("No file part in upload.")
+                fields = form.fields
+                clientKey = fields.get("clientKey", clientKey or "")
+                infer = fields.get("infer", str(infer)).lower() == "true"
+                prodName = fields.get("prodName", prodName)
+                revName = fields.get("revName", revName)
+                stream = fields.get("stream", str(stream)).lower() == "true"
+                mode = fields.get("mode", mode)
+                includeReviews = fields.get("includeReviews", str(includeReviews)).lower() == "true"
+            else:
+                size = 0
+                async for chunk in request.stream():
+                    size += len(chunk)
+                    if size > settings.maxUploadBytes:
+                        raise tooLarge()
+                    await asyncio.to_thread(file.write, chunk)
+        if not clientKey:
+            raise badRequest("No client key given.")
+        if mode not in RESULT_MODES:
+            raise badRequest(f"Unknown mode {mode}.")
+    except:
+        path.unlink(missing_ok=True)
+        raise
+    try:
+        jobId, position = await serverComms.handleCsv(clientKey, path, infer, prodName, revName, stream, mode, includeReviews) # type: ignore
+    except OverBudget as e:
+        raise fast.HTTPException(status_code=413, detail=str(e))
+    except QueueFull as e:
+        raise fast.HTTPException(status_code=503, detail=str(e))
+    return {"jobId": jobId, "position": position}
+
+@app.get("/jobs/{jobId}")
+async def fetchJob(jobId: str):
+    '''A job's state and whatever it has produced so far, for clients not on the websocket. result is the same JSON a websocket client would get (for a streamed job, {"rows": n}), or null while running; partials holds a streamed job's results so far (in counts mode, one running total), unless they were too large to keep (replayable is false, see SENTIMENT_REPLAYMAXBYTES); truncated counts reviews longer than the token budget (see SENTIMENT_MAXTOKENS).'''
+    stored = serverComms.results.get(jobId)
+    if stored is None:
+        raise fast.HTTPException(status_code=404, detail="No such job. It may have expired.")
+    job = serverComms.pending.get(jobId)
+    state = "done" if stored.done else ("running" if job is not None and job.started is not None else "queued")
+    head = json.dumps({"jobId": jobId, "state": state, "failed": stored.failed, "mode": stored.mode, "stream": stored.stream, "replayable": stored.replayable, "truncated": stored.truncated, "position": 0 if job is None else serverComms.jobs.position(job)})
+    partials = ",".join(partial for partial, _ in stored.partials)
+    return fast.Response(f"{head[:-1]},\"partials\":[{partials}],\"result\":{stored.result or "null"}}}", media_type="application/json")
+
+@app.get("/metrics")
+async def metricsText():
+    '''Server metrics in the Prometheus text format (see src.metrics).'''
+    return fast.responses.PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache")
+async def cacheStats():
+    '''Sentiment cache counters for this process (see src.cache.SentimentCache.stats).'''
+    cache = getCache()
+    return {"enabled": False} if cache is None else {"enabled": True, **cache.stats()}
+
 async def handleCsvOri(msg: sc.JsonCsv):
     '''The original CSV handler. The server rejects what seems like perfectly good JSON, so I'm putting this on the back burner until I can figure it out. The other version works fine anyways.'''
     await serverComms.handleCsv(msg.clientKey, msg.data, msg.infer, msg.prodName, msg.revName)
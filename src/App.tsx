@@ -1,5 +1,5 @@
 import { useState } from "react"
-import { HEADER_CALLBACK_PING, HEADER_CLOSE, HEADER_INCOMING_IMAGE, HEADER_INCOMING_KEY, MsgCallbackPing, MsgClose, MsgCsv, MsgImage, MsgKey, SentimentAnalysisError, SentimentAnalysisResult } from "./messages.js"
+import { HEADER_CALLBACK_PING, HEADER_CLOSE, HEADER_INCOMING_IMAGE, HEADER_INCOMING_KEY, HEADER_INCOMING_PARTIAL, HEADER_INCOMING_QUEUED, HEADER_INCOMING_RESULT, MsgCallbackPing, MsgClose, MsgFetchJob, MsgImage, MsgKey, MsgPartial, MsgQueued, MsgResult, ResultMode, SentimentAnalysisError, SentimentAnalysisResult, SentimentColumns, SentimentCounts } from "./messages.js"
 import { Chart as ChartJS, ArcElement, Tooltip, Legend, ChartData, Title } from 'chart.js';
 import { Pie } from 'react-chartjs-2';
 import { Form, Button } from "react-bootstrap";
@@ -16,6 +16,9 @@ document.addEventListener("DOMContentLoaded", (_) => {
 
 const PROD_NAME_KEY = "productName"
 const REV_NAME_KEY = "revName"
+/**Session storage key of the job being waited for, so it can be fetched again after a reconnect or a page reload.*/
+const JOB_ID_KEY = "pendingJob"
+const RECONNECT_MS = 2000
 
 class ClientComms {
     setImageReady: (to: boolean) => void = to => console.log(`Setting image ready before setter provided: ${to}`)
@@ -24,24 +27,21 @@ class ClientComms {
     setLoading: (to: string) => void = to => console.log(`Setting loading before setter provided: ${to}`)
     setInfer: (to: boolean) => void = (to) => console.log(`Setting infer before setter provided: ${to}`)
     infer: boolean = true
+    showReviews: boolean = false
     #ws: WebSocket
-    #reader: FileReader
     #clientKey: string
     #chartRefs: (ChartJS<"pie"> | null)[] = []
     #prodName = ""
     #revName = ""
     #loadingProgress = 1
     #loadingIntervalID: number | null = null
+    #queuePosition = 0
+    #partial: SentimentAnalysisResult = {}
+    #partialCounts: SentimentCounts = {}
+    #partialRows = 0
 
     constructor() {
         this.#setSocket("ws://localhost:5500")
-        this.#reader = new FileReader()
-        this.#reader.addEventListener("load", (_) => this.#submit(this.#reader.result as string))
-        this.#reader.addEventListener("error", e => {
-            console.log(`Error in reading file: ${e}.`)
-            this.setError("Error in reading file.")
-            this.setImageReady(false)
-        })
         this.setError(null)
     }
 
@@ -54,7 +54,10 @@ class ClientComms {
             console.log(`Websocket error: ${e}`) 
             this.setError(`Websocket error.`)
         })
-        this.#ws.addEventListener("close", (_) => console.log("ClientComms socket closing."))
+        this.#ws.addEventListener("close", (_) => {
+            console.log("ClientComms socket closing.")
+            window.setTimeout(() => this.#setSocket(address), RECONNECT_MS)
+        })
         this.#ws.addEventListener("open", (_) => console.log("Hello from the ClientComms socket!"))
     }
 
@@ -70,6 +73,15 @@ class ClientComms {
                     case HEADER_INCOMING_IMAGE:
                         this.#handleIncomingImage(json)
                         break
+                    case HEADER_INCOMING_RESULT:
+                        this.#handleIncomingResult(json)
+                        break
+                    case HEADER_INCOMING_PARTIAL:
+                        this.#handleIncomingPartial(json)
+                        break
+                    case HEADER_INCOMING_QUEUED:
+                        this.#handleIncomingQueued(json)
+                        break
                     case HEADER_INCOMING_KEY:
                         this.#handleIncomingKey(json)
                         break
@@ -112,26 +124,46 @@ class ClientComms {
                     break
                 case "file-input":
                     if (input.files !== null && input.files?.length > 0) {
-                        this.#reader.readAsText(input.files[0])
+                        this.#submit(input.files[0])
                     }
                     break
             }
         })
     }
 
-    #submit(data: string) {
+    /**Uploads the file as multipart form data, so neither the browser nor the server has to hold it as one big string.*/
+    #submit(file: File) {
         let request = new XMLHttpRequest()
-        request.open("POST", "http://localhost:8000/csv", true)
+        request.open("POST", "http://localhost:8000/upload", true)
         request.onreadystatechange = () => {
             if (request.readyState == XMLHttpRequest.DONE) {
                 console.log(`POST response: ${JSON.stringify(request.response, null, 2)}`)
+                if (request.status >= 400 && request.status < 600) {
+                    let detail = `Upload rejected (${request.status}).`
+                    try {
+                        detail = JSON.parse(request.response).detail
+                    } catch {}
+                    this.setError(detail)
+                    this.#stopLoading()
+                }
             }
         }
         request.onerror = (_) => {
             console.log("Upload to server failed.")
             this.setError("Upload to server failed.")
         }
-        request.send(JSON.stringify(new MsgCsv(this.#clientKey, data, this.#prodName, this.#revName, this.infer)))
+        this.#partial = {}
+        this.#partialCounts = {}
+        this.#partialRows = 0
+        const form = new FormData()
+        form.append("clientKey", this.#clientKey)
+        form.append("infer", String(this.infer))
+        form.append("prodName", this.#prodName)
+        form.append("revName", this.#revName)
+        form.append("stream", "true")
+        form.append("mode", this.#mode())
+        form.append("file", file)
+        request.send(form)
         console.log("Outgoing: CSV")
         this.#startLoading()
     }
@@ -139,7 +171,9 @@ class ClientComms {
     #startLoading() {
         this.#stopLoading()
         this.#loadingIntervalID = window.setInterval((() => {
-            this.setLoading(`Loading${".".repeat(this.#loadingProgress)}`)
+            const queued = this.#queuePosition > 0 ? ` (queued, ${this.#queuePosition} ahead)` : ""
+            const done = this.#partialRows > 0 ? ` (${this.#partialRows} rows done)` : ""
+            this.setLoading(`Loading${".".repeat(this.#loadingProgress)}${queued}${done}`)
             this.#loadingProgress += 1
             if (this.#loadingProgress >= 4) {
                 this.#loadingProgress = 1
@@ -152,7 +186,10 @@ class ClientComms {
             window.clearInterval(this.#loadingIntervalID)
         }
         this.setLoading("")
+        window.sessionStorage.removeItem(JOB_ID_KEY)
         this.#loadingIntervalID = null
+        this.#queuePosition = 0
+        this.#partialRows = 0
     }
 
     #handleIncomingImage(msg: MsgImage) {
@@ -170,20 +207,91 @@ class ClientComms {
         } else {
             data = rawData as SentimentAnalysisResult
         }
+        this.#render(this.#countsOf(data), data)
+        this.#stopLoading()
+    }
 
-        for (const ref of this.#chartRefs) {
-            if (ref !== null) {
-                ref.destroy()
+    #handleIncomingResult(msg: MsgResult) {
+        this.#render(this.#toCounts(msg.mode, msg.data), null)
+        this.#stopLoading()
+    }
+
+    /**Merges one chunk of a streamed result into what has arrived so far and redraws the charts. The final message carries no data and only stops the loading indicator.*/
+    #handleIncomingPartial(msg: MsgPartial) {
+        this.#queuePosition = 0
+        this.#partialRows = msg.rows
+        if (msg.done) {
+            this.#stopLoading()
+            return
+        }
+        if (msg.mode == "full") {
+            const data = msg.data as SentimentAnalysisResult
+            for (const productName in data) {
+                const sofar = this.#partial[productName]
+                if (sofar === undefined) {
+                    this.#partial[productName] = data[productName]
+                } else {
+                    sofar.sentiments.push(...data[productName].sentiments)
+                    sofar.reviews.push(...data[productName].reviews)
+                }
             }
         }
+        const counts = this.#toCounts(msg.mode, msg.data)
+        for (const productName in counts) {
+            const sofar = this.#partialCounts[productName] ?? {"p": 0, "n": 0, "e": 0}
+            sofar.p += counts[productName].p
+            sofar.n += counts[productName].n
+            sofar.e += counts[productName].e
+            this.#partialCounts[productName] = sofar
+        }
+        this.#render(this.#partialCounts, msg.mode == "full" ? this.#partial : null)
+    }
 
-        const accumulatedData: {[index: string]: {"p": number, "n": number, "e": number}} = {}
+    /**Results only include individual reviews if they are going to be shown.*/
+    #mode(): ResultMode {
+        return this.showReviews ? "full" : "counts"
+    }
+
+    #toCounts(mode: ResultMode, data: SentimentAnalysisResult | SentimentCounts | SentimentColumns): SentimentCounts {
+        switch (mode) {
+            case "full":
+                return this.#countsOf(data as SentimentAnalysisResult)
+            case "columnar":
+                return this.#countsOfColumns(data as SentimentColumns)
+            default:
+                return data as SentimentCounts
+        }
+    }
+
+    #countsOf(data: SentimentAnalysisResult): SentimentCounts {
+        const counts: SentimentCounts = {}
         for (const productName in data) {
             const sentiments = {"p": 0, "n": 0, "e": 0}
             for (const sent of data[productName].sentiments) {
                 sentiments[sent] += 1
             }
-            accumulatedData[productName] = sentiments
+            counts[productName] = sentiments
+        }
+        return counts
+    }
+
+    #countsOfColumns(data: SentimentColumns): SentimentCounts {
+        const counts: SentimentCounts = {}
+        for (const productName of data.products) {
+            counts[productName] = {"p": 0, "n": 0, "e": 0}
+        }
+        for (let i = 0; i < data.index.length; i++) {
+            counts[data.products[data.index[i]]][data.sentiments[i] as "p" | "n" | "e"] += 1
+        }
+        return counts
+    }
+
+    /**Draws one pie chart per product, with a table of its reviews if they were sent.*/
+    #render(accumulatedData: SentimentCounts, data: SentimentAnalysisResult | null) {
+        for (const ref of this.#chartRefs) {
+            if (ref !== null) {
+                ref.destroy()
+            }
         }
 
         this.#chartRefs = []
@@ -198,11 +306,10 @@ class ClientComms {
                         maintainAspectRatio: false
                     }} ref={ref => { this.#chartRefs.push(ref as (ChartJS<"pie"> | null))}} redraw/>
                 </div>
-                {this.#pieTable(data[productName].reviews, data[productName].sentiments)} 
+                {data === null ? <></> : this.#pieTable(data[productName].reviews, data[productName].sentiments)} 
                 </div>) // Note: Do NOT remove redraw. It will cause a crash when rendering for the 3rd time.
             ind += 1
         }
-        this.#stopLoading()
         this.setImageReady(true)
         this.setCharts(tempCharts)
         console.log("Setting image as ready")
@@ -250,8 +357,22 @@ class ClientComms {
         </table>)
     }
 
+    /**Always the first message about a job, including when it is fetched again, so anything from an earlier attempt is dropped.*/
+    #handleIncomingQueued(msg: MsgQueued) {
+        this.#queuePosition = msg.position
+        this.#partial = {}
+        this.#partialCounts = {}
+        window.sessionStorage.setItem(JOB_ID_KEY, msg.jobId)
+    }
+
+    /**On a new connection, picks up any job that was still being waited for on the last one.*/
     #handleIncomingKey(msg: MsgKey) {
         this.#clientKey = msg.clientKey
+        const pending = window.sessionStorage.getItem(JOB_ID_KEY)
+        if (pending !== null) {
+            this.#startLoading()
+            this.#send(new MsgFetchJob(this.#clientKey, pending))
+        }
     }
 
     #handleClose(_: MsgClose) {
@@ -280,6 +401,8 @@ export default function App() {
     const [infer, setInfer] = useState(true)
     comms.setInfer = setInfer
     comms.infer = infer
+    const [showReviews, setShowReviews] = useState(false)
+    comms.showReviews = showReviews
     //console.log(`Charts: ${JSON.stringify(charts)}`)
     return (<>
     <Form className="input-form m-3" id="input-form">
@@ -301,6 +424,10 @@ export default function App() {
             <Form.Control type="text" id="rev-name-input" className="form-input" defaultValue={savedRevName}/>
         </Form.Group>
         </> : <></>}
+        <Form.Group controlId="show-reviews-check" className="form-input-group">
+            <Form.Check type="checkbox" id="show-reviews-check" label="Show individual reviews" checked={showReviews} onChange={(e) => {setShowReviews(e.target.checked)}}/>
+            <Form.Text className="text-muted">Listing every review makes results for large files much bigger and slower to arrive.</Form.Text>
+        </Form.Group>
         <Form.Group controlId="file-input" className="form-input-group">
             <Form.Label>Select CSV file:</Form.Label>
             <Form.Control type="file" id="file-input" className="form-input" accept=".csv"/>
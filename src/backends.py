@@ -0,0 +1,167 @@
+'''
+Inference backends: interchangeable ways of running the sentiment model, picked by src.config.Settings.backend.
+
+- "transformers": the transformers pipeline (eager PyTorch, fp32).
+- "onnx": the same model exported to ONNX and run by ONNX Runtime.
+- "onnx-int8": the ONNX export with its weights dynamically quantised to int8.
+
+The ONNX backends need onnxruntime, and a model exported beforehand with:
+
+    python -m src.backends export --model-dir <local model directory> --out <directory>
+
+which works offline and writes both the fp32 and the int8 model.
+
+Importing this module is cheap: transformers, torch and onnxruntime are only imported once a backend is loaded (see importLibraries()).
+'''
+
+import os
+import argparse
+import importlib
+import numpy as np
+from typing import Any
+from src.config import settings
+from src.metrics import stage, Timings
+
+MODEL = "tabularisai/multilingual-sentiment-analysis"
+ONNX_FILE = "model.onnx"
+ONNX_INT8_FILE = "model.int8.onnx"
+
+class Backend:
+    '''Runs the model on batches of reviews and returns the model's own labels (e.g. "Very Positive").'''
+    id: str
+    '''Identifies the model and how it is run, so results of different backends are never mixed up (e.g. in src.cache).'''
+    tokenizer: Any
+    '''The model's tokenizer, also used to measure reviews for batching.'''
+    labelNames: list[str]
+    '''The model's labels, in the order of the columns of scores().'''
+
+    def labels(self, reviews: list[str], batchSize: int, timings: Timings | None = None) -> list[str]:
+        '''Reviews longer than settings.maxTokens tokens are cut short. <br />
+        If a timings dict is given, the time spent tokenising and in forward passes is added to it, as "tokenise" and "forward", as far as the backend can tell them apart.'''
+        raise NotImplementedError
+
+    def scores(self, reviews: list[str], batchSize: int, timings: Timings | None = None) -> np.ndarray:
+        '''Like labels(), but returns the probability of every label (columns in labelNames order), one row per review.'''
+        raise NotImplementedError
+
+def backendId(name: str | None = None) -> str:
+    '''The id (see Backend.id) the named backend, or the configured one, has once loaded. Long reviews are labelled differently depending on settings.maxTokens and settings.longReviews, so the id includes them unless they are the defaults.'''
+    name = settings.backend if name is None else name
+    base = MODEL if name == "transformers" else f"{MODEL}#{name}"
+    if settings.maxTokens == 512 and settings.longReviews == "truncate":
+        return base
+    return f"{base}@{settings.longReviews}{settings.maxTokens}"
+
+def importLibraries(name: str | None = None):
+    '''Import the libraries the named backend (or the configured one) runs on. They take seconds to import, so this is kept out of module import time and done by whoever loads a backend first.'''
+    name = settings.backend if name is None else name
+    importlib.import_module("transformers")
+    if name != "transformers":
+        try:
+            importlib.import_module("onnxruntime")
+        except ImportError as e:
+            raise ImportError("The ONNX backends need onnxruntime (pip install onnxruntime).") from e
+
+class TransformersBackend(Backend):
+    def __init__(self, model: str = MODEL):
+        import transformers as tf
+        if settings.modelThreads > 0:
+            import torch
+            torch.set_num_threads(settings.modelThreads)
+        self.id = backendId("transformers") if model == MODEL else model
+        self.pipeline = tf.pipeline("text-classification", model=model, device="cpu")
+        self.tokenizer = self.pipeline.tokenizer
+        id2label = self.pipeline.model.config.id2label
+        self.labelNames = [id2label[i] for i in sorted(id2label)]
+
+    def labels(self, reviews: list[str], batchSize: int, timings: Timings | None = None) -> list[str]:
+        with stage(timings, "forward"): # The pipeline tokenises internally
+            return [rawSent["label"] for rawSent in self.pipeline(reviews, batch_size=batchSize, truncation=True, max_length=settings.maxTokens)]
+
+    def scores(self, reviews: list[str], batchSize: int, timings: Timings | None = None) -> np.ndarray:
+        columns = {name: i for i, name in enumerate(self.labelNames)}
+        scores = np.zeros((len(reviews), len(self.labelNames)))
+        with stage(timings, "forward"):
+            for row, allScores in enumerate(self.pipeline(reviews, batch_size=batchSize, truncation=True, max_length=settings.maxTokens, top_k=None)):
+                for score in allScores:
+                    scores[row, columns[score["label"]]] = score["score"]
+        return scores
+
+class OnnxBackend(Backend):
+    '''Runs an export made by export() with ONNX Runtime. Each batch is padded only to its own longest review.'''
+    def __init__(self, directory: str, quantised: bool = False):
+        importLibraries("onnx")
+        import onnxruntime as ort
+        import transformers as tf
+        file = ONNX_INT8_FILE if quantised else ONNX_FILE
+        self.id = backendId("onnx-int8" if quantised else "onnx")
+        self.tokenizer = tf.AutoTokenizer.from_pretrained(directory, local_files_only=True)
+        self.id2label: dict[int, str] = tf.AutoConfig.from_pretrained(directory, local_files_only=True).id2label
+        self.labelNames = [self.id2label[i] for i in sorted(self.id2label)]
+        options = ort.SessionOptions()
+        if settings.modelThreads > 0:
+            options.intra_op_num_threads = settings.modelThreads
+        self.session = ort.InferenceSession(os.path.join(directory, file), options, providers=["CPUExecutionProvider"])
+        self.inputs = [i.name for i in self.session.get_inputs()]
+
+    def logits(self, reviews: list[str], batchSize: int, timings: Timings | None = None) -> np.ndarray:
+        batches: list[np.ndarray] = []
+        for start in range(0, len(reviews), batchSize):
+            with stage(timings, "tokenise"):
+                encoded = self.tokenizer(reviews[start:start + batchSize], padding=True, truncation=True, max_length=settings.maxTokens, return_tensors="np")
+            with stage(timings, "forward"):
+                batches.append(self.session.run(None, {name: encoded[name].astype(np.int64) for name in self.inputs})[0])
+        return np.concatenate(batches)
+
+    def labels(self, reviews: list[str], batchSize: int, timings: Timings | None = None) -> list[str]:
+        return [self.id2label[int(i)] for i in self.logits(reviews, batchSize, timings).argmax(axis=-1)]
+
+    def scores(self, reviews: list[str], batchSize: int, timings: Timings | None = None) -> np.ndarray:
+        logits = self.logits(reviews, batchSize, timings)
+        exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        return exp / exp.sum(axis=-1, keepdims=True)
+
+def loadBackend(name: str | None = None) -> Backend:
+    '''Load the named backend, or the configured one.'''
+    name = settings.backend if name is None else name
+    match name:
+        case "transformers":
+            return TransformersBackend()
+        case "onnx":
+            return OnnxBackend(settings.onnxDir)
+        case "onnx-int8":
+            return OnnxBackend(settings.onnxDir, quantised=True)
+        case _:
+            raise ValueError(f"Unknown backend {name}")
+
+def export(modelDir: str, out: str, quantise: bool = True):
+    '''Export a locally available model to ONNX in out, together with its tokenizer and config, and optionally an int8 copy. Never touches the network.'''
+    import torch
+    import transformers as tf
+    model = tf.AutoModelForSequenceClassification.from_pretrained(modelDir, local_files_only=True)
+    tokenizer = tf.AutoTokenizer.from_pretrained(modelDir, local_files_only=True)
+    model.eval()
+    os.makedirs(out, exist_ok=True)
+    sample = tokenizer(["good", "tidak bagus sama sekali"], padding=True, return_tensors="pt")
+    names = [name for name in ["input_ids", "attention_mask", "token_type_ids"] if name in sample]
+    axes = {name: {0: "batch", 1: "sequence"} for name in names}
+    axes["logits"] = {0: "batch"}
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(sample[name] for name in names), os.path.join(out, ONNX_FILE), input_names=names, output_names=["logits"], dynamic_axes=axes, opset_version=17, dynamo=False)
+    tokenizer.save_pretrained(out)
+    model.config.save_pretrained(out)
+    print(f"Exported {modelDir} to {os.path.join(out, ONNX_FILE)}")
+    if quantise:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(os.path.join(out, ONNX_FILE), os.path.join(out, ONNX_INT8_FILE), weight_type=QuantType.QInt8)
+        print(f"Quantised to {os.path.join(out, ONNX_INT8_FILE)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prepare models for the ONNX backends.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    exporter = commands.add_parser("export", help="Export a local model to ONNX (fp32 and int8).")
+    exporter.add_argument("--model-dir", required=True, help="Directory holding the model, e.g. a snapshot from the HuggingFace cache.")
+    exporter.add_argument("--out", default=settings.onnxDir, help=f"Where to write the export (default {settings.onnxDir}).")
+    exporter.add_argument("--no-quantise", action="store_true", help="Skip writing the int8 model.")
+    args = parser.parse_args()
+    export(args.model_dir, args.out, not args.no_quantise)
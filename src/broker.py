@@ -0,0 +1,342 @@
+'''
+Job broker, so that analysis workers can run in processes of their own, on this machine or others, and be added or removed independently of the server that holds the client connections.
+
+The broker is a small process holding one shared queue of jobs and, for every server that submits jobs, a queue of events (progress and results) to send back to it. Workers take jobs from the shared queue, so adding workers adds throughput without touching the server. Jobs are routed back by the ID of the server that submitted them, so results always reach the process holding the client's connection.
+
+Used by src.jobs.JobQueue when workerMode is "broker". By default (brokerStart) the server starts a broker on a Unix socket and that many local workers itself. To run them separately, e.g. on other machines:
+
+    python -m src.broker serve
+    python -m src.broker work --count 4
+
+with the same SENTIMENT_BROKERADDRESS and SENTIMENT_BROKERKEY everywhere. Jobs and results are pickled, so every machine needs the same code, and anyone with the key can run code on the broker and every worker: on a network address, the default key is refused (see authKey()). Uploads are passed to workers as file paths, so workers on other machines need SENTIMENT_UPLOADDIR on a shared filesystem.
+'''
+
+import os
+import sys
+import time
+import uuid
+import queue
+import pickle
+import asyncio
+import argparse
+import threading
+import multiprocessing as mp
+import multiprocessing.managers as mpm
+from typing import Any, Callable
+from src.config import settings, Settings
+from src.logs import getLogger
+
+log = getLogger("broker")
+
+HEARTBEAT = 2.0
+'''Seconds between a worker's heartbeats.'''
+WORKER_TIMEOUT = 15.0
+'''Seconds without a heartbeat after which a worker is considered lost, and the job it was running failed.'''
+
+def address(value: str | None = None) -> str | tuple[str, int]:
+    '''Parse a broker address (see src.config.Settings.brokerAddress): "unix:<path>" or "<host>:<port>".'''
+    value = settings.brokerAddress if value is None else value
+    if value.startswith("unix:"):
+        return value.removeprefix("unix:")
+    host, _, port = value.rpartition(":")
+    return (host, int(port))
+
+def authKey(at: str | None = None, key: str | None = None) -> bytes:
+    '''The key to authenticate to the broker at the given address with (settings.brokerKey by default). <br />
+    Raises ValueError if the address is a network one and the key is still the default, which is public: jobs and results are unpickled on the other side, so whoever has the key can run code there.'''
+    key = settings.brokerKey if key is None else key
+    if not isinstance(address(at), str) and key == Settings.model_fields["brokerKey"].default:
+        raise ValueError(f"The broker at {at or settings.brokerAddress} is on the network, so SENTIMENT_BROKERKEY must be set to a secret of your own, the same for the server, the broker and every worker.")
+    return key.encode("utf-8")
+
+class Broker:
+    '''Lives in the broker process; servers and workers call it through proxies (see connect()). Payloads are pickled by the caller and passed through as bytes, so the broker never imports the analysis code.'''
+    def __init__(self):
+        self.jobs: queue.Queue[tuple[str, str, bytes]] = queue.Queue()
+        '''(server ID, job ID, pickled (fn, args, reports progress)) for every job not taken yet.'''
+        self.events: dict[str, queue.Queue[tuple[str, str, Any]]] = {}
+        '''(kind, job ID, payload) for each server, by server ID. kind is "progress", "done" or "failed".'''
+        self.workers: dict[str, dict[str, Any]] = {}
+        '''Live workers by ID: warm-up timings, last heartbeat and the job being run.'''
+        self.errors: list[str] = []
+        '''Why workers failed to warm up.'''
+        self._lock = threading.Lock()
+
+    def _events(self, serverId: str) -> queue.Queue[tuple[str, str, Any]]:
+        with self._lock:
+            events = self.events.get(serverId)
+            if events is None:
+                events = queue.Queue()
+                self.events[serverId] = events
+            return events
+
+    def put(self, serverId: str, jobId: str, payload: bytes):
+        self._events(serverId)
+        self.jobs.put((serverId, jobId, payload))
+
+    def take(self, workerId: str, timeout: float) -> tuple[str, str, bytes] | None:
+        '''The next job for a worker, or None if there was none within timeout seconds.'''
+        self.reap()
+        try:
+            job = self.jobs.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self._lock:
+            worker = self.workers.get(workerId)
+            if worker is not None:
+                worker["job"] = job[:2]
+                worker["seen"] = time.monotonic()
+        return job
+
+    def report(self, serverId: str, kind: str, jobId: str, payload: Any, workerId: str | None = None):
+        '''Send a job's progress or result back to the server that submitted it. A final report ("done" or "failed") frees the worker.'''
+        if workerId is not None and kind != "progress":
+            with self._lock:
+                worker = self.workers.get(workerId)
+                if worker is not None:
+                    worker["job"] = None
+        self._events(serverId).put((kind, jobId, payload))
+
+    def poll(self, serverId: str, timeout: float) -> list[tuple[str, str, Any]]:
+        '''Every event waiting for a server, waiting up to timeout seconds for the first.'''
+        self.reap()
+        events = self._events(serverId)
+        try:
+            first = events.get(timeout=timeout)
+        except queue.Empty:
+            return []
+        out = [first]
+        while True:
+            try:
+                out.append(events.get_nowait())
+            except queue.Empty:
+                return out
+
+    def register(self, workerId: str, timings: dict[str, Any]):
+        '''Called by a worker once it has warmed up and is ready for jobs.'''
+        with self._lock:
+            self.workers[workerId] = {"timings": timings, "seen": time.monotonic(), "job": None}
+
+    def failed(self, workerId: str, error: str):
+        '''Called by a worker that could not warm up, before it exits.'''
+        with self._lock:
+            self.errors.append(f"{workerId}: {error}")
+
+    def heartbeat(self, workerId: str):
+        with self._lock:
+            worker = self.workers.get(workerId)
+            if worker is not None:
+                worker["seen"] = time.monotonic()
+
+    def leave(self, workerId: str):
+        with self._lock:
+            self.workers.pop(workerId, None)
+
+    def reap(self):
+        '''Forget workers that stopped sending heartbeats, and fail the jobs they were running.'''
+        now = time.monotonic()
+        with self._lock:
+            lost = [(workerId, worker["job"]) for workerId, worker in self.workers.items() if now - worker["seen"] > WORKER_TIMEOUT]
+            for workerId, _ in lost:
+                del self.workers[workerId]
+        for workerId, job in lost:
+            if job is not None:
+                self._events(job[0]).put(("failed", job[1], f"Worker {workerId} was lost while running the job."))
+
+    def workerStatus(self) -> tuple[list[dict[str, Any]], list[str]]:
+        '''Warm-up timings of every live worker, and the errors of workers that failed to warm up.'''
+        with self._lock:
+            return [worker["timings"] for worker in self.workers.values()], list(self.errors)
+
+class BrokerManager(mpm.BaseManager):
+    pass
+
+_broker: Broker | None = None
+
+def _getBroker() -> Broker:
+    global _broker
+    if _broker is None:
+        _broker = Broker()
+    return _broker
+
+BrokerManager.register("broker", callable=_getBroker)
+
+def serve(at: str | None = None, key: str | None = None):
+    '''Run a broker until the process is stopped.'''
+    manager = BrokerManager(address=address(at), authkey=authKey(at, key))
+    server = manager.get_server()
+    log.info("Broker listening", address=at or settings.brokerAddress)
+    server.serve_forever()
+
+def connect(at: str | None = None, key: str | None = None, timeout: float = 30.0) -> Any:
+    '''A proxy to the broker at the given address (settings.brokerAddress by default), retrying until it is up or timeout seconds pass. Proxies open one connection per thread, so they can be shared between threads.'''
+    deadline = time.monotonic() + timeout
+    authkey = authKey(at, key)
+    while True:
+        manager = BrokerManager(address=address(at), authkey=authkey)
+        try:
+            manager.connect()
+            return manager.broker() # type: ignore
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+class _BrokerReporter:
+    '''Hands a job's progress from a worker back to the server that submitted it.'''
+    def __init__(self, broker: Any, serverId: str, jobId: str):
+        self.broker = broker
+        self.serverId = serverId
+        self.jobId = jobId
+
+    def __call__(self, *item: Any):
+        self.broker.report(self.serverId, "progress", self.jobId, item)
+
+def work(at: str | None = None, key: str | None = None):
+    '''Run one worker until the process is stopped: load the model, then run jobs from the broker one at a time.'''
+    from src.inference import warmUp
+    from src.logs import setup
+    setup()
+    workerId = f"{os.uname().nodename}-{os.getpid()}"
+    broker = connect(at, key)
+    try:
+        timings = warmUp()
+    except Exception as e:
+        log.exception("Worker failed to warm up", worker=workerId)
+        broker.failed(workerId, f"{type(e).__name__}: {e}")
+        raise
+    broker.register(workerId, timings)
+    log.info("Worker ready", worker=workerId, **timings)
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(HEARTBEAT):
+            broker.heartbeat(workerId)
+
+    threading.Thread(target=beat, daemon=True).start()
+    try:
+        while True:
+            job = broker.take(workerId, HEARTBEAT)
+            if job is None:
+                continue
+            serverId, jobId, payload = job
+            try:
+                fn, args, progress = pickle.loads(payload)
+                if progress:
+                    args = (*args, _BrokerReporter(broker, serverId, jobId))
+                broker.report(serverId, "done", jobId, pickle.dumps(fn(*args)), workerId)
+            except Exception as e:
+                log.exception("Job failed", worker=workerId, jobId=jobId)
+                broker.report(serverId, "failed", jobId, f"{type(e).__name__}: {e}", workerId)
+    finally:
+        stopped.set()
+        broker.leave(workerId)
+
+class BrokerError(Exception):
+    '''A job failed on a broker worker. The message is the worker's description of the error.'''
+
+class BrokerClient:
+    '''A server's side of the broker: submits jobs and relays their events back onto the event loop. <br />
+    If start is true, also starts a broker and that many local workers as child processes, stopped again by stop().'''
+    def __init__(self, workers: int = 0, at: str | None = None, key: str | None = None):
+        self.id = str(uuid.uuid4())
+        self.workers = workers
+        self.at = settings.brokerAddress if at is None else at
+        self.key = settings.brokerKey if key is None else key
+        self.broker: Any = None
+        self.processes: list[Any] = []
+        self.waiting: dict[str, tuple[asyncio.Future[Any], Callable[..., Any] | None]] = {}
+
+    def connect(self):
+        '''Start the broker and local workers if asked to, and connect. Blocks; run it off the event loop. Raises ValueError if the broker key may not be used at its address (see authKey()).'''
+        authKey(self.at, self.key)
+        if self.workers > 0:
+            context = mp.get_context("spawn")
+            at = address(self.at)
+            if isinstance(at, str) and os.path.exists(at):
+                os.remove(at)
+            broker = context.Process(target=serve, args=(self.at, self.key), daemon=True)
+            broker.start()
+            self.processes.append(broker)
+            for _ in range(self.workers):
+                worker = context.Process(target=work, args=(self.at, self.key), daemon=True)
+                worker.start()
+                self.processes.append(worker)
+        self.broker = connect(self.at, self.key)
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            process.join(5)
+        at = address(self.at)
+        if len(self.processes) > 0 and isinstance(at, str) and os.path.exists(at):
+            os.remove(at)
+        self.processes.clear()
+        for future, _ in self.waiting.values():
+            future.cancel()
+        self.waiting.clear()
+
+    async def run(self, fn: Callable[..., Any], args: tuple[Any, ...], onProgress: Callable[..., Any] | None = None) -> Any:
+        '''Run fn(*args) on whichever worker is free next and return its result. As for JobQueue.submit(), fn is given a progress reporter as its last argument if onProgress is given.'''
+        jobId = str(uuid.uuid4())
+        future: asyncio.Future[Any] = asyncio.get_running_loop().create_future()
+        self.waiting[jobId] = (future, onProgress)
+        try:
+            payload = pickle.dumps((fn, args, onProgress is not None))
+            await asyncio.to_thread(self.broker.put, self.id, jobId, payload)
+            return await future
+        finally:
+            self.waiting.pop(jobId, None)
+
+    async def relay(self):
+        '''Pass events from the broker to the jobs waiting for them, until cancelled.'''
+        while True:
+            for kind, jobId, payload in await asyncio.to_thread(self.broker.poll, self.id, 1.0):
+                waiting = self.waiting.get(jobId)
+                if waiting is None:
+                    continue
+                future, onProgress = waiting
+                if kind == "progress":
+                    if onProgress is not None:
+                        onProgress(*payload)
+                elif future.done():
+                    continue
+                elif kind == "done":
+                    future.set_result(pickle.loads(payload))
+                else:
+                    future.set_exception(BrokerError(payload))
+
+    def workerStatus(self) -> tuple[list[dict[str, Any]], list[str]]:
+        return ([], []) if self.broker is None else self.broker.workerStatus()
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(prog="python -m src.broker", description="Run the job broker, or analysis workers that take jobs from it.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serveParser = commands.add_parser("serve", help="Run the broker.")
+    serveParser.add_argument("--address", default=None, help="unix:<path> or <host>:<port> (default: SENTIMENT_BROKERADDRESS).")
+    workParser = commands.add_parser("work", help="Run workers that take jobs from the broker.")
+    workParser.add_argument("--address", default=None, help="unix:<path> or <host>:<port> (default: SENTIMENT_BROKERADDRESS).")
+    workParser.add_argument("--count", type=int, default=1, help="How many worker processes to run (default 1). Each loads its own copy of the model.")
+    args = parser.parse_args(argv)
+    from src.logs import setup
+    setup()
+    try:
+        authKey(args.address)
+    except ValueError as e:
+        log.error(str(e))
+        return 2
+    if args.command == "serve":
+        serve(args.address)
+    elif args.count == 1:
+        work(args.address)
+    else:
+        context = mp.get_context("spawn")
+        processes = [context.Process(target=work, args=(args.address,)) for _ in range(args.count)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+if __name__ == "__main__":
+    sys.exit(main())
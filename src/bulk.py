@@ -0,0 +1,241 @@
+'''
+Offline scoring of whole CSV files, e.g. all of testing/dataset.csv or a nightly catalogue export, without the server:
+
+    python -m src.bulk reviews.csv results/ --workers 4
+
+The CSV is read shardRows rows at a time, never all at once, and each shard is scored by one of a pool of worker processes, each with its own copy of the model, through the same code as uploads (see src.process). Every shard's rows are written to their own file as soon as it is done, and recorded in a checkpoint, so a run that is interrupted picks up where it stopped when the same command is run again: finished shards are only parsed again to skip past them, never scored again.
+
+Output, in the output directory:
+- rows/part-NNNNN.parquet (or .csv), one file per shard: each review's row (its position among the CSV's records, from 0), product and sentiment ("p", "n", "e", or empty if the model's label was unknown), and the review itself with --include-reviews. pandas.read_parquet("results/rows") reads them all as one table.
+- products.parquet (or .csv): for each product, in order of first appearance, how many of its reviews are of each sentiment (p, n, e) and in total (reviews).
+- checkpoint.json: the run's input and settings and the shards done so far.
+'''
+
+import os
+import sys
+import json
+import time as t
+import shutil
+import argparse
+import threading
+import importlib
+import multiprocessing as mp
+import concurrent.futures as cf
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Any, Literal
+from src.config import settings
+from src.logs import getLogger
+from src.metrics import stage, Timings
+from src.backends import backendId
+from src.cascade import cascadeId
+from src.process import CsvError, readCsv, present, group, label, hasPyarrow
+from src.inference import SENTIMENTS
+
+type OutputFormat = Literal["parquet", "csv"]
+
+log = getLogger("bulk")
+
+class Checkpoint:
+    '''Progress of a bulk run, kept in checkpoint.json in its output directory: the run's input and settings, and how many rows each finished shard had. Saved after every shard, by replacing the file, so it is never left half written. Shards may be finished from any thread.'''
+    def __init__(self, path: Path, run: dict[str, Any], shards: dict[int, int] | None = None):
+        self.path = path
+        self.run = run
+        self.shards: dict[int, int] = {} if shards is None else shards
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def load(path: Path, run: dict[str, Any]) -> "Checkpoint":
+        '''The checkpoint at path, or a new one if there is none. Raises ValueError if it belongs to a different input or different settings, as its shards cannot be reused then.'''
+        if not path.exists():
+            return Checkpoint(path, run)
+        with open(path, encoding="utf-8") as file:
+            saved = json.load(file)
+        changed = sorted(name for name in {*run, *saved["run"]} if run.get(name) != saved["run"].get(name))
+        if len(changed) > 0:
+            raise ValueError(f"{path.parent} holds a run with a different {", ".join(changed)}. Pass --restart to discard it, or choose another output directory.")
+        return Checkpoint(path, run, {int(shard): rows for shard, rows in saved["shards"].items()})
+
+    def finish(self, shard: int, rows: int):
+        with self._lock:
+            self.shards[shard] = rows
+            self.save()
+
+    def save(self):
+        temporary = self.path.with_suffix(".tmp")
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump({"run": self.run, "shards": {str(shard): rows for shard, rows in sorted(self.shards.items())}}, file, indent=1)
+        os.replace(temporary, self.path)
+
+def partPath(outDir: Path, shard: int, format: OutputFormat) -> Path:
+    return outDir / "rows" / f"part-{shard:05d}.{format}"
+
+def write(frame: pd.DataFrame, path: Path, format: OutputFormat):
+    '''Write frame to path through a temporary file, so that path only ever holds a complete file.'''
+    temporary = path.with_name(path.name + ".tmp")
+    if format == "parquet":
+        frame.to_parquet(temporary, index=False)
+    else:
+        frame.to_csv(temporary, index=False)
+    os.replace(temporary, path)
+
+def read(path: Path, format: OutputFormat, columns: list[str]) -> pd.DataFrame:
+    if format == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns, dtype=pd.StringDtype(), keep_default_na=False)
+
+def _startWorker(modelThreads: int):
+    '''Runs first in every worker process: load the model before any shard arrives, so that shards are timed without it.'''
+    from src.logs import setup
+    from src.inference import warmUp
+    setup()
+    settings.modelThreads = modelThreads
+    warmUp()
+
+def scoreShard(shard: int, chunk: pd.DataFrame, prodName: str, revName: str, outDir: Path, format: OutputFormat, includeReviews: bool) -> tuple[int, int, Timings]:
+    '''Score one shard of the CSV and write its rows (see the module docstring). Returns the shard, how many reviews it had and its stage timings (see src.metrics.Timings).'''
+    timings: Timings = {}
+    with stage(timings, "group"):
+        chunk = chunk[present(chunk, prodName, revName)]
+        grouped = group(chunk, prodName, revName)
+    with stage(timings, "label"):
+        sentiments = label(grouped, timings=timings)
+    with stage(timings, "encode"):
+        frame = pd.DataFrame({
+            "row": chunk.index.to_numpy(dtype=np.int64),
+            "product": chunk[prodName].array,
+            "sentiment": pd.array(sentiments, dtype=pd.StringDtype()),
+        })
+        if includeReviews:
+            frame["review"] = chunk[revName].array
+        write(frame, partPath(outDir, shard, format), format)
+    return shard, len(frame), timings
+
+def tally(part: pd.DataFrame) -> pd.DataFrame:
+    '''How many of a part's reviews of each product are of each sentiment, and in total, with products in order of first appearance.'''
+    codes, names = pd.factorize(part["product"].to_numpy(dtype=object))
+    sentimentCodes = pd.Index(SENTIMENTS).get_indexer(part["sentiment"].to_numpy(dtype=object, na_value=None)) # -1 for unknown ones
+    table = np.zeros((len(names), len(SENTIMENTS)), dtype=np.int64)
+    known = sentimentCodes >= 0
+    np.add.at(table, (codes[known], sentimentCodes[known]), 1)
+    counts = pd.DataFrame(table, index=pd.Index(names, name="product"), columns=SENTIMENTS)
+    counts["reviews"] = np.bincount(codes, minlength=len(names))
+    return counts
+
+def aggregate(outDir: Path, shards: list[int], format: OutputFormat) -> pd.DataFrame:
+    '''Per-product counts over the parts of every shard, read back from disk, so shards scored by an earlier, interrupted run are included.'''
+    tallies = [tally(read(partPath(outDir, shard, format), format, ["product", "sentiment"])) for shard in shards]
+    if len(tallies) == 0:
+        return pd.DataFrame({"product": pd.Series(dtype=pd.StringDtype()), **{name: pd.Series(dtype=np.int64) for name in [*SENTIMENTS, "reviews"]}})
+    return pd.concat(tallies).groupby(level=0, sort=False).sum().reset_index()
+
+def defaultFormat() -> OutputFormat:
+    '''Parquet if pyarrow is installed to write it, otherwise CSV.'''
+    return "parquet" if hasPyarrow() else "csv"
+
+def run(source: Path, outDir: Path, infer: bool = True, prodName: str = "", revName: str = "", format: OutputFormat | None = None, workers: int | None = None, shardRows: int | None = None, modelThreads: int | None = None, includeReviews: bool = False, restart: bool = False) -> int:
+    '''Score every review of the CSV at source into outDir (see the module docstring), resuming from outDir's checkpoint unless restart is set. Returns how many reviews were scored by this call. <br />
+    format is resolved by defaultFormat() if None. Raises ImportError before anything is read if format is "parquet" and pyarrow is missing, CsvError if the columns cannot be resolved, and ValueError if outDir holds a run that cannot be resumed.'''
+    workers = settings.workers if workers is None else workers
+    shardRows = settings.bulkShardRows if shardRows is None else shardRows
+    modelThreads = settings.modelThreads if modelThreads is None else modelThreads
+    if format is None:
+        format = defaultFormat()
+        if format == "csv":
+            log.warning("pyarrow is not installed, so results are written as CSV (pip install pyarrow for Parquet)")
+    if format == "parquet":
+        try:
+            importlib.import_module("pyarrow")
+        except ImportError as e:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow). Use --format csv otherwise.") from e
+    chunks, prodName, revName = readCsv(source, infer, prodName, revName, shardRows)
+    if restart:
+        shutil.rmtree(outDir / "rows", ignore_errors=True)
+        (outDir / "checkpoint.json").unlink(missing_ok=True)
+    (outDir / "rows").mkdir(parents=True, exist_ok=True)
+    stat = source.stat()
+    checkpoint = Checkpoint.load(outDir / "checkpoint.json", {
+        "input": str(source.resolve()), "inputBytes": stat.st_size, "inputModified": stat.st_mtime_ns,
+        "product": prodName, "review": revName, "shardRows": shardRows, "format": format, "includeReviews": includeReviews, "model": backendId(), "cascade": cascadeId(),
+    })
+    if len(checkpoint.shards) > 0:
+        log.info("Resuming", shardsDone=len(checkpoint.shards), rowsDone=sum(checkpoint.shards.values()))
+    start = t.perf_counter()
+    scored = 0
+    totals: Timings = {}
+    executor = cf.ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"), initializer=_startWorker, initargs=(modelThreads,))
+    running: set[cf.Future] = set()
+
+    def record(future: cf.Future):
+        '''Checkpoint a shard as soon as it is done, from the executor's thread, so shards that finish while the run is stopping early are kept too.'''
+        if not future.cancelled() and future.exception() is None:
+            shard, rows, _ = future.result()
+            checkpoint.finish(shard, rows)
+
+    def collect(done: set[cf.Future]):
+        nonlocal scored
+        for future in done:
+            shard, rows, timings = future.result()
+            scored += rows
+            for name, value in timings.items():
+                totals[name] = totals.get(name, 0.0) + value
+            log.info("Shard done", shard=shard, rows=rows, rowsPerSecond=round(scored / (t.perf_counter() - start)))
+
+    try:
+        shards = 0
+        for shard, chunk in enumerate(chunks): # type: ignore
+            shards = shard + 1
+            if shard in checkpoint.shards:
+                continue
+            # At most two shards per worker are parsed ahead, so memory does not grow with the input
+            if len(running) >= 2 * workers:
+                done, running = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(scoreShard, shard, chunk, prodName, revName, outDir, format, includeReviews)
+            future.add_done_callback(record)
+            running.add(future)
+        collect(running)
+        running = set()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    products = aggregate(outDir, list(range(shards)), format)
+    write(products, outDir / f"products.{format}", format)
+    seconds = t.perf_counter() - start
+    log.info("Done", shards=shards, rows=sum(checkpoint.shards.values()), scored=scored, products=len(products), seconds=round(seconds, 2), rowsPerSecond=round(scored / seconds), timings={name: round(value, 2) for name, value in totals.items()})
+    return scored
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m src.bulk", description="Score every review of a CSV file with a pool of worker processes, writing per-row sentiments and per-product counts. Interrupted runs resume from their checkpoint.")
+    parser.add_argument("input", type=Path, help="The CSV to score.")
+    parser.add_argument("output", type=Path, help="Directory for the results and the checkpoint. Created if missing.")
+    parser.add_argument("--product", default=None, help="Name of the product column. Inferred with --review from the header if neither is given.")
+    parser.add_argument("--review", default=None, help="Name of the review column.")
+    parser.add_argument("--format", choices=["parquet", "csv"], default=None, help="Output format (default parquet if pyarrow is installed, otherwise csv).")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, each with its own copy of the model (default: SENTIMENT_WORKERS).")
+    parser.add_argument("--shard-rows", type=int, default=None, help="Rows per shard (default: SENTIMENT_BULKSHARDROWS). Progress is checkpointed once per shard.")
+    parser.add_argument("--model-threads", type=int, default=None, help="Threads per worker's model (default: SENTIMENT_MODELTHREADS). 1 or 2 stops workers fighting over cores.")
+    parser.add_argument("--include-reviews", action="store_true", help="Also write each review's text next to its sentiment.")
+    parser.add_argument("--restart", action="store_true", help="Discard the output directory's checkpoint and results and start over.")
+    args = parser.parse_args(argv)
+    if (args.product is None) != (args.review is None):
+        parser.error("--product and --review must be given together.")
+    from src.logs import setup, shutdown
+    setup()
+    try:
+        run(args.input, args.output, args.product is None, args.product or "", args.review or "", args.format, args.workers, args.shard_rows, args.model_threads, args.include_reviews, args.restart)
+        return 0
+    except (CsvError, ValueError, ImportError, OSError) as e:
+        log.error(str(e))
+        return 2
+    except KeyboardInterrupt:
+        log.warning("Interrupted. Run the same command again to resume.")
+        return 130
+    except Exception:
+        log.exception("Bulk run failed. Finished shards are kept; run the same command again to resume.")
+        return 1
+    finally:
+        shutdown()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+'''
+Persistent sentiment cache, so that review texts the model has already seen never go through it again.
+'''
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import collections as col
+from src.config import settings
+
+def normalise(text: str) -> str:
+    '''The form of a review used for cache keys. Only differences the model cannot care about (Unicode representation, surrounding and repeated whitespace) are removed.'''
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def key(text: str, model: str) -> str:
+    '''Content address of a review: a hash of the model and the normalised text.'''
+    return hashlib.sha256(f"{model}\0{normalise(text)}".encode("utf-8")).hexdigest()
+
+class SentimentCache:
+    '''Maps review content addresses (see key()) to sentiments. <br />
+    Lookups go to an in-memory LRU first and to a SQLite file second, so results survive restarts and are shared by every worker, thread or process, using the same file.
+
+    Every maxEntries / 10 insertions, the file is trimmed back to maxEntries, least recently used first.'''
+    def __init__(self, path: str | None = None, memoryEntries: int | None = None, maxEntries: int | None = None):
+        self.path = settings.cachePath if path is None else path
+        self.memoryEntries = settings.cacheMemoryEntries if memoryEntries is None else memoryEntries
+        self.maxEntries = settings.cacheMaxEntries if maxEntries is None else maxEntries
+        self.memory: col.OrderedDict[str, str] = col.OrderedDict()
+        self.hits: int = 0
+        self.diskHits: int = 0
+        self.misses: int = 0
+        self.deduplicated: int = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sinceTrim: int = 0
+        self._connect() # Fail early if the file cannot be used
+
+    def _connect(self) -> sqlite3.Connection:
+        '''The calling thread's connection to the cache file.'''
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sentiments (key TEXT PRIMARY KEY, sentiment TEXT NOT NULL, used INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sentimentsUsed ON sentiments (used)")
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key: str, sentiment: str):
+        '''Put an entry at the front of the in-memory LRU. Lock must be held.'''
+        self.memory[key] = sentiment
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memoryEntries:
+            self.memory.popitem(last=False)
+
+    def get(self, keys: list[str]) -> dict[str, str]:
+        '''Look up many keys at once. Returns only the ones found.'''
+        found: dict[str, str] = {}
+        rest: list[str] = []
+        with self._lock:
+            for k in keys:
+                sentiment = self.memory.get(k)
+                if sentiment is None:
+                    rest.append(k)
+                else:
+                    self.memory.move_to_end(k)
+                    found[k] = sentiment
+        if len(rest) > 0:
+            conn = self._connect()
+            fromDisk: dict[str, str] = {}
+            for i in range(0, len(rest), 500): # SQLite caps bound parameters per statement
+                part = rest[i:i + 500]
+                rows = conn.execute(f"SELECT key, sentiment FROM sentiments WHERE key IN ({",".join("?" * len(part))})", part)
+                fromDisk.update(rows.fetchall())
+            if len(fromDisk) > 0:
+                now = int(time.time())
+                conn.executemany("UPDATE sentiments SET used = ? WHERE key = ?", [(now, k) for k in fromDisk])
+                conn.commit()
+            with self._lock:
+                for k, sentiment in fromDisk.items():
+                    self._remember(k, sentiment)
+                self.diskHits += len(fromDisk)
+            found.update(fromDisk)
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, entries: dict[str, str]):
+        '''Store many key -> sentiment pairs at once.'''
+        if len(entries) == 0:
+            return
+        with self._lock:
+            for k, sentiment in entries.items():
+                self._remember(k, sentiment)
+            self._sinceTrim += len(entries)
+            trim = self._sinceTrim > self.maxEntries // 10
+            if trim:
+                self._sinceTrim = 0
+        conn = self._connect()
+        now = int(time.time())
+        conn.executemany("INSERT OR REPLACE INTO sentiments (key, sentiment, used) VALUES (?, ?, ?)", [(k, sentiment, now) for k, sentiment in entries.items()])
+        if trim:
+            count = conn.execute("SELECT COUNT(*) FROM sentiments").fetchone()[0]
+            if count > self.maxEntries:
+                conn.execute("DELETE FROM sentiments WHERE key IN (SELECT key FROM sentiments ORDER BY used ASC LIMIT ?)", (count - self.maxEntries,))
+        conn.commit()
+
+    def countDeduplicated(self, count: int):
+        '''Record how many reviews of a request were skipped as repeats of another one.'''
+        with self._lock:
+            self.deduplicated += count
+
+    def stats(self) -> dict[str, int]:
+        '''Hit/miss counters since this process started. hits includes diskHits; deduplicated counts repeats within a request, which never reach the cache.'''
+        with self._lock:
+            return {"hits": self.hits, "diskHits": self.diskHits, "misses": self.misses, "deduplicated": self.deduplicated, "memoryEntries": len(self.memory)}
+
+_cache: SentimentCache | None = None
+_cacheLock = threading.Lock()
+
+def getCache() -> SentimentCache | None:
+    '''The process-wide cache, or None if caching is turned off.'''
+    global _cache
+    if not settings.cacheEnabled:
+        return None
+    with _cacheLock:
+        if _cache is None:
+            _cache = SentimentCache()
+        return _cache
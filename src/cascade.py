@@ -0,0 +1,210 @@
+'''
+First pass of the model cascade (settings.cascade): a linear classifier over hashed word and character n-grams, trained offline on the transformer's own sentiments, which settles the reviews it is confident about so that only the rest go through the transformer (see src.inference.classify). <br />
+Most reviews are short and clear-cut ("good", "tidak bagus"), and the classifier takes microseconds per review where a forward pass takes milliseconds.
+
+Train it once on a large CSV, e.g. testing/dataset.csv, leaving out the reviews it will be evaluated on:
+
+    python -m src.cascade train testing/dataset.csv --product product_name --review Summary --exclude testing/testData.csv
+
+then set SENTIMENT_CASCADE=true, and check agreement with the transformer and the escalation rate at various thresholds with testing/cascade.py.
+'''
+
+import os
+import re
+import math
+import sys
+import zlib
+import argparse
+import threading
+import numpy as np
+from pathlib import Path
+from typing import Any
+from src.config import settings
+from src.logs import getLogger
+
+log = getLogger("cascade")
+
+DIMENSIONS = 1 << 18
+'''Size of the hashed feature space. Collisions are rare at this size for review vocabularies, and the weights take 3 MiB.'''
+
+_WORD = re.compile(r"\w+")
+
+def terms(review: str) -> list[str]:
+    '''The features of a review: its lowercased words, pairs of consecutive words (so "not good" differs from "good") and three-character pieces of every word (so misspellings like "gud" or "bagusss" share features with the words they stand for).'''
+    words = _WORD.findall(review.lower())
+    found = [f"w {word}" for word in words]
+    found += [f"b {first} {second}" for first, second in zip(words, words[1:])]
+    for word in words:
+        padded = f"<{word}>"
+        found += [f"c {padded[i:i + 3]}" for i in range(len(padded) - 2)]
+    return found
+
+def features(reviews: list[str], dimensions: int = DIMENSIONS) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''Reviews as a sparse matrix in CSR form: (indptr, indices, values), one row per review. Terms are hashed with CRC-32, which, unlike hash(), is the same in every process, and each row is scaled to unit length so that long reviews do not get more extreme scores.'''
+    indptr = np.zeros(len(reviews) + 1, dtype=np.int64)
+    indices: list[int] = []
+    values: list[float] = []
+    for row, review in enumerate(reviews):
+        found = terms(review)
+        indices += [zlib.crc32(term.encode("utf-8")) % dimensions for term in found]
+        if len(found) > 0:
+            values += [1 / math.sqrt(len(found))] * len(found)
+        indptr[row + 1] = len(indices)
+    return indptr, np.array(indices, dtype=np.int64), np.array(values, dtype=np.float32)
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+class LinearClassifier:
+    '''Multinomial logistic regression over hashed features (see features()). Weights are read-only once trained, so one instance can be shared by every thread.'''
+    def __init__(self, weights: np.ndarray, bias: np.ndarray, classes: list[str]):
+        self.weights = weights
+        self.bias = bias
+        self.classes = classes
+
+    def logits(self, indptr: np.ndarray, indices: np.ndarray, values: np.ndarray) -> np.ndarray:
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        logits = np.tile(self.bias, (len(indptr) - 1, 1))
+        for c in range(len(self.classes)):
+            logits[:, c] += np.bincount(rows, weights=self.weights[indices, c] * values, minlength=len(indptr) - 1)
+        return logits
+
+    def predict(self, reviews: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        '''Each review's most likely class (an object array) and its probability. Reviews without a single word get a probability of 0, so that they are never taken on trust.'''
+        if len(reviews) == 0:
+            return np.empty(0, dtype=object), np.empty(0)
+        indptr, indices, values = features(reviews, len(self.weights))
+        probabilities = softmax(self.logits(indptr, indices, values))
+        confidence = probabilities.max(axis=1)
+        confidence[np.diff(indptr) == 0] = 0
+        return np.array(self.classes, dtype=object)[probabilities.argmax(axis=1)], confidence
+
+    def save(self, path: str | Path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "wb") as file:
+            np.savez_compressed(file, weights=self.weights, bias=self.bias, classes=np.array(self.classes))
+
+    @staticmethod
+    def load(path: str | Path) -> "LinearClassifier":
+        with np.load(path) as saved:
+            return LinearClassifier(saved["weights"], saved["bias"], saved["classes"].tolist())
+
+    @staticmethod
+    def train(reviews: list[str], labels: list[str], classes: list[str], dimensions: int = DIMENSIONS, epochs: int = 8, batchSize: int = 2048, learningRate: float = 0.02, l2: float = 1e-6, seed: int = 0) -> "LinearClassifier":
+        '''Fit weights to labels (each one of classes) by minimising cross-entropy with Adam, on mini-batches of consecutive rows of one random shuffle of the reviews.'''
+        order = np.random.default_rng(seed).permutation(len(reviews))
+        indptr, indices, values = features([reviews[i] for i in order], dimensions)
+        targets = np.eye(len(classes))[[classes.index(labels[i]) for i in order]]
+        priors = targets.mean(axis=0) + 1e-6
+        model = LinearClassifier(np.zeros((dimensions, len(classes))), np.log(priors / priors.sum()), classes)
+        moments = [[np.zeros_like(model.weights), np.zeros_like(model.weights)], [np.zeros_like(model.bias), np.zeros_like(model.bias)]]
+        step = 0
+        for _ in range(epochs):
+            for start in range(0, len(reviews), batchSize):
+                end = min(start + batchSize, len(reviews))
+                batchIndptr = indptr[start:end + 1] - indptr[start]
+                batchIndices = indices[indptr[start]:indptr[end]]
+                batchValues = values[indptr[start]:indptr[end]]
+                errors = (softmax(model.logits(batchIndptr, batchIndices, batchValues)) - targets[start:end]) / (end - start)
+                rows = np.repeat(np.arange(end - start), np.diff(batchIndptr))
+                weightGradient = np.stack([np.bincount(batchIndices, weights=batchValues * errors[rows, c], minlength=dimensions) for c in range(len(classes))], axis=1) + l2 * model.weights
+                step += 1
+                for parameter, gradient, (mean, square) in zip([model.weights, model.bias], [weightGradient, errors.sum(axis=0)], moments):
+                    mean *= 0.9
+                    mean += 0.1 * gradient
+                    square *= 0.999
+                    square += 0.001 * gradient ** 2
+                    parameter -= learningRate * (mean / (1 - 0.9 ** step)) / (np.sqrt(square / (1 - 0.999 ** step)) + 1e-8)
+        model.weights = model.weights.astype(np.float32)
+        return model
+
+_lock = threading.Lock()
+_loaded: tuple[str, int, LinearClassifier] | None = None
+
+def getClassifier() -> LinearClassifier:
+    '''The classifier in settings.cascadeModel, loaded once per process and again if the file changes. Raises FileNotFoundError if it has not been trained yet.'''
+    global _loaded
+    path = settings.cascadeModel
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No cascade classifier at {path}. Train one with python -m src.cascade train, or set SENTIMENT_CASCADE=false.")
+    modified = os.stat(path).st_mtime_ns
+    with _lock:
+        if _loaded is None or _loaded[:2] != (path, modified):
+            _loaded = (path, modified, LinearClassifier.load(path))
+            log.info("Cascade classifier loaded", path=path)
+        return _loaded[2]
+
+def cascadeId() -> str | None:
+    '''What decides the cascade's results (the classifier file and the threshold), for telling results apart, or None if the cascade is off.'''
+    if not settings.cascade:
+        return None
+    stat = os.stat(settings.cascadeModel) if os.path.exists(settings.cascadeModel) else None
+    return f"{settings.cascadeModel}:{None if stat is None else stat.st_mtime_ns}@{settings.cascadeThreshold}"
+
+def firstPass(reviews: list[str], threshold: float | None = None) -> tuple[np.ndarray, np.ndarray]:
+    '''Sentiments of reviews from the classifier, and a mask of those it is at least threshold (settings.cascadeThreshold by default) sure of. The rest should go to the transformer.'''
+    threshold = settings.cascadeThreshold if threshold is None else threshold
+    sentiments, confidence = getClassifier().predict(reviews)
+    return sentiments, confidence >= threshold
+
+def trainFromCsv(path: Path, infer: bool, prodName: str, revName: str, out: str, exclude: Path | None = None, maxRows: int | None = None, holdout: float = 0.1, seed: int = 0) -> dict[str, Any]:
+    '''Label the distinct reviews of a CSV with the transformer (through src.inference.classify, so the sentiment cache is used), train a classifier on them and save it to out. <br />
+    Reviews also found in exclude are left out, so that it can be evaluated on them fairly. A holdout fraction of the reviews is kept back to report how often the classifier agrees with the transformer, overall and on the reviews it is confident about. Returns those figures.'''
+    from src.process import readCsv
+    from src.inference import classify, SENTIMENTS
+    settings.cascade = False
+    readData, prodName, revName = readCsv(path, infer, prodName, revName)
+    reviews = readData[revName].dropna().unique().tolist()
+    del readData
+    if exclude is not None:
+        excluded, _, excludeName = readCsv(exclude, infer, prodName, revName)
+        reviews = list(set(reviews) - set(excluded[excludeName].dropna().tolist()))
+        reviews.sort()
+    rng = np.random.default_rng(seed)
+    if maxRows is not None and len(reviews) > maxRows:
+        reviews = [reviews[i] for i in rng.choice(len(reviews), maxRows, replace=False)]
+    log.info("Labelling reviews with the transformer", reviews=len(reviews))
+    labels = classify(reviews)
+    labelled = [(review, label) for review, label in zip(reviews, labels) if label is not None]
+    order = rng.permutation(len(labelled))
+    split = int(len(labelled) * holdout)
+    test = [labelled[i] for i in order[:split]]
+    train = [labelled[i] for i in order[split:]]
+    log.info("Training", reviews=len(train), heldOut=len(test))
+    model = LinearClassifier.train([review for review, _ in train], [label for _, label in train], list(SENTIMENTS))
+    model.save(out)
+    report: dict[str, Any] = {"trained": len(train), "heldOut": len(test), "out": out}
+    if len(test) > 0:
+        predicted, confidence = model.predict([review for review, _ in test])
+        expected = np.array([label for _, label in test], dtype=object)
+        confident = confidence >= settings.cascadeThreshold
+        report["agreement"] = float((predicted == expected).mean())
+        report["confident"] = float(confident.mean())
+        report["confidentAgreement"] = float((predicted[confident] == expected[confident]).mean()) if confident.any() else None
+    return report
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m src.cascade", description="Train the cascade's first-pass classifier.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    trainer = commands.add_parser("train", help="Train on the reviews of a CSV, labelled by the transformer.")
+    trainer.add_argument("input", type=Path, help="CSV of reviews to learn from. The more the better; testing/dataset.csv has 205,000.")
+    trainer.add_argument("--product", default=None, help="Name of the product column. Inferred with --review from the header if neither is given.")
+    trainer.add_argument("--review", default=None, help="Name of the review column.")
+    trainer.add_argument("--exclude", type=Path, default=None, help="CSV (with the same columns) whose reviews are left out, e.g. testing/testData.csv to evaluate on it.")
+    trainer.add_argument("--max-rows", type=int, default=None, help="Train on at most this many distinct reviews, picked at random.")
+    trainer.add_argument("--out", default=settings.cascadeModel, help=f"Where to save the classifier (default {settings.cascadeModel}).")
+    args = parser.parse_args(argv)
+    if (args.product is None) != (args.review is None):
+        parser.error("--product and --review must be given together.")
+    from src.logs import setup, shutdown
+    setup()
+    try:
+        report = trainFromCsv(args.input, args.product is None, args.product or "", args.review or "", args.out, args.exclude, args.max_rows)
+        log.info("Cascade classifier trained", **report)
+        return 0
+    finally:
+        shutdown()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+'''
+Server-side settings. Every field can be overridden by an environment variable of the same name prefixed with SENTIMENT_ (case-insensitive), e.g. SENTIMENT_BATCHSIZE=64.
+'''
+
+import os
+import tempfile
+import pydantic_settings as pds
+from typing import Literal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class Settings(pds.BaseSettings):
+    model_config = pds.SettingsConfigDict(env_prefix="SENTIMENT_")
+
+    batchSize: int = 32
+    '''How many reviews are sent through the model in one forward pass.'''
+    lengthKey: Literal["tokens", "chars", "none"] = "tokens"
+    '''How reviews are ordered before batching, so that each batch holds reviews of similar length and pads as little as possible. "tokens" sorts by tokenised length, "chars" by string length (cheaper, less exact), "none" keeps input order.'''
+    backend: Literal["transformers", "onnx", "onnx-int8"] = "transformers"
+    '''How the model is run (see src.backends). The ONNX backends need onnxruntime and an export in onnxDir; "onnx-int8" trades a little accuracy for speed.'''
+    onnxDir: str = os.path.join(ROOT, "models", "onnx")
+    '''Directory written by python -m src.backends export, read by the ONNX backends.'''
+    warmUpRows: int = 32
+    '''How many made-up reviews each worker classifies after loading the model at startup, so the first real request does not pay for first-call overheads. 0 only loads the model.'''
+    maxTokens: int = 512
+    '''Longest a review may be, in model tokens (including the model's special tokens), so that no batch costs more than batchSize * maxTokens however long its reviews are. The model cannot take more than 512.'''
+    longReviews: Literal["truncate", "headTail", "window"] = "truncate"
+    '''What happens to reviews longer than maxTokens: "truncate" keeps their start, "headTail" keeps their first quarter and last three quarters of the budget (the conclusion of a long review is often in its last lines), "window" classifies overlapping windows of maxTokens tokens and averages their scores. Windows cost one model input each.'''
+    csvEngine: Literal["auto", "pyarrow", "c"] = "auto"
+    '''Parser for whole uploads. "pyarrow" is multithreaded and much faster on large files, and pyarrow is in requirements.txt; "auto" uses it if it is installed (the server warns at startup if it is not), and "c" always uses pandas' parser. Streamed uploads are always parsed by pandas, which can stop after each chunk.'''
+    microBatch: bool = False
+    '''Whether reviews from every job running at once in a process share batches (see src.inference.Batcher), so several small uploads fill one forward pass. Only jobs in the same process are merged, so it matters with workerMode "thread", where the workers then share one copy of the model.'''
+    batchWaitMs: float = 10
+    '''With microBatch, how long (in milliseconds) a partly filled batch waits for more reviews before running anyway. Longer fills batches better; shorter answers small uploads sooner.'''
+    cascade: bool = False
+    '''Whether reviews first go through a fast linear classifier (see src.cascade), and only those it is less than cascadeThreshold sure of go through the transformer. Needs a classifier trained with python -m src.cascade train.'''
+    cascadeThreshold: float = 0.9
+    '''How sure (0-1) the cascade's classifier must be of a review's sentiment to settle it without the transformer. Higher sends more reviews to the transformer and agrees with it more often.'''
+    cascadeModel: str = os.path.join(ROOT, "models", "cascade.npz")
+    '''Where the cascade's classifier is saved and loaded.'''
+    chunkRows: int = 2000
+    '''How many rows are parsed and classified at a time when results are streamed back to the client.'''
+    bulkShardRows: int = 20_000
+    '''How many rows of a CSV python -m src.bulk hands to a worker at a time (see src.bulk). Progress is checkpointed once per shard, so an interrupted run loses at most the shards being scored.'''
+    workers: int = 2
+    '''How many analysis jobs run at once. Each worker loads its own copy of the model.'''
+    workerMode: Literal["thread", "process", "broker"] = "thread"
+    '''Whether each worker is a thread in the server process, a separate process, or a process taking jobs from a broker (see src.broker), which may run on another machine. Processes avoid the GIL on the non-model parts of a job, at the cost of a slower start.'''
+    modelThreads: int = 0
+    '''Threads each worker's model uses for a forward pass. 0 leaves it to torch or ONNX Runtime, which use every core. With several worker processes, 1 or 2 each stops them fighting over cores, so throughput grows with the number of workers.'''
+    brokerAddress: str = "unix:" + os.path.join(tempfile.gettempdir(), "sentiment-broker.sock")
+    '''Where the broker listens when workerMode is "broker": "unix:<path>" for a Unix socket, or "<host>:<port>" to accept workers from other machines.'''
+    brokerKey: str = "sentiment"
+    '''Shared secret workers and servers authenticate to the broker with. Jobs are pickled, so anyone with it can run code on the broker and its workers: the default is refused on a "<host>:<port>" address, so it must be changed there.'''
+    brokerStart: bool = True
+    '''Whether the server starts the broker and as many local workers as the workers setting itself. If false, it connects to a broker started with python -m src.broker serve, and workers are started separately with python -m src.broker work.'''
+    maxQueuedJobs: int = 16
+    '''How many jobs may wait for a worker before new uploads are rejected.'''
+    maxJobsPerClient: int = 4
+    '''How many jobs a single client may have waiting at once.'''
+    memoryBudget: int = 0
+    '''Bytes the analyses running at once may take between them, on top of what the workers take to hold the model, as estimated from each upload's size and rows (see src.process.estimateMemory). Jobs wait in the queue until their estimate fits, and uploads whose estimate could never fit are rejected with a 413. 0 means a quarter of the machine's physical memory, or of the container's memory limit (cgroup) if that is lower.'''
+    maxUploadBytes: int = 512 * 1024 * 1024
+    '''Largest CSV accepted by /upload, in bytes.'''
+    uploadDir: str = tempfile.gettempdir()
+    '''Where /upload stores CSVs while they are being analysed.'''
+    pingInterval: float = 60
+    '''Seconds between liveness pings to each websocket client. A client that has not answered a ping by its next check is disconnected. Checks are spread out, not done for every client at once.'''
+    sendTimeout: float = 10
+    '''Seconds a websocket send may go without the client reading any of it before the client is considered stuck and disconnected. Sends that keep draining, such as a large result to a slow client, may take as long as they need.'''
+    wsCompressionLevel: int = 1
+    '''zlib level (1-9) for permessage-deflate on the websocket. 0 turns compression off. Frames are compressed on the event loop as they are sent, so higher levels hold up every other client while a large result goes out, for little gain: on a 22 MiB full result, level 1 takes about half the time of level 6 and compresses to 26% rather than 23%.'''
+    wsWindowBits: int = 12
+    '''zlib window size (9-15) for permessage-deflate. Larger compresses repetitive results better but costs memory per connection.'''
+    cacheEnabled: bool = True
+    '''Whether sentiments are cached by review text (see src.cache).'''
+    cachePath: str = os.path.join(ROOT, "cache", "sentiments.db")
+    '''SQLite file holding the persistent cache.'''
+    cacheMemoryEntries: int = 100_000
+    '''How many entries each process keeps in its in-memory LRU in front of the file.'''
+    cacheMaxEntries: int = 5_000_000
+    '''How many entries the file may hold before the least recently used ones are evicted.'''
+    resultTtl: float = 3600
+    '''How long finished results are kept, in seconds, for clients to fetch again by job ID and for identical uploads to reuse (see src.results).'''
+    resultMaxBytes: int = 256 * 1024 * 1024
+    '''How much finished results may take up before the least recently used ones are dropped early.'''
+    replayMaxBytes: int = 16 * 1024 * 1024
+    '''How much of a running streamed job's partial results is kept, so that clients that join it late (e.g. after reconnecting) can be sent them. Past this, they are dropped, and such clients are asked to upload the file again. In counts mode only a running total is kept, which rarely gets near it.'''
+    profileRate: float = 0.0
+    '''Fraction of jobs (0-1) run under cProfile. For each of them, the profile and a JSON breakdown of where the job's time went are written to profileDir.'''
+    profileDir: str = os.path.join(ROOT, "profiles")
+    '''Where profiled jobs are written (see profileRate).'''
+    logLevel: str = "INFO"
+    '''Lowest level logged (DEBUG, INFO, WARNING, ERROR). Every websocket message is logged at DEBUG.'''
+    logFormat: Literal["text", "json"] = "text"
+    '''"text" for human-readable lines, "json" for one JSON object per line.'''
+    logPayloadChars: int = 200
+    '''How much of a message is included when it is logged. The rest is only counted.'''
+    logQueueSize: int = 10_000
+    '''How many records may wait for the logging thread before new ones are dropped.'''
+    logPingInterval: float = 300
+    '''Callback ping traffic is logged at most once per this many seconds, with a count of what was left out.'''
+
+settings = Settings()
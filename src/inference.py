@@ -0,0 +1,405 @@
+'''
+Model inference. All reviews of a request go through classify() together, so the model sees a few well-filled batches instead of one small call per product. With settings.microBatch, the reviews of requests running at the same time also share batches (see Batcher).
+'''
+
+import time
+import threading
+import collections as col
+import numpy as np
+import pandas as pd
+from typing import Any, Literal
+from src.config import settings
+from src.cache import getCache, key
+from src.logs import getLogger
+from src.metrics import stage, Timings
+from src.backends import Backend, backendId, loadBackend, importLibraries
+from src.cascade import firstPass, getClassifier
+
+type Sentiment = Literal["p"] | Literal["n"] | Literal["e"]
+
+_local = threading.local()
+log = getLogger(__name__)
+
+def getBackend(name: str | None = None) -> Backend:
+    '''The backend (see src.backends) owned by the calling thread, by default the configured one, loaded on first use. Each worker (see src.jobs) therefore has its own copy, and none is loaded just by importing this module.'''
+    name = settings.backend if name is None else name
+    backends: dict[str, Backend] = _local.__dict__.setdefault("backends", {})
+    backend = backends.get(name)
+    if backend is None:
+        backend = loadBackend(name)
+        backends[name] = backend
+    return backend
+
+SENTIMENTS: list[Sentiment] = ["p", "n", "e"]
+
+LABELS: dict[str, Sentiment] = {
+    "Very Positive": "p",
+    "Positive": "p",
+    "Neutral": "e",
+    "Negative": "n",
+    "Very Negative": "n",
+}
+
+_LABEL_INDEX = pd.Index(list(LABELS))
+_LABEL_TABLE = np.array([*LABELS.values(), None], dtype=object) # Last entry catches get_indexer's -1
+
+def mapLabels(labels: list[str]) -> np.ndarray:
+    '''Map model labels to sentiments in one vectorised lookup. Unknown labels map to None.'''
+    return _LABEL_TABLE[_LABEL_INDEX.get_indexer(labels)]
+
+def lengths(reviews: list[str], lengthKey: str, backend: Backend) -> list[int]:
+    '''The sort key used to bucket reviews of similar length into the same batch.'''
+    match lengthKey:
+        case "tokens":
+            return [len(ids) for ids in backend.tokenizer(reviews)["input_ids"]]
+        case "chars":
+            return [len(review) for review in reviews]
+        case _:
+            return [0] * len(reviews)
+
+def addCount(timings: Timings | None, name: str, count: int):
+    if timings is not None and count > 0:
+        timings[name] = timings.get(name, 0) + count
+
+def tokenBudget(tokenizer: Any, maxTokens: int | None = None) -> int:
+    '''How many of a review's own tokens fit into settings.maxTokens, next to the model's special tokens.'''
+    return (settings.maxTokens if maxTokens is None else maxTokens) - tokenizer.num_special_tokens_to_add()
+
+def overBudget(reviews: list[str], tokenizer: Any, maxTokens: int | None = None) -> dict[int, list[int]]:
+    '''The token IDs of every review with more tokens than the budget (see tokenBudget()), by index. <br />
+    Only reviews with more characters than the budget has tokens are tokenised, since a review rarely has more tokens than characters.'''
+    budget = tokenBudget(tokenizer, maxTokens)
+    candidates = [i for i, review in enumerate(reviews) if len(review) > budget]
+    if len(candidates) == 0:
+        return {}
+    return {i: ids for i, ids in zip(candidates, tokenizer([reviews[i] for i in candidates], add_special_tokens=False)["input_ids"]) if len(ids) > budget}
+
+def countTruncated(reviews: list[str], tokenizer: Any, timings: Timings | None):
+    '''Add how many of reviews are over the token budget to timings["truncated"], counting every repeat of a review, and whether or not it goes through the model. Each distinct long review is tokenised once.'''
+    if timings is None:
+        return
+    budget = tokenBudget(tokenizer)
+    candidates = col.Counter(review for review in reviews if len(review) > budget)
+    if len(candidates) == 0:
+        return
+    distinct = list(candidates)
+    addCount(timings, "truncated", sum(candidates[distinct[i]] for i in overBudget(distinct, tokenizer)))
+
+def fit(reviews: list[str], tokenizer: Any, maxTokens: int | None = None, longReviews: str | None = None) -> tuple[list[str], np.ndarray | None]:
+    '''Fit reviews into the model's token budget (settings.maxTokens, handled as settings.longReviews says). <br />
+    Returns the texts to classify and which review each text belongs to (None when each text is simply its review, in order). <br />
+    Anything overBudget() lets through is cut short by the backend.'''
+    longReviews = settings.longReviews if longReviews is None else longReviews
+    if longReviews == "truncate":
+        return reviews, None
+    budget = tokenBudget(tokenizer, maxTokens)
+    tooLong = overBudget(reviews, tokenizer, maxTokens)
+    if len(tooLong) == 0:
+        return reviews, None
+    if longReviews == "headTail":
+        head = budget // 4
+        texts = list(reviews)
+        for i, ids in tooLong.items():
+            texts[i] = f"{tokenizer.decode(ids[:head])} {tokenizer.decode(ids[head - budget:])}"
+        return texts, None
+    stride = max(1, budget // 2)
+    texts = []
+    owners: list[int] = []
+    for i, review in enumerate(reviews):
+        ids = tooLong.get(i)
+        if ids is None:
+            texts.append(review)
+            owners.append(i)
+            continue
+        for start in dict.fromkeys(min(start, len(ids) - budget) for start in range(0, len(ids) - budget + stride, stride)):
+            texts.append(tokenizer.decode(ids[start:start + budget]))
+            owners.append(i)
+    return texts, np.array(owners)
+
+def aggregate(scores: np.ndarray, owners: np.ndarray, count: int, labelNames: list[str]) -> list[str]:
+    '''The label of each of count reviews with the highest average score over that review's texts (see fit()).'''
+    totals = np.zeros((count, scores.shape[1]))
+    np.add.at(totals, owners, scores)
+    return [labelNames[i] for i in totals.argmax(axis=-1)]
+
+class _Request:
+    '''One predict() call's reviews, as seen by the Batcher.'''
+    def __init__(self, reviews: list[str], lengthKey: str):
+        self.reviews = reviews
+        self.lengthKey = lengthKey
+        self.texts: list[str] = reviews
+        '''What is actually classified (see fit()). Worked out by the batcher's thread, which owns the tokenizer, along with owners and order.'''
+        self.owners: np.ndarray | None = None
+        self.order: list[int] | None = None
+        '''Indices of texts, shortest first.'''
+        self.next: int = 0
+        '''How many texts (in order) have been put in a batch so far.'''
+        self.remaining: int = len(reviews)
+        self.labels: list[str] = [""] * len(reviews)
+        self.scores: np.ndarray | None = None
+        '''Scores of each text, if any review was split into windows.'''
+        self.submitted: float = time.perf_counter()
+        self.started: float | None = None
+        self.done = threading.Event()
+        self.error: Exception | None = None
+
+class Batcher:
+    '''Runs the reviews of every predict() call made at once in this process through one backend, in shared batches, so that several small requests fill one forward pass instead of each running its own half-empty ones. <br />
+    A batch is run as soon as batchSize reviews are waiting, or once the longest-waiting request has waited maxWait seconds, whichever comes first. Batches are filled round-robin across waiting requests, so a small request gets into the next batch even while a large one is being worked through. <br />
+    The backend lives on the batcher's own thread, so with workerMode "thread" the workers share one copy of the model. Requests are only merged within a process.'''
+    def __init__(self, batchSize: int | None = None, maxWait: float | None = None, backendName: str | None = None):
+        self.batchSize = settings.batchSize if batchSize is None else batchSize
+        self.maxWait = settings.batchWaitMs / 1000 if maxWait is None else maxWait
+        self.backendName = backendName
+        self.backend: Backend | None = None
+        self.pending: col.deque[_Request] = col.deque()
+        self.loaded = threading.Event()
+        '''Set once the backend has loaded, or failed to (see error).'''
+        self.error: Exception | None = None
+        self._waiting: int = 0
+        '''Texts of pending requests not yet put in a batch.'''
+        self._changed = threading.Condition()
+        threading.Thread(target=self._run, name="batcher", daemon=True).start()
+
+    def labels(self, reviews: list[str], lengthKey: str, timings: Timings | None = None) -> list[str]:
+        '''Model labels for reviews, in input order. Blocks until every review has been through the model. <br />
+        If a timings dict is given, "batchWait" gets the time until the first of these reviews went into a batch, and "forward" the time from then until the last came out.'''
+        if len(reviews) == 0:
+            return []
+        request = _Request(reviews, lengthKey)
+        with self._changed:
+            self.pending.append(request)
+            self._waiting += len(reviews)
+            self._changed.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        if timings is not None and request.started is not None:
+            timings["batchWait"] = timings.get("batchWait", 0.0) + request.started - request.submitted
+            timings["forward"] = timings.get("forward", 0.0) + time.perf_counter() - request.started
+        return request.labels
+
+    def _run(self):
+        try:
+            self.backend = getBackend(self.backendName)
+        except Exception as e:
+            log.exception("Batcher could not load the model")
+            self.error = e
+        self.loaded.set()
+        while True:
+            with self._changed:
+                while len(self.pending) == 0:
+                    self._changed.wait()
+                deadline = self.pending[0].submitted + self.maxWait
+                while self._waiting < self.batchSize and (left := deadline - time.perf_counter()) > 0:
+                    self._changed.wait(left)
+                requests = list(self.pending)
+            if self.error is not None:
+                self._fail(requests, self.error)
+                continue
+            try:
+                self._batch(requests)
+            except Exception as e:
+                log.exception("Batcher failed", requests=len(requests))
+                self._fail(requests, e)
+
+    def _prepare(self, request: _Request):
+        '''Fit a new request's reviews into the token budget and sort them by length.'''
+        assert self.backend is not None
+        request.texts, request.owners = fit(request.reviews, self.backend.tokenizer)
+        if request.owners is not None:
+            request.scores = np.empty((len(request.texts), len(self.backend.labelNames)))
+            request.remaining = len(request.texts)
+            with self._changed:
+                self._waiting += len(request.texts) - len(request.reviews)
+        keys = lengths(request.texts, request.lengthKey, self.backend)
+        request.order = sorted(range(len(request.texts)), key=keys.__getitem__)
+
+    def _batch(self, requests: list[_Request]):
+        '''Take up to batchSize texts round-robin from requests, run them and hand each its labels.'''
+        assert self.backend is not None
+        for request in requests:
+            if request.order is None:
+                self._prepare(request)
+        taken: list[tuple[_Request, int]] = []
+        active = [request for request in requests if request.next < len(request.texts)]
+        while len(taken) < self.batchSize and len(active) > 0:
+            for request in active:
+                if len(taken) == self.batchSize:
+                    break
+                taken.append((request, request.order[request.next])) # type: ignore
+                request.next += 1
+            active = [request for request in active if request.next < len(request.texts)]
+        start = time.perf_counter()
+        for request in {request for request, _ in taken}:
+            if request.started is None:
+                request.started = start
+        with self._changed:
+            self._waiting -= len(taken)
+        texts = [request.texts[i] for request, i in taken]
+        try:
+            if any(request.scores is not None for request, _ in taken):
+                scores = self.backend.scores(texts, len(taken))
+                labels = [self.backend.labelNames[i] for i in scores.argmax(axis=-1)]
+            else:
+                scores = None
+                labels = self.backend.labels(texts, len(taken))
+        except Exception as e:
+            log.exception("Batch failed", reviews=len(taken))
+            self._fail(list({request for request, _ in taken}), e)
+            return
+        finished: list[_Request] = []
+        for row, ((request, i), label) in enumerate(zip(taken, labels)):
+            if request.scores is not None:
+                request.scores[i] = scores[row] # type: ignore
+            else:
+                request.labels[i] = label
+            request.remaining -= 1
+            if request.remaining == 0:
+                if request.scores is not None:
+                    request.labels = aggregate(request.scores, request.owners, len(request.reviews), self.backend.labelNames) # type: ignore
+                finished.append(request)
+        self._finish(finished)
+
+    def _fail(self, requests: list[_Request], error: Exception):
+        for request in requests:
+            request.error = error
+        with self._changed:
+            self._waiting -= sum(len(request.texts) - request.next for request in requests)
+            for request in requests:
+                request.next = len(request.texts)
+        self._finish(requests)
+
+    def _finish(self, requests: list[_Request]):
+        with self._changed:
+            for request in requests:
+                if request in self.pending:
+                    self.pending.remove(request)
+        for request in requests:
+            request.done.set()
+
+_batcher: Batcher | None = None
+_batcherLock = threading.Lock()
+
+def getBatcher() -> Batcher:
+    '''The process's Batcher, started on first use.'''
+    global _batcher
+    with _batcherLock:
+        if _batcher is None:
+            _batcher = Batcher()
+        return _batcher
+
+def predict(reviews: list[str], batchSize: int, lengthKey: str, backend: Backend | None = None, timings: Timings | None = None) -> list[Sentiment | None]:
+    '''Run reviews through the model and return their sentiments, in input order. <br />
+    Reviews are fitted into the token budget (see fit()), sorted by length and fed to the model in fixed-size batches, each padded only to its own longest review. None marks a label the model should never produce. <br />
+    With settings.microBatch and no backend given, the reviews go through the process's Batcher instead, sharing batches with every other request running at the time.'''
+    if len(reviews) == 0:
+        return []
+    if backend is None and settings.microBatch:
+        labels = getBatcher().labels(reviews, lengthKey, timings)
+        sentiments = mapLabels(labels)
+    else:
+        backend = getBackend() if backend is None else backend
+        with stage(timings, "tokenise"):
+            texts, owners = fit(reviews, backend.tokenizer)
+            keys = lengths(texts, lengthKey, backend)
+        order = sorted(range(len(texts)), key=keys.__getitem__) # Stable, so "none" keeps input order
+        if owners is None:
+            labels = backend.labels([texts[i] for i in order], batchSize, timings)
+            sentiments = np.empty(len(reviews), dtype=object)
+            sentiments[order] = mapLabels(labels)
+        else:
+            scores = np.empty((len(texts), len(backend.labelNames)))
+            scores[order] = backend.scores([texts[i] for i in order], batchSize, timings)
+            labels = aggregate(scores, owners, len(reviews), backend.labelNames)
+            sentiments = mapLabels(labels)
+    if None in sentiments:
+        log.warning("Unknown labels received from model", labels=sorted(set(labels) - set(LABELS)))
+    return sentiments.tolist()
+
+def cascade(reviews: list[str], batchSize: int, lengthKey: str, backend: Backend | None = None, timings: Timings | None = None) -> tuple[list[Sentiment | None], np.ndarray]:
+    '''Classify reviews with the cascade's first pass (see src.cascade), and put only those it is not sure enough of through predict(). Returns their sentiments, in input order, and a mask of those that came from the model. <br />
+    If a timings dict is given, "firstPass" gets the time spent in the first pass, and the counts "settled" and "escalated" how many reviews it decided and how many it left to the model.'''
+    with stage(timings, "firstPass"):
+        sentiments, settled = firstPass(reviews)
+    escalated = np.flatnonzero(~settled)
+    addCount(timings, "settled", len(reviews) - len(escalated))
+    addCount(timings, "escalated", len(escalated))
+    if len(escalated) > 0:
+        sentiments[escalated] = np.array(predict([reviews[i] for i in escalated], batchSize, lengthKey, backend, timings), dtype=object)
+    return sentiments.tolist(), ~settled
+
+def getTokenizer(backend: Backend | None) -> Any:
+    '''The tokenizer of backend, or with settings.microBatch and no backend, of the process's Batcher.'''
+    if backend is not None:
+        return backend.tokenizer
+    batcher = getBatcher()
+    batcher.loaded.wait()
+    if batcher.backend is None:
+        raise batcher.error # type: ignore
+    return batcher.backend.tokenizer
+
+def classify(reviews: list[str], batchSize: int | None = None, lengthKey: str | None = None, timings: Timings | None = None) -> list[Sentiment | None]:
+    '''Classify a flat list of reviews and return their sentiments, in input order. <br />
+    Repeated reviews are only classified once, and reviews found in the sentiment cache (see src.cache) are not classified at all. The rest go through predict(), or with settings.cascade through cascade(). Only the model's sentiments are cached, never the first pass's. <br />
+    If a timings dict is given, the time spent on the cache, tokenisation and the model's forward passes is added to it (see src.metrics.Timings), and "truncated" gets how many of the reviews are over the token budget: all of them, however they were classified.'''
+    batchSize = settings.batchSize if batchSize is None else batchSize
+    lengthKey = settings.lengthKey if lengthKey is None else lengthKey
+    backend = None if settings.microBatch else getBackend()
+    with stage(timings, "tokenise"):
+        countTruncated(reviews, getTokenizer(backend), timings)
+    cache = getCache()
+    if cache is None:
+        if settings.cascade:
+            return cascade(reviews, batchSize, lengthKey, backend, timings)[0]
+        return predict(reviews, batchSize, lengthKey, backend, timings)
+    keys = [key(review, backendId()) for review in reviews]
+    unique: dict[str, str] = {} # Key -> first review with that key
+    for k, review in zip(keys, reviews):
+        if k not in unique:
+            unique[k] = review
+    cache.countDeduplicated(len(reviews) - len(unique))
+    with stage(timings, "cache"):
+        known: dict[str, str] = cache.get(list(unique))
+    missing = [k for k in unique if k not in known]
+    if settings.cascade:
+        predicted, fromModel = cascade([unique[k] for k in missing], batchSize, lengthKey, backend, timings)
+    else:
+        predicted, fromModel = predict([unique[k] for k in missing], batchSize, lengthKey, backend, timings), np.ones(len(missing), dtype=bool)
+    fresh = {k: sentiment for k, sentiment in zip(missing, predicted) if sentiment is not None}
+    with stage(timings, "cache"):
+        cache.put({k: sentiment for k, sentiment, modelled in zip(missing, predicted, fromModel) if modelled and sentiment is not None})
+    known.update(fresh)
+    return [known.get(k) for k in keys] # type: ignore
+
+WARM_UP_REVIEWS = [
+    "Great product, arrived quickly and works perfectly.",
+    "Barang tidak sesuai dengan gambar, sangat kecewa.",
+    "It's okay, nothing special.",
+    "Kualiti bagus, penghantaran cepat. Terima kasih seller!",
+    "Stopped working after two days and the seller never replied to my messages about a refund.",
+]
+
+def warmUp(rows: int | None = None) -> dict[str, float]:
+    '''Get the calling thread ready to classify: import the model libraries, load its backend (and with settings.cascade the first-pass classifier, so that a missing one fails the warm-up) and put a batch of rows made-up reviews through it, bypassing the cache. Meant to be the first thing every worker runs (see src.jobs.JobQueue.start). <br />
+    Returns how long each step took, in seconds. In thread mode only the first worker pays for the import, and with settings.microBatch only the first pays for loading the shared backend.'''
+    rows = settings.warmUpRows if rows is None else rows
+    reviews = [WARM_UP_REVIEWS[i % len(WARM_UP_REVIEWS)] for i in range(rows)]
+    start = time.perf_counter()
+    importLibraries()
+    imported = time.perf_counter()
+    if settings.cascade:
+        getClassifier()
+    if settings.microBatch:
+        batcher = getBatcher()
+        batcher.loaded.wait()
+        if batcher.error is not None:
+            raise batcher.error
+        loaded = time.perf_counter()
+        batcher.labels(reviews, settings.lengthKey)
+    else:
+        backend = getBackend()
+        loaded = time.perf_counter()
+        predict(reviews, settings.batchSize, settings.lengthKey, backend)
+    done = time.perf_counter()
+    return {"importSeconds": imported - start, "loadSeconds": loaded - imported, "firstInferenceSeconds": done - loaded}
@@ -0,0 +1,347 @@
+'''
+Job queue feeding a pool of analysis workers, so that model inference never runs on the event loop.
+'''
+
+import os
+import time
+import uuid
+import asyncio
+import contextlib
+import collections as col
+import multiprocessing as mp
+import multiprocessing.managers as mpm
+import concurrent.futures as cf
+from typing import Any, Callable
+from src.config import settings
+from src.logs import getLogger
+from src.broker import BrokerClient
+
+log = getLogger(__name__)
+
+class QueueFull(Exception):
+    '''Raised by JobQueue.submit() when a job cannot be accepted right now. The message is meant for the client.'''
+
+class OverBudget(QueueFull):
+    '''Raised by JobQueue.submit() when a job would need more memory than the whole budget, so it could never be run. The message is meant for the client.'''
+
+def physicalMemory() -> int | None:
+    '''Bytes of physical memory on this machine, or None where it cannot be told.'''
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+CGROUP_LIMITS = ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]
+'''Where cgroups v2 and v1 keep the memory limit of the container this runs in.'''
+
+def cgroupMemory() -> int | None:
+    '''Bytes this process's container may use (its cgroup memory limit), or None if it has none. cgroups v1 reports no limit as a huge number, which memoryLimit() sees past.'''
+    for path in CGROUP_LIMITS:
+        try:
+            with open(path) as file:
+                value = file.read().strip()
+        except OSError:
+            continue
+        return None if value == "max" else int(value)
+    return None
+
+def memoryLimit() -> int | None:
+    '''Bytes of memory this process can have: the lower of physical memory and its container's limit, or None where neither can be told.'''
+    limits = [limit for limit in (physicalMemory(), cgroupMemory()) if limit is not None]
+    return min(limits) if len(limits) > 0 else None
+
+class Job:
+    def __init__(self, clientKey: str, fn: Callable[..., Any], args: tuple[Any, ...], onProgress: Callable[..., Any] | None = None, memory: int = 0):
+        self.id: str = str(uuid.uuid4())
+        self.clientKey = clientKey
+        self.fn = fn
+        self.args = args
+        self.onProgress = onProgress
+        self.memory = memory
+        '''Bytes the job is expected to need while it runs, reserved against JobQueue.memoryBudget.'''
+        self.future: asyncio.Future[Any] = asyncio.get_running_loop().create_future()
+        self.submitted: float = time.perf_counter()
+        self.started: float | None = None
+        '''When a worker picked the job up (time.perf_counter()), or None while it is still queued.'''
+
+class _LoopReporter:
+    '''Hands progress from a worker thread to a callback on the event loop.'''
+    def __init__(self, loop: asyncio.AbstractEventLoop, callback: Callable[..., Any]):
+        self.loop = loop
+        self.callback = callback
+
+    def __call__(self, *item: Any):
+        self.loop.call_soon_threadsafe(self.callback, *item)
+
+class _QueueReporter:
+    '''Hands progress from a worker process to the server process. Picklable, unlike _LoopReporter.'''
+    def __init__(self, queue: Any):
+        self.queue = queue
+
+    def __call__(self, *item: Any):
+        self.queue.put(item)
+
+class JobQueue:
+    '''A bounded queue of jobs served by a fixed number of workers. <br />
+    Each worker is a single-threaded executor (a thread or a process, see src.config.Settings.workerMode), so anything a worker caches per thread, such as its model pipeline, belongs to that worker alone. <br />
+    In "broker" mode the workers are processes attached to a broker (see src.broker) and may come and go: a job is handed to the broker whenever one of them is free, one at a time per worker, so scheduling stays here.
+
+    Clients are served round-robin: a client that uploads many files at once only gets one of them run before every other waiting client has had a turn. <br />
+    Jobs only start while their memory estimate fits in what is left of memoryBudget. The next job in turn waits until it does, and holds back the jobs behind it, so that a stream of small uploads cannot starve a large one.'''
+    def __init__(self, workers: int | None = None, mode: str | None = None, maxQueued: int | None = None, maxPerClient: int | None = None, memoryBudget: int | None = None):
+        self.workers = settings.workers if workers is None else workers
+        self.mode = settings.workerMode if mode is None else mode
+        self.maxQueued = settings.maxQueuedJobs if maxQueued is None else maxQueued
+        self.maxPerClient = settings.maxJobsPerClient if maxPerClient is None else maxPerClient
+        memoryBudget = settings.memoryBudget if memoryBudget is None else memoryBudget
+        if memoryBudget <= 0:
+            total = memoryLimit()
+            memoryBudget = None if total is None else total // 4
+        self.memoryBudget: int | None = memoryBudget
+        '''Bytes the running jobs may reserve between them (see Job.memory), or None for no limit.'''
+        self.reserved: int = 0
+        '''Bytes reserved by the jobs running now.'''
+        self.pending: dict[str, col.deque[Job]] = {}
+        self.turns: col.deque[str] = col.deque()
+        self.queued: int = 0
+        self.running: int = 0
+        self.executors: list[cf.Executor] = []
+        self._tasks: list[asyncio.Task] = []
+        self._ready: asyncio.Condition
+        self._manager: asyncio.Future[mpm.SyncManager] | None = None
+        '''In process mode, the manager whose queues carry progress back from worker processes, started off the event loop by start().'''
+        self.started: bool = False
+        self._warmUp: Callable[[], Any] | None = None
+        self.warmUps: list[dict[str, Any]] = []
+        '''What each worker's warm-up returned, in the order they finished.'''
+        self.warmUpErrors: list[str] = []
+        self.broker: BrokerClient | None = None
+        self.slots: int = 0
+        '''In broker mode, how many worker loops hand jobs to the broker, so how many jobs may be with it at once: one per attached broker worker.'''
+        self._retiring: int = 0
+        '''In broker mode, how many worker loops should stop, as workers have detached, before taking another job.'''
+
+    def start(self, warmUp: Callable[[], Any] | None = None):
+        '''Spin up the workers. Idempotent. Must be called from within the event loop. <br />
+        If warmUp is given, every worker runs it (on its own thread or process) before taking any job, e.g. to load the model. Progress is reported by status().'''
+        if self.started:
+            return
+        self.started = True
+        self._warmUp = warmUp
+        self._ready = asyncio.Condition()
+        if self.mode == "broker":
+            self.broker = BrokerClient(self.workers if settings.brokerStart else 0)
+            self._tasks.append(asyncio.create_task(self._watchBroker()))
+            return
+        if self.mode == "process":
+            self._manager = asyncio.ensure_future(asyncio.to_thread(mp.get_context("spawn").Manager))
+        for i in range(self.workers):
+            if self.mode == "process":
+                executor: cf.Executor = cf.ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn"))
+            else:
+                executor = cf.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"worker-{i}")
+            self.executors.append(executor)
+            self._tasks.append(asyncio.create_task(self._work(executor)))
+
+    async def stop(self):
+        '''Stop the workers and fail any jobs still waiting. Idempotent.'''
+        if not self.started:
+            return
+        self.started = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        for queue in self.pending.values():
+            for job in queue:
+                job.future.cancel()
+        self.pending.clear()
+        self.turns.clear()
+        self.queued = 0
+        self.reserved = 0
+        for executor in self.executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self.executors.clear()
+        if self._manager is not None:
+            starting = self._manager
+            self._manager = None
+            with contextlib.suppress(Exception):
+                manager = await starting
+                await asyncio.to_thread(manager.shutdown)
+        if self.broker is not None:
+            self.broker.stop()
+            self.broker = None
+            self.slots = 0
+            self._retiring = 0
+            self.warmUps = []
+
+    def status(self) -> str:
+        '''"ready" once every worker has warmed up, "failed" if any warm-up raised, "warming up" before then, and "stopped" if the workers are not running. <br />
+        In broker mode workers come and go, so it is "ready" while any worker is attached, and "failed" only if none is and some failed.'''
+        if not self.started:
+            return "stopped"
+        if self.mode == "broker":
+            if len(self.warmUps) > 0:
+                return "ready"
+            return "failed" if len(self.warmUpErrors) > 0 else "warming up"
+        if len(self.warmUpErrors) > 0:
+            return "failed"
+        if self._warmUp is not None and len(self.warmUps) < self.workers:
+            return "warming up"
+        return "ready"
+
+    async def submit(self, clientKey: str, fn: Callable[..., Any], *args: Any, onProgress: Callable[..., Any] | None = None, memory: int = 0) -> tuple[Job, int]:
+        '''Queue fn(*args) to run on a worker on behalf of a client. Returns the job and its approximate position in the queue (0 = next to run). <br />
+        fn and args must be picklable if workers are processes. <br />
+        If onProgress is given, fn is called with one more argument: a function it can call from the worker with any (picklable) arguments, which are passed on to onProgress on the event loop, in order, before the job's future resolves. <br />
+        memory is how many bytes the job is expected to need while it runs. It is not started until that fits in the memory budget. <br />
+        Raises QueueFull if the queue or the client's share of it is full, and OverBudget if memory is more than the whole budget.'''
+        if self.memoryBudget is not None and memory > self.memoryBudget:
+            raise OverBudget(f"This file needs about {memory >> 20} MiB to analyse, more than the server can spare ({self.memoryBudget >> 20} MiB). Please split it into smaller files, or stream the results, which takes far less.")
+        if self.queued >= self.maxQueued:
+            raise QueueFull(f"Server is busy ({self.queued} jobs waiting). Please try again later.")
+        queue = self.pending.get(clientKey)
+        if queue is not None and len(queue) >= self.maxPerClient:
+            raise QueueFull(f"Too many uploads waiting ({len(queue)}). Please wait for them to finish.")
+        job = Job(clientKey, fn, args, onProgress, memory)
+        if queue is None:
+            queue = col.deque()
+            self.pending[clientKey] = queue
+            self.turns.append(clientKey)
+        queue.append(job)
+        self.queued += 1
+        position = self.position(job)
+        async with self._ready:
+            self._ready.notify()
+        return job, position
+
+    def position(self, job: Job) -> int:
+        '''How many queued jobs will be started before this one, under round-robin scheduling.'''
+        queue = self.pending.get(job.clientKey)
+        if queue is None or job not in queue:
+            return 0
+        ahead = queue.index(job)
+        position = ahead
+        for key in self.turns:
+            if key == job.clientKey:
+                continue
+            position += min(len(self.pending[key]), ahead + 1)
+        return position
+
+    def _next(self) -> Job | None:
+        '''Take the next job in round-robin order and reserve its memory, if there is one and its memory fits in the budget.'''
+        if len(self.turns) == 0:
+            return None
+        key = self.turns[0]
+        queue = self.pending[key]
+        if self.memoryBudget is not None and self.reserved + queue[0].memory > self.memoryBudget:
+            return None
+        self.turns.popleft()
+        job = queue.popleft()
+        self.reserved += job.memory
+        if len(queue) > 0:
+            self.turns.append(key)
+        else:
+            del self.pending[key]
+        self.queued -= 1
+        return job
+
+    async def _watchBroker(self):
+        '''Connect to the broker, then keep one worker loop per broker worker, adding loops as workers attach and retiring them as workers detach, so that jobs never pile up in the broker's own queue, out of round-robin order.'''
+        assert self.broker is not None
+        try:
+            await asyncio.to_thread(self.broker.connect)
+        except Exception as e:
+            log.error("Could not connect to the broker", address=settings.brokerAddress, error=f"{type(e).__name__}: {e}")
+            self.warmUpErrors.append(f"{type(e).__name__}: {e}")
+            return
+        self._tasks.append(asyncio.create_task(self.broker.relay()))
+        while True:
+            self.warmUps, self.warmUpErrors = await asyncio.to_thread(self.broker.workerStatus)
+            attached = len(self.warmUps)
+            while self.slots - self._retiring < attached:
+                if self._retiring > 0:
+                    self._retiring -= 1
+                else:
+                    self.slots += 1
+                    self._tasks.append(asyncio.create_task(self._work(None)))
+                log.info("Broker worker attached", slots=self.slots - self._retiring)
+            if self.slots - self._retiring > attached:
+                self._retiring = self.slots - attached
+                log.info("Broker worker detached", slots=attached)
+                async with self._ready:
+                    self._ready.notify_all()
+            self._tasks = [task for task in self._tasks if not task.done()]
+            await asyncio.sleep(1)
+
+    async def _work(self, executor: cf.Executor | None):
+        '''Worker loop: repeatedly take a job and run it on this worker's executor, or in broker mode (executor None) hand it to the broker, until it is retired (see _watchBroker()).'''
+        loop = asyncio.get_running_loop()
+        if self._warmUp is not None and executor is not None:
+            try:
+                timings = await loop.run_in_executor(executor, self._warmUp)
+                log.info("Worker warmed up", **timings)
+                self.warmUps.append(timings)
+            except Exception as e:
+                log.error("Worker failed to warm up", error=f"{type(e).__name__}: {e}")
+                self.warmUpErrors.append(f"{type(e).__name__}: {e}")
+        while True:
+            async with self._ready:
+                while True:
+                    if executor is None and self._retiring > 0:
+                        self._retiring -= 1
+                        self.slots -= 1
+                        return
+                    job = self._next()
+                    if job is not None:
+                        break
+                    await self._ready.wait()
+            if job.future.cancelled():
+                await self._release(job)
+                continue
+            self.running += 1
+            job.started = time.perf_counter()
+            try:
+                result = await self._run(loop, executor, job)
+                if not job.future.done():
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self.running -= 1
+                await self._release(job)
+
+    async def _release(self, job: Job):
+        '''Give back a job's memory reservation, and let any worker waiting for memory check the next job again.'''
+        self.reserved -= job.memory
+        if job.memory > 0:
+            async with self._ready:
+                self._ready.notify_all()
+
+    async def _run(self, loop: asyncio.AbstractEventLoop, executor: cf.Executor | None, job: Job) -> Any:
+        '''Run a job on an executor, or the broker if executor is None, relaying its progress if it reports any.'''
+        if executor is None:
+            assert self.broker is not None
+            return await self.broker.run(job.fn, job.args, job.onProgress)
+        if job.onProgress is None:
+            return await loop.run_in_executor(executor, job.fn, *job.args)
+        if self.mode != "process":
+            return await loop.run_in_executor(executor, job.fn, *job.args, _LoopReporter(loop, job.onProgress))
+        assert self._manager is not None
+        manager = await asyncio.shield(self._manager) # Shared by every job, so not cancelled with this one
+        queue = await asyncio.to_thread(manager.Queue)
+        relay = asyncio.create_task(self._relay(queue, job.onProgress))
+        try:
+            return await loop.run_in_executor(executor, job.fn, *job.args, _QueueReporter(queue))
+        finally:
+            await asyncio.to_thread(queue.put, None)
+            await relay
+
+    async def _relay(self, queue: Any, onProgress: Callable[..., Any]):
+        '''Pass progress reported from a worker process on to onProgress, until None arrives.'''
+        while (item := await asyncio.to_thread(queue.get)) is not None:
+            onProgress(*item)
@@ -0,0 +1,143 @@
+'''
+Logging. Records are handed to a background thread through a bounded queue, so the event loop never waits on stdout, and records are dropped rather than queued without limit if the output cannot keep up. <br />
+Payloads are never logged whole: log their size, and at most a truncated preview (see preview()), so logging costs the same however large a result is.
+
+Usage:
+
+    log = getLogger(__name__)
+    log.info("CSV received", clientKey=key, bytes=size)
+'''
+
+import sys
+import json
+import time
+import queue
+import logging
+import threading
+import logging.handlers as lh
+from typing import Any
+from src.config import settings
+
+ROOT_LOGGER = "sentiment"
+
+class Logger:
+    '''Wraps a logging.Logger so that structured fields can be passed as keyword arguments.'''
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+
+    def log(self, level: int, message: str, /, exc_info: Any = None, **fields: Any):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, message, exc_info=exc_info, extra={"fields": fields})
+
+    def debug(self, message: str, /, **fields: Any):
+        self.log(logging.DEBUG, message, **fields)
+
+    def info(self, message: str, /, **fields: Any):
+        self.log(logging.INFO, message, **fields)
+
+    def warning(self, message: str, /, **fields: Any):
+        self.log(logging.WARNING, message, **fields)
+
+    def error(self, message: str, /, **fields: Any):
+        self.log(logging.ERROR, message, **fields)
+
+    def exception(self, message: str, /, **fields: Any):
+        '''Log at error level together with the exception being handled.'''
+        self.log(logging.ERROR, message, exc_info=True, **fields)
+
+    def isEnabledFor(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level)
+
+def getLogger(name: str) -> Logger:
+    '''A logger under the application's root logger, which setup() configures.'''
+    return Logger(logging.getLogger(f"{ROOT_LOGGER}.{name.removeprefix("src.")}"))
+
+def preview(payload: str | bytes, limit: int | None = None) -> str:
+    '''The start of a payload, at most limit characters (settings.logPayloadChars by default), marked if cut short. Costs the same whatever the payload's size.'''
+    limit = settings.logPayloadChars if limit is None else limit
+    if isinstance(payload, bytes):
+        return payload[:limit].decode("utf-8", errors="replace") + ("" if len(payload) <= limit else "...")
+    return payload if len(payload) <= limit else f"{payload[:limit]}..."
+
+class RateLimit:
+    '''Lets through at most one event per key every interval seconds, e.g. for repetitive traffic like pings. allow() returns how many events were held back since the last one let through, or None to hold this one back.'''
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last: dict[str, float] = {}
+        self.held: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key: str) -> int | None:
+        now = time.monotonic()
+        with self._lock:
+            if now - self.last.get(key, -self.interval) < self.interval:
+                self.held[key] = self.held.get(key, 0) + 1
+                return None
+            self.last[key] = now
+            return self.held.pop(key, 0)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", {})
+        line = f"{self.formatTime(record)} {record.levelname} {record.name}: {record.getMessage()}"
+        if len(fields) > 0:
+            line += " " + " ".join(f"{key}={value!r}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class JsonFormatter(logging.Formatter):
+    '''One JSON object per line: time, level, logger, message, the record's fields, and exception if any.'''
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, Any] = {"time": record.created, "level": record.levelname, "logger": record.name, "message": record.getMessage(), **getattr(record, "fields", {})}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class DroppingQueueHandler(lh.QueueHandler):
+    '''A QueueHandler that drops records when its queue is full instead of blocking the caller.'''
+    def __init__(self, queue: queue.Queue):
+        super().__init__(queue)
+        self.dropped: int = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Leave formatting to the listener thread; only merge the message with its args, which may change before the thread gets to them
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+_listener: lh.QueueListener | None = None
+_handler: DroppingQueueHandler | None = None
+
+def setup():
+    '''Send the application's records (see getLogger()) to stderr, through a background thread, at the configured level and format. Idempotent.'''
+    global _listener, _handler
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if settings.logFormat == "json" else TextFormatter())
+    _handler = DroppingQueueHandler(queue.Queue(maxsize=settings.logQueueSize))
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(settings.logLevel.upper())
+    root.addHandler(_handler)
+    root.propagate = False
+    _listener = lh.QueueListener(_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+
+def shutdown():
+    '''Write out every record still queued and stop the background thread.'''
+    global _listener, _handler
+    if _listener is None:
+        return
+    _listener.stop()
+    logging.getLogger(ROOT_LOGGER).removeHandler(_handler) # type: ignore
+    if _handler is not None and _handler.dropped > 0:
+        print(f"{_handler.dropped} log records were dropped because logging could not keep up.", file=sys.stderr)
+    _listener = None
+    _handler = None
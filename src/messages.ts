@@ -10,6 +10,21 @@ export type SentimentAnalysisResult = {
     },
 }
 
+/**Result in "counts" mode: how many reviews of each product are of each sentiment.*/
+export type SentimentCounts = {
+    [index: string]: {"p": number, "n": number, "e": number}
+}
+
+/**Result in "columnar" mode: for each review in input order, the index of its product and its sentiment (one character each).*/
+export type SentimentColumns = {
+    products: string[]
+    index: number[]
+    sentiments: string
+    reviews?: string[]
+}
+
+export type ResultMode = "full" | "counts" | "columnar"
+
 export type SentimentAnalysisError = {
     error: string
     inferFailure: boolean
@@ -28,20 +43,77 @@ export class MsgImage {
     }
 }
 
-/**Contains the entirety of the file as a string, as well as header names.*/
+export const HEADER_INCOMING_RESULT = "incoming_result"
+/**Contains a finished result in a compact mode. Unlike MsgImage, data is the result itself, not a string.*/
+export class MsgResult {
+    header: "incoming_result" = "incoming_result"
+    clientKey: string
+    jobId: string
+    mode: ResultMode
+    data: SentimentCounts | SentimentColumns
+
+    constructor(clientKey: string, jobId: string, mode: ResultMode, data: SentimentCounts | SentimentColumns) {
+        this.clientKey = clientKey
+        this.jobId = jobId
+        this.mode = mode
+        this.data = data
+    }
+}
+
+export const HEADER_INCOMING_PARTIAL = "incoming_partial"
+/**Contains the result for one chunk of a streamed upload, in the given mode. The last one has done set and empty data.*/
+export class MsgPartial {
+    header: "incoming_partial" = "incoming_partial"
+    clientKey: string
+    jobId: string
+    mode: ResultMode
+    data: SentimentAnalysisResult | SentimentCounts | SentimentColumns
+    rows: number
+    done: boolean
+
+    constructor(clientKey: string, jobId: string, mode: ResultMode, data: SentimentAnalysisResult | SentimentCounts | SentimentColumns, rows: number, done: boolean) {
+        this.clientKey = clientKey
+        this.jobId = jobId
+        this.mode = mode
+        this.data = data
+        this.rows = rows
+        this.done = done
+    }
+}
+
+/**Contains the entirety of the file as a string, as well as header names. If stream is set, results come back as MsgPartials.*/
 export class MsgCsv {
     clientKey: string
     data: string
     infer: boolean
     prodName: string
     revName: string
+    stream: boolean
+    mode: ResultMode
 
-    constructor(clientKey: string, data: string, prodName: string, revName: string, infer: boolean) {
+    constructor(clientKey: string, data: string, prodName: string, revName: string, infer: boolean, stream: boolean = false, mode: ResultMode = "full") {
         this.clientKey = clientKey
         this.data = data
         this.infer = infer
         this.prodName = prodName
         this.revName = revName
+        this.stream = stream
+        this.mode = mode
+    }
+}
+
+export const HEADER_INCOMING_QUEUED = "incoming_queued"
+/**Tells the client its CSV was accepted, and how many jobs are ahead of it.*/
+export class MsgQueued {
+    header: "incoming_queued" = "incoming_queued"
+    clientKey: string
+    jobId: string
+    position: number
+
+    constructor(clientKey: string, jobId: string, position: number) {
+        this.clientKey = clientKey
+        this.jobId = jobId
+        this.position = position
     }
 }
 
@@ -67,6 +139,19 @@ export class MsgClose {
     }
 }
 
+export const HEADER_FETCH_JOB = "fetch_job"
+/**Asks the server to send everything for a job submitted earlier (e.g. before the connection dropped) again, and the rest of it as it comes, to this connection.*/
+export class MsgFetchJob {
+    header: "fetch_job" = "fetch_job"
+    clientKey: string
+    jobId: string
+
+    constructor(clientKey: string, jobId: string) {
+        this.clientKey = clientKey
+        this.jobId = jobId
+    }
+}
+
 export const HEADER_CALLBACK_PING = "callback_ping"
 /**Signals the server that this connection is still active.*/
 export class MsgCallbackPing {
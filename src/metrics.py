@@ -0,0 +1,228 @@
+'''
+Server metrics, served in the Prometheus text format at /metrics, and the stage timer that feeds them.
+
+Workers never touch the registry: an analysis run through Measured returns its stage timings along with its result, and the server process records them. This works the same whether workers are threads or processes.
+'''
+
+import os
+import math
+import time
+import bisect
+import cProfile
+import threading
+import contextlib
+from typing import Any, Callable
+
+type Timings = dict[str, float]
+'''Seconds spent in each stage of an analysis: "read" (CSV parsing), "group", "label" (everything in src.inference.classify, which includes "cache", "tokenise" and "forward") and "encode". <br />
+With micro-batching (see src.inference.Batcher), "label" also includes "batchWait": how long the job's reviews waited for a shared batch. <br />
+Some entries are counts rather than seconds: "truncated", how many reviews were longer than settings.maxTokens (see src.inference.classify), and with the cascade on (see src.inference.cascade), "settled" and "escalated", how many reviews its first pass decided and how many it left to the model. Its own time is "firstPass", within "label". <br />
+Measured adds two in bytes: "peakRss", the highest resident set size of the worker process while the job ran, and "rssGrowth", how far that was above its size when the job started (see RssWatch). In thread mode, jobs running at the same time share the process, so each one's figures include the others'.'''
+
+@contextlib.contextmanager
+def stage(timings: Timings | None, name: str):
+    '''Add the time spent in the with block to timings[name], if timings is given.'''
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+def _labels(labelName: str | None, label: str | None, extra: str = "") -> str:
+    parts = [f"{labelName}=\"{label}\""] if labelName is not None else []
+    if extra != "":
+        parts.append(extra)
+    return f"{{{",".join(parts)}}}" if len(parts) > 0 else ""
+
+def _number(value: float) -> str:
+    return "+Inf" if value == math.inf else repr(float(value))
+
+class Counter:
+    '''A value that only goes up, optionally split by one label.'''
+    def __init__(self, name: str, help: str, labelName: str | None = None):
+        self.name = name
+        self.help = help
+        self.labelName = labelName
+        self.values: dict[str | None, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, label: str | None = None):
+        with self._lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self.values) if len(self.values) > 0 or self.labelName is not None else {None: 0}
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", *(f"{self.name}{_labels(self.labelName, label)} {_number(value)}" for label, value in values.items())]
+
+class Gauge:
+    '''A value read from read() whenever metrics are rendered.'''
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {_number(self.read())}"]
+
+class Histogram:
+    '''Counts observations into cumulative buckets, optionally split by one label.'''
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name: str, help: str, labelName: str | None = None, buckets: tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelName = labelName
+        self.buckets = (*buckets, math.inf)
+        self.counts: dict[str | None, list[int]] = {}
+        self.sums: dict[str | None, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, label: str | None = None):
+        with self._lock:
+            counts = self.counts.get(label)
+            if counts is None:
+                counts = [0] * len(self.buckets)
+                self.counts[label] = counts
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[label] = self.sums.get(label, 0.0) + value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(label, list(counts), self.sums[label]) for label, counts in self.counts.items()]
+        for label, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelName, label, f"le=\"{_number(bound)}\"")} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelName, label)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelName, label)} {cumulative}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def add[M: Counter | Gauge | Histogram](self, metric: M) -> M:
+        '''Register a metric, replacing any earlier one of the same name.'''
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics.values() for line in metric.render()) + "\n"
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.add(Histogram("sentiment_stage_seconds", "Time spent per job in each analysis stage (see src.metrics.Timings), and per message in websocket sends (stage=\"send\").", "stage"))
+QUEUE_SECONDS = REGISTRY.add(Histogram("sentiment_queue_wait_seconds", "Time jobs spent waiting for a worker."))
+JOB_SECONDS = REGISTRY.add(Histogram("sentiment_job_seconds", "Time from a job being queued to its result being sent."))
+ROWS = REGISTRY.add(Counter("sentiment_rows_total", "CSV rows (lines after the header) of finished jobs."))
+JOBS = REGISTRY.add(Counter("sentiment_jobs_total", "Finished jobs, by outcome.", "outcome"))
+TRUNCATED = REGISTRY.add(Counter("sentiment_truncated_reviews_total", "Reviews longer than the token budget (SENTIMENT_MAXTOKENS), which were cut short or split into windows."))
+ERRORS = REGISTRY.add(Counter("sentiment_errors_total", "Errors, by kind: analysis (the CSV could not be analysed), job (a worker raised) and send (a websocket send failed).", "kind"))
+
+MEMORY_BUCKETS = tuple(float(mib << 20) for mib in (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192))
+PEAK_RSS = REGISTRY.add(Histogram("sentiment_job_peak_rss_bytes", "Highest resident set size of the worker process while each job ran.", buckets=MEMORY_BUCKETS))
+RSS_GROWTH = REGISTRY.add(Histogram("sentiment_job_rss_growth_bytes", "How far each job's peak resident set size was above the worker process's size when it started: roughly the memory the job itself needed.", buckets=MEMORY_BUCKETS))
+
+SETTLED = REGISTRY.add(Counter("sentiment_cascade_settled_total", "Reviews the cascade's first pass was sure enough of to decide without the model (SENTIMENT_CASCADE)."))
+ESCALATED = REGISTRY.add(Counter("sentiment_cascade_escalated_total", "Reviews the cascade's first pass left to the model. The escalation rate is this over the sum of both cascade counters."))
+
+COUNTED = {"truncated": TRUNCATED, "settled": SETTLED, "escalated": ESCALATED}
+'''Entries of Timings that are counts, and the counters they go to.'''
+MEASURED = {"peakRss": PEAK_RSS, "rssGrowth": RSS_GROWTH}
+'''Entries of Timings that are in bytes, and the histograms they go to.'''
+
+def record(timings: Timings):
+    '''Add the stage timings of one job to STAGE_SECONDS, its counts to their counters (see COUNTED) and its memory use to its histograms (see MEASURED).'''
+    for name, value in timings.items():
+        if name in COUNTED:
+            COUNTED[name].inc(value)
+        elif name in MEASURED:
+            MEASURED[name].observe(value)
+        else:
+            STAGE_SECONDS.observe(value, name)
+
+def currentRss() -> int | None:
+    '''Resident set size of this process in bytes, or None where it cannot be read (only Linux's /proc is supported).'''
+    try:
+        with open("/proc/self/statm", "rb") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+class RssWatch:
+    '''The highest resident set size of this process seen while a with block ran, sampled every SAMPLE_SECONDS by one background thread shared by every block running at once, which stops when none is. <br />
+    start and peak stay None where the size cannot be read (see currentRss()).'''
+    SAMPLE_SECONDS = 0.02
+    _watches: set["RssWatch"] = set()
+    _lock = threading.Lock()
+    _sampler: threading.Thread | None = None
+
+    def __init__(self):
+        self.start: int | None = None
+        self.peak: int | None = None
+
+    def sample(self, rss: int):
+        self.peak = rss if self.peak is None else max(self.peak, rss)
+
+    def __enter__(self) -> "RssWatch":
+        self.start = currentRss()
+        if self.start is None:
+            return self
+        self.sample(self.start)
+        with RssWatch._lock:
+            RssWatch._watches.add(self)
+            if RssWatch._sampler is None:
+                RssWatch._sampler = threading.Thread(target=RssWatch._sample, name="rss-sampler", daemon=True)
+                RssWatch._sampler.start()
+        return self
+
+    def __exit__(self, *_: Any):
+        if self.start is None:
+            return
+        with RssWatch._lock:
+            RssWatch._watches.discard(self)
+        rss = currentRss()
+        if rss is not None:
+            self.sample(rss)
+
+    @staticmethod
+    def _sample():
+        while True:
+            rss = currentRss()
+            with RssWatch._lock:
+                if len(RssWatch._watches) == 0:
+                    RssWatch._sampler = None
+                    return
+                if rss is not None:
+                    for watch in RssWatch._watches:
+                        watch.sample(rss)
+            time.sleep(RssWatch.SAMPLE_SECONDS)
+
+class Measured:
+    '''Wraps an analysis function (e.g. src.process.analyseCsv) so that calling it returns (result, timings). Picklable, so it runs on worker processes too. <br />
+    If profilePath is given, the call also runs under cProfile and its stats are written there (read them with pstats or snakeviz).'''
+    def __init__(self, fn: Callable[..., Any], profilePath: str | None = None):
+        self.fn = fn
+        self.profilePath = profilePath
+
+    def __call__(self, *args: Any) -> tuple[Any, Timings]:
+        timings: Timings = {}
+        with RssWatch() as watch:
+            if self.profilePath is None:
+                result = self.fn(*args, timings=timings)
+            else:
+                profiler = cProfile.Profile()
+                try:
+                    result = profiler.runcall(self.fn, *args, timings=timings)
+                finally:
+                    profiler.dump_stats(self.profilePath)
+        if watch.start is not None and watch.peak is not None:
+            timings["peakRss"] = watch.peak
+            timings["rssGrowth"] = watch.peak - watch.start
+        return result, timings
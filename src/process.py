@@ -1,41 +1,218 @@
 import io
+import sys
+import csv
 import json
+import asyncio
+import importlib
+import importlib.util
+import numpy as np
 import pandas as pd
-import functools as ft
-import transformers as tf
-from typing import Literal
+from pathlib import Path
+from typing import Literal, Callable, Iterator
+from src.config import settings
+from src.inference import classify, SENTIMENTS
+from src.metrics import stage, Timings
+
+type CsvSource = str | Path
+'''Either the CSV itself or the path of a file holding it, which is then parsed straight from disk.'''
+
+type ResultMode = Literal["full", "counts", "columnar"]
+RESULT_MODES: list[ResultMode] = ["full", "counts", "columnar"]
 
 type SentimentsJson = dict[str, dict[str, list[Literal["p"] | Literal["n"] | Literal["e"]] | list[str]]]
 
-class NamesInfo:
-    def __init__(self):
-        self.prod: str | None = None
-        self.rev: str | None = None
-        self.count: int = 0
+class CsvError(Exception):
+    '''Raised when an upload does not fit the expected schema. The message is meant for the client.'''
+    def __init__(self, message: str, inferFailure: bool = False):
+        super().__init__(message)
+        self.inferFailure = inferFailure
+
+    def json(self) -> str:
+        return json.dumps({"error": str(self), "inferFailure": self.inferFailure})
 
 POTENTIAL_REV = ["review", "reviews"]
 POTENTIAL_PROD = ["productname", "product_name", "product name"]
 
-def colTest(info: NamesInfo, c: object):
-    name = str(c).lower()
-    ret = False
-    if name in POTENTIAL_PROD and name != info.prod:
-        if info.prod == None:
-            ret = True
-        info.prod = name
-        info.count += 1
-    elif name in POTENTIAL_REV and name != info.rev:
-        if info.rev == None:
-            ret = True
-        info.rev = name
-        info.count += 1
-    return ret
-
-MODEL = "tabularisai/multilingual-sentiment-analysis"
-pipeline = tf.pipeline("text-classification", model=MODEL, device="cpu")
-
-async def analyse(data: str, infer: bool, prodName: str, revName: str) -> str:
-    '''Analyse a CSV string containing product reviews according to a certain schema and return a sentiment analysis. <br />
+def _lines(text: str) -> Iterator[str]:
+    '''The lines of text, one at a time, without splitting (and so copying) all of it.'''
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start)
+        end = len(text) if end == -1 else end + 1
+        yield text[start:end]
+        start = end
+
+def readHeader(data: CsvSource) -> list[str]:
+    '''The field names on the first non-blank line of a CSV string or file. Nothing past that line is read.'''
+    if isinstance(data, Path):
+        with open(data, encoding="utf-8-sig", newline="") as file:
+            return next((row for row in csv.reader(file) if len(row) > 0), [])
+    return next((row for row in csv.reader(_lines(data.removeprefix("\ufeff"))) if len(row) > 0), [])
+
+def resolveColumns(header: list[str], infer: bool, prodName: str, revName: str) -> tuple[str, str]:
+    '''The names of the product and review columns in header: inferred from POTENTIAL_PROD and POTENTIAL_REV (case-insensitive) if infer is set, otherwise prodName and revName, which must be present. <br />
+    Raises CsvError if they cannot be resolved.'''
+    if infer:
+        prods = [name for name in header if name.lower() in POTENTIAL_PROD]
+        revs = [name for name in header if name.lower() in POTENTIAL_REV]
+        matches = len(prods) + len(revs)
+        if matches > 2:
+            raise CsvError(f"Inference failure: too many matches({matches}). Please specify column names.", True)
+        if len(prods) != 1 or len(revs) != 1:
+            raise CsvError("Inference failure: too few matches. Please specify column names.", True)
+        return prods[0], revs[0]
+    matches = sum(1 for name in header if name in [prodName, revName])
+    if matches < 2:
+        raise CsvError("Provided names not found.")
+    elif matches > 2:
+        raise CsvError(f"Too many columns ({matches}) match provided names")
+    return prodName, revName
+
+def usePyarrow() -> bool:
+    '''Whether whole uploads are parsed by pyarrow (see src.config.Settings.csvEngine).'''
+    if settings.csvEngine == "c":
+        return False
+    try:
+        importlib.import_module("pyarrow.csv")
+        return True
+    except ImportError as e:
+        if settings.csvEngine == "pyarrow":
+            raise ImportError("SENTIMENT_CSVENGINE=pyarrow needs pyarrow (pip install pyarrow).") from e
+        return False
+
+def hasPyarrow() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+def stringDtype() -> pd.StringDtype:
+    '''The dtype parsed columns are held in: arrow-backed strings if pyarrow is installed, which keep a column in a few contiguous buffers instead of one Python object per value, otherwise pandas' object-backed ones.'''
+    return pd.StringDtype("pyarrow" if hasPyarrow() else "python")
+
+def releaseMemory():
+    '''Hand memory freed by pyarrow back to the operating system straight away, rather than keeping it for later allocations, so that one large upload does not leave its worker holding its peak.'''
+    if "pyarrow" in sys.modules:
+        import pyarrow as pa
+        pa.default_memory_pool().release_unused()
+
+def readArrow(data: CsvSource, columns: list[str]) -> pd.DataFrame | None:
+    '''Parse columns out of a CSV with pyarrow's multithreaded reader. <br />
+    pandas keeps the named fields of lines with too many or too few fields (missing ones are left empty), which pyarrow cannot do. At the first such line this gives up and returns None, and the CSV should be parsed by pandas instead, so the result never depends on the parser.'''
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    try:
+        table = pacsv.read_csv(
+            str(data) if isinstance(data, Path) else pa.BufferReader(data.encode("utf-8")),
+            read_options=pacsv.ReadOptions(use_threads=True),
+            parse_options=pacsv.ParseOptions(newlines_in_values=True, invalid_row_handler=lambda _: "error"),
+            convert_options=pacsv.ConvertOptions(include_columns=columns, column_types={name: pa.string() for name in columns}, strings_can_be_null=False),
+        )
+    except pa.ArrowInvalid:
+        return None
+    return table.to_pandas(types_mapper={pa.string(): stringDtype()}.get)
+
+def readCsv(data: CsvSource, infer: bool, prodName: str, revName: str, chunkRows: int | None = None) -> tuple[pd.DataFrame | Iterator[pd.DataFrame], str, str]:
+    '''Parse the product and review columns out of a CSV string or file. Only those two columns are ever materialised. Returns the data (an iterator of DataFrames of up to chunkRows rows each if chunkRows is given) and the resolved column names. <br />
+    The columns are resolved from the header line alone, so CsvError is raised before anything else is parsed if they cannot be. Whole CSVs are parsed by pyarrow if it is installed (see usePyarrow()), chunks by pandas' C parser.'''
+    prodName, revName = resolveColumns(readHeader(data), infer, prodName, revName)
+    columns = [prodName, revName]
+    if chunkRows is None and usePyarrow():
+        readData = readArrow(data, columns)
+        if readData is not None:
+            return readData, prodName, revName
+    source = data if isinstance(data, Path) else io.StringIO(data)
+    readData = pd.read_csv(source, sep=",", header=0, usecols=columns, dtype=stringDtype(), skip_blank_lines=True, iterator=False, chunksize=chunkRows, on_bad_lines="skip", keep_default_na=False, memory_map=isinstance(data, Path))
+    return readData, prodName, revName
+
+MEMORY_PER_BYTE = 3
+MEMORY_PER_ROW = 300
+MEMORY_PER_BYTE_OBJECT = 3
+MEMORY_PER_ROW_OBJECT = 250
+
+def estimateMemory(size: int, rows: int, mode: ResultMode = "full", stream: bool = False, includeReviews: bool = False, chunkRows: int | None = None) -> int:
+    '''Roughly how many bytes analysing a CSV of size bytes and rows rows takes on top of what its worker already holds: parsing, the reviews as Python strings, classifying them, and the result, which repeats every review in mode "full" (or with includeReviews). A streamed CSV only holds one chunk of chunkRows rows (the configured default if None) at a time. <br />
+    MEMORY_PER_BYTE and MEMORY_PER_ROW were fitted to the peak memory of generated CSVs with short and long reviews, rounded up. Without pyarrow, columns are held as one Python object per value (see stringDtype()) and parsed by pandas, which was fitted separately (MEMORY_PER_BYTE_OBJECT and MEMORY_PER_ROW_OBJECT).'''
+    if stream and rows > 0:
+        chunkRows = settings.chunkRows if chunkRows is None else chunkRows
+        size = size * min(rows, chunkRows) // rows
+        rows = min(rows, chunkRows)
+    perByte, perRow = (MEMORY_PER_BYTE, MEMORY_PER_ROW) if hasPyarrow() else (MEMORY_PER_BYTE_OBJECT, MEMORY_PER_ROW_OBJECT)
+    estimate = perByte * size + perRow * rows
+    if mode == "full" or includeReviews:
+        estimate += size
+    return estimate
+
+class Grouped:
+    '''Reviews of an upload held as arrays: product names (in order of first appearance), and for each row its product's index into them and its review.'''
+    def __init__(self, names: np.ndarray, codes: np.ndarray, reviews: np.ndarray):
+        self.names = names
+        self.codes = codes
+        self.reviews = reviews
+
+def present(readData: pd.DataFrame, prodName: str, revName: str) -> pd.Series:
+    '''Which rows have both a product and a review. Empty fields are parsed as "" rather than NA (see readCsv()), so both are checked: NA only comes from rows with too few fields.'''
+    product = readData[prodName]
+    review = readData[revName]
+    return product.notna() & (product != "") & review.notna() & (review != "")
+
+def group(readData: pd.DataFrame, prodName: str, revName: str) -> Grouped:
+    '''Factorise product names once, straight from their (arrow-backed, see stringDtype()) column, so that no per-row Python objects are needed to group reviews. Only the reviews, which the model needs as Python strings, are materialised. Rows missing either field (see present()) are dropped.'''
+    complete = present(readData, prodName, revName)
+    if not complete.all():
+        readData = readData[complete]
+    codes, names = pd.factorize(readData[prodName])
+    return Grouped(names.to_numpy(dtype=object), codes, readData[revName].to_numpy(dtype=object))
+
+def assemble(grouped: Grouped, sentiments: np.ndarray) -> SentimentsJson:
+    '''Build the output of analyseCsv() from grouped reviews and their sentiments (None for unknown ones, which are left out), keeping input order within each product.'''
+    order = np.argsort(grouped.codes, kind="stable")
+    ends = np.cumsum(np.bincount(grouped.codes, minlength=len(grouped.names)))
+    reviews = grouped.reviews[order]
+    sentiments = sentiments[order]
+    known = pd.notna(sentiments)
+    allKnown = bool(known.all())
+    output: SentimentsJson = {}
+    start = 0
+    for name, end in zip(grouped.names.tolist(), ends.tolist()):
+        sents = sentiments[start:end] if allKnown else sentiments[start:end][known[start:end]]
+        output[name] = {"sentiments": sents.tolist(), "reviews": reviews[start:end].tolist()}
+        start = end
+    return output
+
+def counts(grouped: Grouped, sentiments: np.ndarray) -> dict[str, dict[str, int]]:
+    '''How many reviews of each product are of each sentiment.'''
+    table = np.zeros((len(grouped.names), len(SENTIMENTS)), dtype=np.int64)
+    sentimentCodes = pd.Index(SENTIMENTS).get_indexer(sentiments) # -1 for unknown ones
+    known = sentimentCodes >= 0
+    np.add.at(table, (grouped.codes[known], sentimentCodes[known]), 1)
+    return {name: dict(zip(SENTIMENTS, row)) for name, row in zip(grouped.names.tolist(), table.tolist())}
+
+def columnar(grouped: Grouped, sentiments: np.ndarray, includeReviews: bool = False) -> dict[str, object]:
+    '''The result as parallel columns, one entry per review in input order: the index of its product in products, and its sentiment as one character of a string. Reviews with unknown sentiments are left out.'''
+    known = pd.notna(sentiments)
+    output: dict[str, object] = {
+        "products": grouped.names.tolist(),
+        "index": grouped.codes[known].tolist(),
+        "sentiments": "".join(sentiments[known].tolist()),
+    }
+    if includeReviews:
+        output["reviews"] = grouped.reviews[known].tolist()
+    return output
+
+def encode(grouped: Grouped, sentiments: np.ndarray, mode: ResultMode = "full", includeReviews: bool = False) -> str:
+    '''Serialise a result in one of the response modes (see analyseCsv()).'''
+    match mode:
+        case "counts":
+            return json.dumps(counts(grouped, sentiments), ensure_ascii=False, separators=(",", ":"))
+        case "columnar":
+            return json.dumps(columnar(grouped, sentiments, includeReviews), ensure_ascii=False, separators=(",", ":"))
+        case _:
+            return json.dumps(assemble(grouped, sentiments))
+
+def label(grouped: Grouped, batchSize: int | None = None, lengthKey: str | None = None, timings: Timings | None = None) -> np.ndarray:
+    '''Classify the reviews of every product in one go (see src.inference.classify). Returns their sentiments, in row order.'''
+    return np.array(classify(grouped.reviews.tolist(), batchSize, lengthKey, timings), dtype=object)
+
+def analyseCsv(data: CsvSource, infer: bool, prodName: str, revName: str, batchSize: int | None = None, lengthKey: str | None = None, mode: ResultMode = "full", includeReviews: bool = False, timings: Timings | None = None) -> str:
+    '''Analyse a CSV string (or file, see CsvSource) containing product reviews according to a certain schema and return a sentiment analysis. <br />
     ## Schema
     Exactly 2 fields matching the provided product field and review field names expected (case-sensitive).
 
@@ -63,47 +240,64 @@ async def analyse(data: str, infer: bool, prodName: str, revName: str) -> str:
 
     "p" = positive, "n" = negative, "e" = neutral
 
-    {"error": error description} is returned if an error occurred.'''
+    {"error": error description} is returned if an error occurred.
+
+    ## Other output modes
+    The above is mode "full". Other modes send much less back, which matters for large uploads:
+    - "counts": {[index: string]: {p: number, n: number, e: number}}, just what the pie charts need.
+    - "columnar": {products: string[], index: number[], sentiments: string, reviews?: string[]}, one entry in index and one character in sentiments per review, in input order. reviews is only present if includeReviews is set.
+
+    ## Batching
+    Reviews from every product are classified together, in batches of batchSize grouped by lengthKey (see src.config.Settings). Leave either as None to use the configured default.
+
+    ## Timing
+    If a timings dict is given, the time spent in each stage is added to it (see src.metrics.Timings).'''
     try:
-        if infer:
-            info = NamesInfo()
-            readData = pd.read_csv(io.StringIO(data), sep=",", header=0, usecols=ft.partial(colTest, info), dtype=pd.StringDtype(), skip_blank_lines=True, iterator=False, on_bad_lines="skip", keep_default_na=False)
-            cols = info.count
-            if cols < 2:
-                return json.dumps({"error": "Inference failure: too few matches. Please specify column names.", "inferFailure": True})
-            elif cols > 2:
-                return json.dumps({"error": f"Inference failure: too many matches({info.count}). Please specify column names.", "inferFailure": True})
-            prodName = str(info.prod)
-            revName = str(info.rev)
-        else:
-            readData = pd.read_csv(io.StringIO(data), sep=",", header=0, usecols=(lambda c: str(c) in [prodName, revName]), dtype=pd.StringDtype(), skip_blank_lines=True, iterator=False, on_bad_lines="skip", keep_default_na=False)
-            cols = len(readData.columns)
-            if cols < 2:
-                return json.dumps({"error": "Provided names not found.", "inferFailure": False})
-            elif cols > 2:
-                return json.dumps({"error": f"Too many columns ({cols}) match provided names", "inferFailure": False})
-        
-        products: dict[str, list[str]] = {}
-        for _, ser in readData.iterrows():
-            if ser[prodName] in products:
-                products[ser[prodName]].append(ser[revName])
-            else:
-                products[ser[prodName]] = [ser[revName]]
-                
-        sentiments: SentimentsJson = {} #In the value list, first item is positives and second is negatives
-        for name, reviews in products.items():
-            sentimentList: list[Literal["p"] | Literal["n"] | Literal["e"]] = []
-            rawSentiments = pipeline(reviews)
-            for rawSent in rawSentiments:
-                if rawSent["label"] == "Positive" or rawSent["label"] == "Very Positive":
-                    sentimentList.append("p")
-                elif rawSent["label"] == "Negative" or rawSent["label"] == "Very Negative":
-                    sentimentList.append("n")
-                elif rawSent["label"] == "Neutral":
-                    sentimentList.append("e")
-                else:
-                    print(f"Unknown value received from model: {rawSent}")
-            sentiments[name] = {"sentiments": sentimentList, "reviews": reviews}
-        return json.dumps(sentiments)
+        with stage(timings, "read"):
+            readData, prodName, revName = readCsv(data, infer, prodName, revName)
+        with stage(timings, "group"):
+            grouped = group(readData, prodName, revName)
+            # Only the grouped arrays are needed from here on
+            del readData
+            releaseMemory()
+        with stage(timings, "label"):
+            sentiments = label(grouped, batchSize, lengthKey, timings)
+        with stage(timings, "encode"):
+            return encode(grouped, sentiments, mode, includeReviews)
+    except CsvError as e:
+        return e.json()
     except Exception as e:
-        return json.dumps({"error": str(e), "inferFailure": False})
\ No newline at end of file
+        return json.dumps({"error": str(e), "inferFailure": False})
+
+def analyseStream(data: CsvSource, infer: bool, prodName: str, revName: str, chunkRows: int | None, onPartial: Callable[[str, int], None], mode: ResultMode = "full", includeReviews: bool = False, timings: Timings | None = None) -> str:
+    '''Like analyseCsv(), but the CSV is parsed and classified chunkRows rows at a time (None for the configured default, see src.config.Settings.chunkRows), and each chunk's result is handed to onPartial as soon as it is ready, together with the number of rows done so far. <br />
+    Each partial result has the same shape as the output of analyseCsv() in the given mode, but only covers the rows of its chunk, so a product may appear in several of them. Nothing is kept between chunks. <br />
+    Returns {"rows": total rows} when done, or an error like analyseCsv(). Stage times are summed over chunks into timings, if given; "read" covers parsing every chunk.'''
+    chunkRows = settings.chunkRows if chunkRows is None else chunkRows
+    try:
+        with stage(timings, "read"):
+            chunks, prodName, revName = readCsv(data, infer, prodName, revName, chunkRows)
+            chunkIter = iter(chunks) # type: ignore
+        rows = 0
+        while True:
+            with stage(timings, "read"):
+                chunk = next(chunkIter, None)
+            if chunk is None:
+                break
+            rows += len(chunk)
+            with stage(timings, "group"):
+                grouped = group(chunk, prodName, revName)
+            with stage(timings, "label"):
+                sentiments = label(grouped, timings=timings)
+            with stage(timings, "encode"):
+                result = encode(grouped, sentiments, mode, includeReviews)
+            onPartial(result, rows)
+        return json.dumps({"rows": rows})
+    except CsvError as e:
+        return e.json()
+    except Exception as e:
+        return json.dumps({"error": str(e), "inferFailure": False})
+
+async def analyse(data: str, infer: bool, prodName: str, revName: str, batchSize: int | None = None, lengthKey: str | None = None) -> str:
+    '''Run analyseCsv() in a separate thread so the calling event loop is not blocked. The server itself goes through src.jobs instead.'''
+    return await asyncio.to_thread(analyseCsv, data, infer, prodName, revName, batchSize, lengthKey)
\ No newline at end of file
@@ -0,0 +1,140 @@
+'''
+Store of finished and running jobs' results, so that results outlive the connection that asked for them and identical uploads are only analysed once.
+'''
+
+import time
+import json
+import hashlib
+import collections as col
+from pathlib import Path
+from typing import Any
+from src.config import settings
+from src.backends import backendId
+from src.cascade import cascadeId
+
+def uploadKey(data: str | Path, params: dict[str, Any]) -> str:
+    '''Content address of an upload: a hash of the CSV, everything that changes what its result looks like (params, e.g. column names and mode) and the model, and cascade if on, it would be run through. Reads the whole file if data is one, so call it off the event loop.'''
+    digest = hashlib.sha256(json.dumps({**params, "model": backendId(), "cascade": cascadeId()}, sort_keys=True).encode("utf-8"))
+    digest.update(b"\0")
+    if isinstance(data, Path):
+        with open(data, "rb") as file:
+            while block := file.read(1 << 20):
+                digest.update(block)
+    else:
+        digest.update(data.encode("utf-8"))
+    return digest.hexdigest()
+
+class StoredJob:
+    '''Everything sent, or to be sent, for one job: the partial results of a streamed job as they arrive, then the final result. Any number of clients can follow a job; each gets everything sent so far on joining, as long as the job is replayable (see ResultStore.addPartial).'''
+    def __init__(self, jobId: str, key: str, stream: bool, mode: str):
+        self.jobId = jobId
+        self.key = key
+        self.stream = stream
+        self.mode = mode
+        self.clients: set[str] = set()
+        self.partials: list[tuple[str, int]] = []
+        '''(partial result, rows done) covering every chunk of a streamed job so far: one running total in counts mode, otherwise each chunk's own.'''
+        self.counts: dict[str, dict[str, int]] = {}
+        '''The running total of a streamed job in counts mode.'''
+        self.replayable: bool = True
+        '''False once a streamed job's partials were dropped for taking up more than the store's replayMaxBytes, after which it can no longer be sent to clients that join late.'''
+        self.result: str | None = None
+        '''The final result (for a streamed job, its summary), once done.'''
+        self.failed: bool = False
+        self.truncated: int = 0
+        '''How many reviews were longer than the token budget (see src.inference.fit).'''
+        self.size: int = 0
+        self.finished: float | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.result is not None
+
+class ResultStore:
+    '''Jobs by ID, and finished or running jobs by upload key (see uploadKey()). <br />
+    Finished jobs are kept for ttl seconds after finishing, and the least recently used ones are evicted earlier if results take up more than maxBytes. Running jobs are never evicted, and do not count towards maxBytes: what each keeps is bounded by replayMaxBytes instead. Failed and unreplayable jobs can still be fetched by ID, but are never reused for a new upload.'''
+    def __init__(self, ttl: float | None = None, maxBytes: int | None = None, replayMaxBytes: int | None = None):
+        self.ttl = settings.resultTtl if ttl is None else ttl
+        self.maxBytes = settings.resultMaxBytes if maxBytes is None else maxBytes
+        self.replayMaxBytes = settings.replayMaxBytes if replayMaxBytes is None else replayMaxBytes
+        self.jobs: dict[str, StoredJob] = {}
+        self.byKey: dict[str, str] = {}
+        self.finished: col.OrderedDict[str, StoredJob] = col.OrderedDict()
+        '''Finished jobs in the order they finished, so the first ones are always the first to expire.'''
+        self.recent: col.OrderedDict[str, StoredJob] = col.OrderedDict()
+        '''Finished jobs from least to most recently used.'''
+        self.size: int = 0
+
+    def add(self, job: StoredJob):
+        self.jobs[job.jobId] = job
+        self.byKey[job.key] = job.jobId
+
+    def get(self, jobId: str) -> StoredJob | None:
+        '''A job by ID, if it is still stored. Counts as a use for eviction.'''
+        self.evict()
+        job = self.jobs.get(jobId)
+        if job is not None and job.done:
+            self.recent.move_to_end(jobId)
+        return job
+
+    def find(self, key: str) -> StoredJob | None:
+        '''A finished or running job for the same upload, if any.'''
+        jobId = self.byKey.get(key)
+        return None if jobId is None else self.get(jobId)
+
+    def addPartial(self, job: StoredJob, partial: str, rows: int):
+        '''Keep one chunk of a streamed job's result for clients that join late. In counts mode it is folded into the job's running total, which only grows with the number of products; other modes grow with the file, so once a job keeps more than replayMaxBytes its partials are dropped and it stops being replayable.'''
+        if not job.replayable:
+            return
+        if job.mode == "counts":
+            for product, counts in json.loads(partial).items():
+                total = job.counts.setdefault(product, {})
+                for sentiment, count in counts.items():
+                    total[sentiment] = total.get(sentiment, 0) + count
+            partial = json.dumps(job.counts, ensure_ascii=False, separators=(",", ":"))
+            job.partials = [(partial, rows)]
+            job.size = len(partial)
+        else:
+            job.partials.append((partial, rows))
+            job.size += len(partial)
+        if job.size > self.replayMaxBytes:
+            job.partials = []
+            job.counts = {}
+            job.size = 0
+            job.replayable = False
+            if self.byKey.get(job.key) == job.jobId:
+                del self.byKey[job.key]
+
+    def finish(self, job: StoredJob, result: str, failed: bool = False):
+        '''Record a job's final result.'''
+        job.result = result
+        job.failed = failed
+        job.finished = time.monotonic()
+        job.size += len(result)
+        self.size += job.size
+        self.finished[job.jobId] = job
+        self.recent[job.jobId] = job
+        if failed and self.byKey.get(job.key) == job.jobId:
+            del self.byKey[job.key]
+        self.evict()
+
+    def remove(self, job: StoredJob):
+        if self.jobs.pop(job.jobId, None) is None:
+            return
+        if self.byKey.get(job.key) == job.jobId:
+            del self.byKey[job.key]
+        if job.done:
+            del self.finished[job.jobId]
+            del self.recent[job.jobId]
+            self.size -= job.size
+
+    def evict(self):
+        '''Drop finished jobs past their TTL, then the least recently used finished ones while over the size limit. Only looks at the jobs it drops, and one more.'''
+        now = time.monotonic()
+        while len(self.finished) > 0:
+            job = next(iter(self.finished.values()))
+            if now - job.finished <= self.ttl: # type: ignore
+                break
+            self.remove(job)
+        while self.size > self.maxBytes and len(self.recent) > 0:
+            self.remove(next(iter(self.recent.values())))
@@ -2,20 +2,39 @@
 Python implementation of server-sde communications (originally in JavaScript)
 '''
 
+import os
 import enum
 import json
+import time
 import uuid
+import heapq
+import random
 import asyncio
+import functools as ft
 import pydantic as pyd
 import websockets as ws
-from src.process import analyse
-from typing import Literal, Callable, Awaitable
+from pathlib import Path
+from src.process import analyseCsv, analyseStream, estimateMemory, CsvSource, ResultMode
+from src.inference import warmUp
+from src.config import settings
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+from src.jobs import JobQueue, Job
+from src.results import ResultStore, StoredJob, uploadKey
+from src.logs import getLogger, preview, RateLimit
+from src.metrics import Measured, record, STAGE_SECONDS, QUEUE_SECONDS, JOB_SECONDS, ROWS, JOBS, ERRORS
+from typing import Literal, Awaitable
+
+log = getLogger(__name__)
 
 class Headers(enum.Enum):
     INCOMING_KEY = "incoming_key"
     CALLBACK_PING = "callback_ping"
     CLOSE = "close"
     INCOMING_IMAGE = "incoming_image"
+    INCOMING_QUEUED = "incoming_queued"
+    INCOMING_PARTIAL = "incoming_partial"
+    INCOMING_RESULT = "incoming_result"
+    FETCH_JOB = "fetch_job"
 
 class MsgKey(pyd.BaseModel):
     header: Literal["incoming_key"] = "incoming_key"
@@ -34,135 +53,389 @@ class MsgImage(pyd.BaseModel):
     clientKey: str
     data: str
 
+class MsgQueued(pyd.BaseModel):
+    header: Literal["incoming_queued"] = "incoming_queued"
+    clientKey: str
+    jobId: str
+    position: int
+
+def withData(msg: pyd.BaseModel, data: str) -> str:
+    '''Serialise a message whose data field is already-serialised JSON, embedding it as is instead of escaping it into a string.'''
+    head = msg.model_dump_json(exclude={"data"})
+    return f"{head[:-1]},\"data\":{data}}}"
+
+class MsgResult(pyd.BaseModel):
+    '''A finished result in one of the compact modes (see src.process.analyseCsv). Send with withData(); data is the result itself, not a string.'''
+    header: Literal["incoming_result"] = "incoming_result"
+    clientKey: str
+    jobId: str
+    mode: str
+    data: None = None
+
+class MsgPartial(pyd.BaseModel):
+    '''Part of a streamed result, sent with withData(): data covers only the rows of one chunk, in the given mode, and rows is how many rows have been done so far. The last message of a job has done set and empty data.'''
+    header: Literal["incoming_partial"] = "incoming_partial"
+    clientKey: str
+    jobId: str
+    mode: str
+    rows: int
+    done: bool = False
+    data: None = None
+
+class MsgFetchJob(pyd.BaseModel):
+    '''Sent by a client to follow a job it submitted before (e.g. on an earlier connection). Everything sent for the job so far is sent again, then the rest as it comes.'''
+    header: Literal["fetch_job"] = "fetch_job"
+    clientKey: str
+    jobId: str
+
 class JsonCsv(pyd.BaseModel):
     clientKey: str
     data: str
     infer: bool
     prodName: str
     revName: str
+    stream: bool = False
+    mode: ResultMode = "full"
+    includeReviews: bool = False
+
+class Liveness:
+    '''When each client is next checked, and which clients have not answered their last ping. <br />
+    Every client has its own deadline in a heap, first set at a random point between half an interval and one and a half intervals after it connects, so checks are spread evenly over time instead of every client being pinged in one sweep, and each check costs O(log n). Clients that leave are not searched for: their heap entry is dropped when it comes up.'''
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.deadlines: list[tuple[float, str]] = []
+        self.awaiting: set[str] = set()
+        '''Clients pinged since their last check that have not answered yet.'''
+
+    def add(self, key: str):
+        heapq.heappush(self.deadlines, (time.monotonic() + random.uniform(0.5, 1.5) * self.interval, key))
 
-class Timer:
-    def __init__(self, timeout: int, callback: Callable[[], Awaitable[None]]):
-        self._timeout = timeout
-        self._callback = callback
-        self._cancelled: bool = False
-        self._task: asyncio.Task
+    def answered(self, key: str):
+        self.awaiting.discard(key)
 
-    async def _time(self):
-        while not self._cancelled:
-            await asyncio.sleep(self._timeout)
-            await self._callback()
+    def remove(self, key: str):
+        self.awaiting.discard(key)
 
-    def start(self):
-        self._task = asyncio.create_task(self._time())
+    def due(self) -> list[str]:
+        '''Take every client whose check is due. Each must be added again (see add()) to be checked again.'''
+        now = time.monotonic()
+        keys: list[str] = []
+        while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+            keys.append(heapq.heappop(self.deadlines)[1])
+        return keys
 
-    def stop(self):
-        self._cancelled = True
-        self._task.cancel()
+    def reschedule(self, key: str):
+        heapq.heappush(self.deadlines, (time.monotonic() + self.interval, key))
 
 class ServerComms:
     def __init__(self, host: str = "localhost", port: int = 5500) -> None:
         self.clients: dict[str, ws.ServerConnection] = {}
         self.server: ws.Server
-        self.awaitingCallback: list[str] = []
         self.started: bool = False
         self.stopped: bool = False
         self.port = port
         self.host = host
-        self.timer = Timer(60, self.callbackPing)
+        self.liveness = Liveness(settings.pingInterval)
+        self._background: set[asyncio.Task] = set()
+        '''Fire-and-forget sends and closes, kept so they are not garbage collected while running.'''
+        self.jobs = JobQueue()
+        self.inflightRows: int = 0
+        '''CSV rows of jobs that are queued or running.'''
+        self.pingLog = RateLimit(settings.logPingInterval)
+        self.results = ResultStore()
+        self.pending: dict[str, Job] = {}
+        '''Jobs not finished yet, by ID.'''
 
     async def start(self):
         '''Start the server. Idempotent.'''
-        print("Starting ServerComms.")
+        log.info("Starting ServerComms")
         if self.started:
             return
         self.started = True
-        self.timer.start()
+        self._watcher = asyncio.create_task(self.watchLiveness())
+        self.jobs.start(warmUp)
         self._stopper = asyncio.get_event_loop().create_future()
         await self._startServer()
 
     async def _startServer(self):
         '''Start the server's operation. Do NOT call this alone. It should only be called once, by start().'''
-        self.server = await ws.serve(self.onConnect, self.host, self.port, start_serving=False)
+        compression = [ServerPerMessageDeflateFactory(server_max_window_bits=settings.wsWindowBits, client_max_window_bits=settings.wsWindowBits, compress_settings={"level": settings.wsCompressionLevel, "memLevel": 5})] if settings.wsCompressionLevel > 0 else []
+        try:
+            self.server = await ws.serve(self.onConnect, self.host, self.port, start_serving=False, compression=None, extensions=compression)
+        except OSError as e:
+            # Typically a second server process on the same port. Connections live in one process, so scale analysis with workerMode="broker" instead
+            log.error("Could not start the websocket server", host=self.host, port=self.port, error=str(e))
+            raise
         async with self.server as server:
             await server.start_serving()
             await self._stopper
 
     async def stop(self):
         '''Stop the server and perform cleanup. Idempotent.'''
-        print("Stopping ServerComms.")
+        log.info("Stopping ServerComms")
         if self.stopped: 
             return
         self.stopped = True
         self._stopper.set_result(True)
-        self.timer.stop()
-        keys = []
-        for key in self.clients:
-            keys.append(key)
-        for key in keys:
-            await self.closeConnection(key)
+        self._watcher.cancel()
+        await self.jobs.stop()
+        await asyncio.gather(*(self.closeConnection(key) for key in list(self.clients)))
 
     async def onConnect(self, conn: ws.ServerConnection):
         '''Called whenever a new connection is detected. Is responsible for all I/O from/to that connection.'''
         key = str(uuid.uuid4())
         self.clients[key] = conn
+        self.liveness.add(key)
+        try:
+            await self.serveConnection(key, conn)
+        finally:
+            if self.clients.get(key) is conn:
+                del self.clients[key]
+                self.liveness.remove(key)
+                log.info("Client disconnected", clientKey=key, clients=len(self.clients))
+
+    async def serveConnection(self, key: str, conn: ws.ServerConnection):
+        '''Everything sent by one connection, until it closes.'''
         await self.send(conn, MsgKey(clientKey=key).model_dump_json())
+        log.info("Client connected", clientKey=key, clients=len(self.clients))
         async for message in conn:
-            print(f"Incoming: {message}")
             try:
                 event = json.loads(message)
                 if "header" in event:
                     match event["header"]:
                         case Headers.CALLBACK_PING.value:
+                            if (held := self.pingLog.allow("incoming")) is not None:
+                                log.debug("Incoming callback pings", clientKey=key, since=held + 1)
                             self.handleCallbackPing(MsgCallbackPing.model_validate_json(message))
+                        case Headers.FETCH_JOB.value:
+                            log.debug("Incoming", clientKey=key, bytes=len(message), message=preview(message))
+                            await self.handleFetchJob(key, MsgFetchJob.model_validate_json(message))
                         case Headers.CLOSE.value:
+                            log.debug("Incoming", clientKey=key, bytes=len(message), message=preview(message))
                             await self.handleMsgClose(MsgClose.model_validate_json(message))
                         case _:
-                            print(f"Received JSON with unrecognised header: {message}")
+                            log.warning("Received JSON with unrecognised header", clientKey=key, bytes=len(message), message=preview(message))
                 else:
-                    print(f"Received JSON without header: {message}")
+                    log.warning("Received JSON without header", clientKey=key, bytes=len(message), message=preview(message))
             except json.JSONDecodeError:
-                print(f"Received malformed message: {message}")
+                log.warning("Received malformed message", clientKey=key, bytes=len(message), message=preview(message))
 
-    def handleCallbackPing(self, msg: MsgCallbackPing): 
-        self.awaitingCallback.remove(msg.clientKey)
+    def handleCallbackPing(self, msg: MsgCallbackPing):
+        self.liveness.answered(msg.clientKey)
 
     async def handleMsgClose(self, msg: MsgClose):
         await self.closeConnection(msg.clientKey)
 
-    async def handleCsv(self, clientKey: str, data: str, infer: bool, prodName: str, revName: str):
-        print("Incoming: CSV")
-        result = asyncio.ensure_future(analyse(data, infer, prodName, revName))
-        result.add_done_callback(lambda task: asyncio.ensure_future(self.send(self.clients[clientKey], MsgImage(clientKey=clientKey, data=task.result()).model_dump_json())))
-
-    async def callbackPing(self): 
-        for key in self.awaitingCallback:
-            await self.send(self.clients[key], MsgClose(clientKey=key).model_dump_json())
-            await self.clients[key].close()
-            del self.clients[key]
-            print(f"Client {key} failed callback ping.")
-        self.awaitingCallback.clear()
-        for key, conn in self.clients.items():
-            await self.send(conn, MsgCallbackPing(clientKey=key).model_dump_json())
-            self.awaitingCallback.append(key)
-
-    async def send(self, conn: ws.ServerConnection, data: str):
-        '''Send data through a connection. For centralisation, always use this instead of doing it directly.'''
+    async def handleFetchJob(self, clientKey: str, msg: MsgFetchJob):
+        '''Let the client on this connection follow a job by ID, whoever submitted it.'''
+        stored = self.results.get(msg.jobId)
+        if stored is None:
+            await self.sendTo(clientKey, MsgImage(clientKey=clientKey, data=json.dumps({"error": "That analysis is no longer available. Please upload the file again.", "inferFailure": False})).model_dump_json())
+            return
+        await self.follow(clientKey, stored)
+
+    async def handleCsv(self, clientKey: str, data: CsvSource, infer: bool, prodName: str, revName: str, stream: bool = False, mode: ResultMode = "full", includeReviews: bool = False) -> tuple[str, int]:
+        '''Queue a CSV for analysis and return the job's ID and position in the queue. Raises src.jobs.QueueFull if the server cannot take it, or src.jobs.OverBudget (a QueueFull) if it never could (see src.process.estimateMemory). <br />
+        The result is sent to the client when done, or, if stream is set, chunk by chunk as MsgPartials (see src.process.analyseStream). Full results go out as a MsgImage, other modes as a MsgResult. <br />
+        If the same CSV was uploaded before with the same settings, and its job is still running or its result still stored (see src.results), the client follows that job instead of a new one being queued. <br />
+        If data is a file, it is deleted once the job is over, whether it was accepted or not.'''
+        try:
+            params = {"infer": infer, "prodName": prodName, "revName": revName, "stream": stream, "mode": mode, "includeReviews": includeReviews, "chunkRows": settings.chunkRows if stream else None}
+            key = await asyncio.to_thread(uploadKey, data, params)
+            earlier = self.results.find(key)
+            if earlier is not None:
+                if isinstance(data, Path):
+                    data.unlink(missing_ok=True)
+                log.info("CSV matches an earlier upload", clientKey=clientKey, jobId=earlier.jobId, done=earlier.done)
+                return earlier.jobId, await self.follow(clientKey, earlier)
+            rows = await asyncio.to_thread(countRows, data)
+            memory = estimateMemory(data.stat().st_size if isinstance(data, Path) else len(data), rows, mode, stream, includeReviews)
+            log.info("CSV received", clientKey=clientKey, rows=rows, file=isinstance(data, Path), stream=stream, mode=mode, memory=memory)
+            profilePath = os.path.join(settings.profileDir, f"{int(time.time())}-{uuid.uuid4().hex[:8]}") if random.random() < settings.profileRate else None
+            if profilePath is not None:
+                os.makedirs(settings.profileDir, exist_ok=True)
+            stored = StoredJob("", key, stream, mode)
+            if stream:
+                fn = Measured(ft.partial(analyseStream, mode=mode, includeReviews=includeReviews), None if profilePath is None else f"{profilePath}.prof")
+                job, _ = await self.jobs.submit(clientKey, fn, data, infer, prodName, revName, None, onProgress=lambda partial, rows: self.sendPartial(stored, partial, rows), memory=memory)
+            else:
+                fn = Measured(ft.partial(analyseCsv, mode=mode, includeReviews=includeReviews), None if profilePath is None else f"{profilePath}.prof")
+                job, _ = await self.jobs.submit(clientKey, fn, data, infer, prodName, revName, memory=memory)
+        except:
+            if isinstance(data, Path):
+                data.unlink(missing_ok=True)
+            raise
+        stored.jobId = job.id
+        self.results.add(stored)
+        self.pending[job.id] = job
+        self.inflightRows += rows
+        if isinstance(data, Path):
+            job.future.add_done_callback(lambda _: data.unlink(missing_ok=True))
+        job.future.add_done_callback(lambda _: asyncio.ensure_future(self.finishJob(stored, job, rows, profilePath)))
+        return job.id, await self.follow(clientKey, stored)
+
+    async def follow(self, clientKey: str, stored: StoredJob) -> int:
+        '''Make a client one of those a job's results are sent to, and send it a MsgQueued and everything sent for the job so far. Returns the job's position in the queue. <br />
+        If the job's partial results were too large to keep (see src.results.ResultStore.addPartial), the client is told to upload the file again instead, as it could only be sent part of them.'''
+        job = self.pending.get(stored.jobId)
+        position = 0 if job is None else self.jobs.position(job)
+        if not stored.replayable:
+            await self.sendTo(clientKey, MsgImage(clientKey=clientKey, data=json.dumps({"error": "That analysis is too large to be sent again. Please upload the file again.", "inferFailure": False})).model_dump_json())
+            return position
+        stored.clients.add(clientKey)
+        partials = list(stored.partials) # Chunks that arrive from here on are sent by sendPartial()
+        await self.sendTo(clientKey, MsgQueued(clientKey=clientKey, jobId=stored.jobId, position=position).model_dump_json())
+        for partial, rows in partials:
+            await self.sendTo(clientKey, withData(MsgPartial(clientKey=clientKey, jobId=stored.jobId, mode=stored.mode, rows=rows), partial))
+        if stored.done:
+            await self.sendResult(clientKey, stored)
+        return position
+
+    def sendPartial(self, stored: StoredJob, partial: str, rows: int):
+        '''Keep one chunk of a streamed job's result for clients that join late (see src.results.ResultStore.addPartial) and send it to everyone following the job.'''
+        self.results.addPartial(stored, partial, rows)
+        for clientKey in list(stored.clients):
+            asyncio.ensure_future(self.sendTo(clientKey, withData(MsgPartial(clientKey=clientKey, jobId=stored.jobId, mode=stored.mode, rows=rows), partial)))
+
+    async def finishJob(self, stored: StoredJob, job: Job, rows: int, profilePath: str | None):
+        '''Store a finished job's result, record it in the metrics and send it to everyone following the job, then write its breakdown if it was profiled.'''
+        self.pending.pop(job.id, None)
+        self.inflightRows -= rows
+        if job.future.cancelled():
+            self.results.remove(stored)
+            return
+        timings = {}
+        if job.future.exception() is not None:
+            ERRORS.inc(label="job")
+            JOBS.inc(label="failed")
+            log.error("Job failed", jobId=job.id, error=repr(job.future.exception()))
+            result = json.dumps({"error": f"Analysis failed: {job.future.exception()}", "inferFailure": False})
+            failed = True
+        else:
+            result, timings = job.future.result()
+            failed = result.startswith('{"error"')
+            record(timings)
+            ROWS.inc(rows)
+            stored.truncated = int(timings.get("truncated", 0))
+            if stored.truncated > 0:
+                log.info("Long reviews shortened", jobId=job.id, truncated=stored.truncated, strategy=settings.longReviews, maxTokens=settings.maxTokens)
+            JOBS.inc(label="error" if failed else "done")
+            if failed:
+                ERRORS.inc(label="analysis")
+        self.results.finish(stored, result, failed)
+        started = job.started if job.started is not None else job.submitted
+        QUEUE_SECONDS.observe(started - job.submitted)
+        sendStart = time.perf_counter()
+        for clientKey in list(stored.clients):
+            await self.sendResult(clientKey, stored)
+        finished = time.perf_counter()
+        JOB_SECONDS.observe(finished - job.submitted)
+        if profilePath is not None:
+            breakdown = {"jobId": job.id, "rows": rows, "mode": stored.mode, "stream": stored.stream, "error": failed, "queueSeconds": started - job.submitted, "stages": timings, "sendSeconds": finished - sendStart, "totalSeconds": finished - job.submitted, "profile": f"{profilePath}.prof"}
+            await asyncio.to_thread(writeBreakdown, f"{profilePath}.json", breakdown)
+            log.info("Profiled job", **breakdown)
+
+    async def sendResult(self, clientKey: str, stored: StoredJob):
+        '''Send the outcome of a finished job to a client. Errors always go out as a MsgImage; a streamed job otherwise ends with a done MsgPartial.'''
+        result: str = stored.result # type: ignore
+        if stored.failed or (stored.mode == "full" and not stored.stream):
+            await self.sendTo(clientKey, MsgImage(clientKey=clientKey, data=result).model_dump_json())
+        elif stored.stream:
+            await self.sendTo(clientKey, withData(MsgPartial(clientKey=clientKey, jobId=stored.jobId, mode=stored.mode, rows=json.loads(result)["rows"], done=True), "{}"))
+        else:
+            await self.sendTo(clientKey, withData(MsgResult(clientKey=clientKey, jobId=stored.jobId, mode=stored.mode), result))
+
+    async def watchLiveness(self):
+        '''Check each client when its deadline comes up (see Liveness): disconnect it if it never answered the last ping, otherwise ping it again. Sends go out concurrently, so a slow client never holds up the others.'''
+        pinged = 0
+        while True:
+            await asyncio.sleep(min(1.0, self.liveness.interval))
+            for key in self.liveness.due():
+                conn = self.clients.get(key)
+                if conn is None:
+                    continue
+                if key in self.liveness.awaiting:
+                    log.info("Client failed callback ping", clientKey=key)
+                    self.background(self.closeConnection(key))
+                    continue
+                self.liveness.awaiting.add(key)
+                self.liveness.reschedule(key)
+                self.background(self.send(conn, MsgCallbackPing(clientKey=key).model_dump_json(), quiet=True))
+                pinged += 1
+            if pinged > 0 and (held := self.pingLog.allow("outgoing")) is not None:
+                log.debug("Sent callback pings", pings=pinged, clients=len(self.clients), checksSince=held + 1)
+                pinged = 0
+
+    def background(self, coroutine: Awaitable[None]):
+        '''Run a send or close without waiting for it.'''
+        task = asyncio.ensure_future(coroutine)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def send(self, conn: ws.ServerConnection, data: str, quiet: bool = False):
+        '''Send data through a connection. For centralisation, always use this instead of doing it directly. <br />
+        Each message is logged at debug level by its size and a preview, unless quiet is set for repetitive traffic that is logged in summary elsewhere.'''
+        start = time.perf_counter()
         try:
-            print(f"Outgoing: {data}")
-            await conn.send(data)
+            if not quiet:
+                log.debug("Outgoing", bytes=len(data), message=preview(data))
+            await self.drained(conn, asyncio.ensure_future(conn.send(data)))
         except ws.ConnectionClosed:
-            print("Outgoing failed (socket already closed).")
+            ERRORS.inc(label="send")
+            log.warning("Outgoing failed (socket already closed)", bytes=len(data), message=preview(data))
+        except TimeoutError:
+            # The client is not reading. Drop it rather than let its buffer grow; onConnect cleans up once the connection ends
+            ERRORS.inc(label="send")
+            log.warning("Outgoing stalled, dropping connection", bytes=len(data), timeout=settings.sendTimeout, seconds=round(time.perf_counter() - start, 1))
+            conn.transport.abort()
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - start, "send")
+
+    async def drained(self, conn: ws.ServerConnection, sending: asyncio.Future[None]):
+        '''Wait for a send to finish for as long as the client keeps reading, however long a large result takes to go out. <br />
+        Every sendTimeout seconds the connection's write buffer is checked, and TimeoutError is raised (and the send cancelled) if it has not shrunk since the last check, so a client that stops reading is found within two checks.'''
+        buffered: int | None = None
+        try:
+            while True:
+                done, _ = await asyncio.wait([sending], timeout=settings.sendTimeout)
+                if done:
+                    return sending.result()
+                size = conn.transport.get_write_buffer_size()
+                if buffered is not None and size >= buffered:
+                    raise TimeoutError
+                buffered = size
+        finally:
+            sending.cancel()
+
+    async def sendTo(self, clientKey: str, data: str):
+        '''Send data to a client by key, if it is still connected. Results stay in the store, so a client that has gone can fetch them again later.'''
+        conn = self.clients.get(clientKey)
+        if conn is not None:
+            await self.send(conn, data)
 
     async def closeConnection(self, key: str):
-        '''Close the connection and remove it from any relevant collections.'''
-        await self.send(self.clients[key], MsgClose(clientKey=key).model_dump_json())
-        await self.clients[key].close()
-        del self.clients[key]
-        for acKey in self.awaitingCallback:
-            if acKey == key:
-                self.awaitingCallback.remove(acKey)
-                break
+        '''Close the connection and remove it from any relevant collections. Does nothing if it is already gone.'''
+        conn = self.clients.pop(key, None)
+        if conn is None:
+            return
+        self.liveness.remove(key)
+        await self.send(conn, MsgClose(clientKey=key).model_dump_json())
+        await conn.close()
+
+def countRows(data: CsvSource) -> int:
+    '''Lines after the header of a CSV, an estimate of its rows (quoted line breaks count too) that is cheap enough to take before analysis.'''
+    if isinstance(data, Path):
+        lines, last = 0, b"\n"
+        with open(data, "rb") as file:
+            while block := file.read(1 << 20):
+                lines += block.count(b"\n")
+                last = block[-1:]
+        return max(0, lines - (last == b"\n"))
+    return max(0, data.count("\n") - data.endswith("\n") if data != "" else 0)
+
+def writeBreakdown(path: str, breakdown: dict[str, object]):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(breakdown, file, indent=2)
 
 if __name__ == "__main__":
     asyncio.run(ServerComms().start())
\ No newline at end of file
@@ -0,0 +1,206 @@
+'''
+Benchmark suite for the real analysis code path (src.process.analyseCsv, and src.jobs for concurrent submissions), on synthetic CSVs from generate.py.
+
+For each scenario it measures:
+- throughput: rows per second and seconds per stage (see src.metrics.Timings), median of REPEATS runs;
+- latency: p50/p95 from submission to result when several clients submit at once through the job queue;
+- peak RSS of the process doing the work.
+Every run happens in a fresh process with an empty sentiment cache, so runs never see each other's cache or memory. Model loading is done (and reported) before anything is timed.
+
+The report is written as JSON to ./reports. Given a baseline report (by default ./baseline.json, if present), every metric that got worse by more than the tolerance is flagged, and the script exits with status 1.
+
+Usage: python bench.py [--only NAME ...] [--scale FACTOR] [--baseline PATH] [--save-baseline] [--tolerance FRACTION]
+'''
+
+import os
+import sys
+import json
+import time as t
+import argparse
+import platform
+import datetime as dt
+import statistics as st
+import multiprocessing as mp
+import concurrent.futures as cf
+from typing import Any
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+dirPath = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(dirPath))
+
+from generate import generateCsv, PRODUCT_NAME, REVIEW
+
+REPEATS = 3
+TOLERANCE = 0.1
+REPORT_DIR = f"{dirPath}/reports"
+BASELINE = f"{dirPath}/baseline.json"
+
+SCENARIOS: list[dict[str, Any]] = [
+    {"name": "small", "rows": 1_000, "products": 50},
+    {"name": "medium", "rows": 20_000, "products": 500},
+    {"name": "longReviews", "rows": 5_000, "products": 200, "minWords": 40, "maxWords": 120},
+    {"name": "duplicates", "rows": 20_000, "products": 500, "duplicates": 0.8},
+    {"name": "manyProducts", "rows": 20_000, "products": 10_000},
+    {"name": "counts", "rows": 20_000, "products": 500, "mode": "counts"},
+]
+'''rows, products, minWords, maxWords, duplicates and seed are passed to generate.py; mode is the result mode; clients is how many submit at once in the latency run.'''
+
+DEFAULTS: dict[str, Any] = {"products": 500, "minWords": 1, "maxWords": 30, "duplicates": 0.2, "seed": 0, "mode": "full", "clients": 4}
+
+# Metrics compared against the baseline, and whether bigger is better
+COMPARED = {"rowsPerSecond": True, "latencyP50": False, "latencyP95": False, "peakRssBytes": False}
+
+def peakRss() -> int | None:
+    '''Peak resident set size of this process so far, in bytes.'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def dataFor(scenario: dict[str, Any]) -> str:
+    return generateCsv(scenario["rows"], scenario["products"], scenario["minWords"], scenario["maxWords"], scenario["duplicates"], scenario["seed"])
+
+def isolate(cacheDir: str):
+    '''Point this (fresh) process at its own empty cache file. Must run before src is imported.'''
+    os.environ["SENTIMENT_CACHEPATH"] = os.path.join(cacheDir, f"bench-{os.getpid()}.db")
+
+def throughputRun(scenario: dict[str, Any], cacheDir: str) -> dict[str, Any]:
+    '''One timed analyseCsv() call, in a fresh process.'''
+    isolate(cacheDir)
+    from src.inference import warmUp
+    from src.process import analyseCsv
+    coldStart = warmUp()
+    data = dataFor(scenario)
+    timings: dict[str, float] = {}
+    start = t.perf_counter()
+    result = analyseCsv(data, False, PRODUCT_NAME, REVIEW, mode=scenario["mode"], timings=timings)
+    seconds = t.perf_counter() - start
+    if result.startswith("{\"error\""):
+        raise RuntimeError(result)
+    return {"seconds": seconds, "stages": timings, "peakRssBytes": peakRss(), "coldStart": coldStart}
+
+def latencyRun(scenario: dict[str, Any], cacheDir: str) -> dict[str, Any]:
+    '''scenario["clients"] clients submitting the scenario's CSV at once through the job queue, in a fresh process. Every client's CSV uses a different seed, so none is served from another's cache.'''
+    isolate(cacheDir)
+    import asyncio
+    import functools as ft
+    from src.jobs import JobQueue
+    from src.inference import warmUp
+    from src.process import analyseCsv
+    datas = [dataFor({**scenario, "seed": scenario["seed"] + 1 + i}) for i in range(scenario["clients"])]
+
+    async def run() -> list[float]:
+        jobs = JobQueue(maxQueued=len(datas), maxPerClient=1)
+        jobs.start(warmUp)
+        while jobs.status() == "warming up":
+            await asyncio.sleep(0.05)
+        if jobs.status() != "ready":
+            raise RuntimeError(f"Workers failed to warm up: {jobs.warmUpErrors}")
+        async def one(i: int, data: str) -> float:
+            start = t.perf_counter()
+            job, _ = await jobs.submit(f"client-{i}", ft.partial(analyseCsv, mode=scenario["mode"]), data, False, PRODUCT_NAME, REVIEW)
+            await job.future
+            return t.perf_counter() - start
+        try:
+            return await asyncio.gather(*(one(i, data) for i, data in enumerate(datas)))
+        finally:
+            await jobs.stop()
+
+    latencies = sorted(asyncio.run(run()))
+    return {"latencies": latencies, "peakRssBytes": peakRss()}
+
+def percentile(values: list[float], p: float) -> float:
+    '''Nearest-rank percentile of sorted values.'''
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+def inFreshProcess(fn, *args) -> Any:
+    with cf.ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn")) as executor:
+        return executor.submit(fn, *args).result()
+
+def runScenario(scenario: dict[str, Any], cacheDir: str) -> dict[str, Any]:
+    runs = [inFreshProcess(throughputRun, scenario, cacheDir) for _ in range(REPEATS)]
+    seconds = st.median(run["seconds"] for run in runs)
+    stageNames = sorted({name for run in runs for name in run["stages"]})
+    latency = inFreshProcess(latencyRun, scenario, cacheDir)
+    peaks = [run["peakRssBytes"] for run in runs if run["peakRssBytes"] is not None]
+    return {
+        "params": scenario,
+        "seconds": seconds,
+        "rowsPerSecond": scenario["rows"] / seconds,
+        "stages": {name: st.median(run["stages"].get(name, 0.0) for run in runs) for name in stageNames},
+        "latencyP50": percentile(latency["latencies"], 50),
+        "latencyP95": percentile(latency["latencies"], 95),
+        "latencies": latency["latencies"],
+        "peakRssBytes": max(peaks) if len(peaks) > 0 else None,
+        "latencyPeakRssBytes": latency["peakRssBytes"],
+        "coldStart": runs[0]["coldStart"],
+    }
+
+def compare(report: dict[str, Any], baseline: dict[str, Any], tolerance: float) -> list[str]:
+    '''Descriptions of every compared metric that got worse than the baseline by more than tolerance.'''
+    regressions: list[str] = []
+    for name, result in report["scenarios"].items():
+        old = baseline["scenarios"].get(name)
+        if old is None or old["params"] != result["params"]:
+            continue
+        for metric, biggerIsBetter in COMPARED.items():
+            new, before = result.get(metric), old.get(metric)
+            if new is None or before is None or before == 0:
+                continue
+            change = (new - before) / before
+            if (-change if biggerIsBetter else change) > tolerance:
+                regressions.append(f"{name}.{metric}: {before:.4g} -> {new:.4g} ({change:+.1%})")
+    return regressions
+
+def environment() -> dict[str, Any]:
+    from src.config import settings
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {name: getattr(settings, name) for name in ["backend", "batchSize", "lengthKey", "workers", "workerMode", "cacheEnabled"]},
+    }
+
+if __name__ == "__main__":
+    import tempfile
+    parser = argparse.ArgumentParser(description="Benchmark the analysis code path on synthetic data.")
+    parser.add_argument("--only", nargs="+", help="Only run these scenarios.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply every scenario's row count, e.g. 0.1 for a quick run.")
+    parser.add_argument("--baseline", default=BASELINE, help="Report to compare against (default ./baseline.json).")
+    parser.add_argument("--save-baseline", action="store_true", help="Also write the report to the baseline path.")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Largest change for the worse not flagged as a regression (default 0.1 = 10%%).")
+    args = parser.parse_args()
+
+    scenarios = [{**DEFAULTS, **scenario} for scenario in SCENARIOS if args.only is None or scenario["name"] in args.only]
+    for scenario in scenarios:
+        scenario["rows"] = max(1, round(scenario["rows"] * args.scale))
+    report: dict[str, Any] = {"created": dt.datetime.now().isoformat(timespec="seconds"), "environment": environment(), "scenarios": {}}
+    with tempfile.TemporaryDirectory() as cacheDir:
+        for scenario in scenarios:
+            result = runScenario(scenario, cacheDir)
+            report["scenarios"][scenario["name"]] = result
+            stages = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in result["stages"].items())
+            print(f"{scenario["name"]}: {result["rowsPerSecond"]:.1f} rows/s ({stages}), latency p50 {result["latencyP50"]:.3f}s p95 {result["latencyP95"]:.3f}s, peak RSS {(result["peakRssBytes"] or 0) / 2**20:.0f} MiB")
+
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    path = f"{REPORT_DIR}/bench-{dt.datetime.now().strftime("%Y%m%d-%H%M%S")}.json"
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Report written to {path}")
+
+    regressions: list[str] = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        print(f"Compared against {args.baseline}: {len(regressions)} regression(s)")
+        for regression in regressions:
+            print(f"  REGRESSION {regression}")
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    sys.exit(1 if len(regressions) > 0 else 0)
@@ -0,0 +1,84 @@
+'''
+Microbenchmark for the non-inference part of analysis: grouping reviews by product and turning model labels into sentiments.
+The model itself is not run; its output is faked, so only the overhead around it is measured.
+'''
+
+import os
+import sys
+import time as t
+import random as r
+import pandas as pd
+
+dirPath = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(dirPath))
+
+from src.process import group, assemble
+from src.inference import mapLabels
+
+ROWS = 100_000
+PRODUCTS = 5_000
+REPEATS = 3
+SEED = 0
+
+PRODUCT_NAME = "product_name"
+REVIEW = "Summary"
+WORDS = ["good", "bad", "nice", "product", "memang", "bagus", "tidak", "packaging", "fast", "delivery", "quality", "okay"]
+MODEL_LABELS = ["Very Positive", "Positive", "Neutral", "Negative", "Very Negative"]
+
+def makeData(rows: int = ROWS, products: int = PRODUCTS, seed: int = SEED) -> pd.DataFrame:
+    '''A DataFrame shaped like the one src.process.readCsv() returns.'''
+    rand = r.Random(seed)
+    names = [f"Product {i}" for i in range(products)]
+    return pd.DataFrame({
+        PRODUCT_NAME: [rand.choice(names) for _ in range(rows)],
+        REVIEW: [" ".join(rand.choices(WORDS, k=rand.randint(1, 12))) for _ in range(rows)],
+    }, dtype=pd.StringDtype())
+
+def pipeline(reviews: list[str]) -> list[dict[str, object]]:
+    '''Stand-in for the model, with output shaped like the transformers pipeline's.'''
+    return [{"label": MODEL_LABELS[len(review) % len(MODEL_LABELS)], "score": 0.9} for review in reviews]
+
+def before(readData: pd.DataFrame) -> dict:
+    '''The original implementation: iterrows grouping and per-label string comparisons.'''
+    products: dict[str, list[str]] = {}
+    for _, ser in readData.iterrows():
+        if ser[PRODUCT_NAME] in products:
+            products[ser[PRODUCT_NAME]].append(ser[REVIEW])
+        else:
+            products[ser[PRODUCT_NAME]] = [ser[REVIEW]]
+    sentiments = {}
+    for name, reviews in products.items():
+        sentimentList = []
+        for rawSent in pipeline(reviews):
+            if rawSent["label"] == "Positive" or rawSent["label"] == "Very Positive":
+                sentimentList.append("p")
+            elif rawSent["label"] == "Negative" or rawSent["label"] == "Very Negative":
+                sentimentList.append("n")
+            elif rawSent["label"] == "Neutral":
+                sentimentList.append("e")
+        sentiments[name] = {"sentiments": sentimentList, "reviews": reviews}
+    return sentiments
+
+def after(readData: pd.DataFrame) -> dict:
+    '''The vectorised implementation used by src.process.'''
+    grouped = group(readData, PRODUCT_NAME, REVIEW)
+    return assemble(grouped, mapLabels([rawSent["label"] for rawSent in pipeline(grouped.reviews.tolist())])) # type: ignore
+
+def best(fn, *args) -> float:
+    times = []
+    for _ in range(REPEATS):
+        start = t.perf_counter()
+        fn(*args)
+        times.append(t.perf_counter() - start)
+    return min(times)
+
+if __name__ == "__main__":
+    readData = makeData()
+    beforeTime = best(before, readData)
+    afterTime = best(after, readData)
+    scale = 100_000 / ROWS
+    print(f"Rows: {ROWS}, products: {PRODUCTS}, best of {REPEATS}")
+    print(f"Before: {beforeTime * scale:.3f} seconds per 100k rows")
+    print(f"After: {afterTime * scale:.3f} seconds per 100k rows")
+    print(f"Speedup: {beforeTime / afterTime:.1f}x")
+    assert before(readData) == after(readData), "Outputs differ"
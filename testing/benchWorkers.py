@@ -0,0 +1,71 @@
+'''
+Measures how throughput scales with the number of broker workers (see src.broker): for each worker count, starts a broker and that many local worker processes, submits the same batch of synthetic CSVs (from generate.py) through the job queue, and reports rows per second and scaling efficiency (throughput per worker relative to a single worker; 1.0 is perfectly linear).
+
+Each worker's model is limited to --model-threads threads (default 1), so that workers do not compete for the same cores. Scaling stops being linear once workers outnumber physical cores.
+
+Usage: python benchWorkers.py [--workers 1 2 4] [--jobs 16] [--rows 2000] [--model-threads 1]
+'''
+
+import os
+import sys
+import time as t
+import asyncio
+import argparse
+import tempfile
+import functools as ft
+from typing import Any
+
+dirPath = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(dirPath))
+
+from generate import generateCsv, PRODUCT_NAME, REVIEW
+
+def scalingRun(workers: int, datas: list[str], mode: str) -> float:
+    '''Seconds for workers broker workers to analyse every CSV in datas, once they have all warmed up.'''
+    from src.jobs import JobQueue
+    from src.config import settings
+    from src.process import analyseCsv
+    settings.brokerAddress = "unix:" + os.path.join(tempfile.gettempdir(), f"sentiment-bench-{os.getpid()}-{workers}.sock")
+
+    async def run() -> float:
+        jobs = JobQueue(workers=workers, mode="broker", maxQueued=len(datas), maxPerClient=len(datas))
+        jobs.start()
+        try:
+            while len(jobs.warmUps) < workers:
+                if len(jobs.warmUpErrors) > 0:
+                    raise RuntimeError(f"Workers failed to warm up: {jobs.warmUpErrors}")
+                await asyncio.sleep(0.1)
+            while jobs.slots < workers:
+                await asyncio.sleep(0.05)
+            start = t.perf_counter()
+            # One client per CSV, so round-robin scheduling does not hold any back
+            submitted = [await jobs.submit(f"client-{i}", ft.partial(analyseCsv, mode=mode), data, False, PRODUCT_NAME, REVIEW) for i, data in enumerate(datas)]
+            await asyncio.gather(*(job.future for job, _ in submitted))
+            return t.perf_counter() - start
+        finally:
+            await jobs.stop()
+
+    return asyncio.run(run())
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how throughput scales with the number of broker workers.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts to try (default 1 2 4).")
+    parser.add_argument("--jobs", type=int, default=16, help="How many CSVs are submitted per run (default 16).")
+    parser.add_argument("--rows", type=int, default=2000, help="Rows per CSV (default 2000).")
+    parser.add_argument("--mode", default="counts", help="Result mode (default counts).")
+    parser.add_argument("--model-threads", type=int, default=1, help="Threads per worker's model (default 1, 0 for the library default).")
+    args = parser.parse_args()
+    # Read by the worker processes too; every CSV gets its own seed and the cache is off, so no work is skipped
+    os.environ["SENTIMENT_MODELTHREADS"] = str(args.model_threads)
+    os.environ["SENTIMENT_CACHEENABLED"] = "false"
+    datas = [generateCsv(args.rows, 200, seed=i) for i in range(args.jobs)]
+    results: list[dict[str, Any]] = []
+    for workers in args.workers:
+        seconds = scalingRun(workers, datas, args.mode)
+        rowsPerSecond = args.rows * args.jobs / seconds
+        results.append({"workers": workers, "seconds": seconds, "rowsPerSecond": rowsPerSecond})
+        base = results[0]["rowsPerSecond"] / results[0]["workers"]
+        print(f"{workers} workers: {seconds:.2f}s, {rowsPerSecond:,.0f} rows/s, efficiency {rowsPerSecond / (workers * base):.2f}")
+
+if __name__ == "__main__":
+    main()
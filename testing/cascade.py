@@ -0,0 +1,61 @@
+'''
+Evaluation of the model cascade (see src/cascade.py) on the reviews of testData.csv. <br />
+The transformer classifies every review once for reference. Then, for each confidence threshold, the cascade classifies them again: its first pass settles the reviews it is sure of and the transformer gets the rest. For each threshold the script reports:
+- the escalation rate (how many reviews still went to the transformer);
+- agreement with the transformer, over all reviews and over those the first pass settled;
+- the share of positive, negative and neutral reviews, next to the transformer's;
+- throughput, and speed-up over the transformer alone.
+
+Needs a trained classifier (python -m src.cascade train, see the README). Train it with --exclude testing/testData.csv, or agreement here will be flattering.
+
+Usage: python cascade.py [--thresholds 0.5 0.7 0.9 ...] [--data testData.csv] [--review Summary]
+'''
+
+import os
+import sys
+import time as t
+import argparse
+import numpy as np
+import pandas as pd
+
+dirPath = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(dirPath))
+
+from src.config import settings
+from src.cascade import firstPass
+from src.inference import getBackend, predict, SENTIMENTS
+
+REVIEW = "Summary"
+THRESHOLDS = [0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99]
+
+def distribution(sentiments: np.ndarray) -> str:
+    return " ".join(f"{sentiment} {np.mean(sentiments == sentiment):.1%}" for sentiment in SENTIMENTS)
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the cascade's escalation rate, agreement with the transformer and speed-up at several thresholds.")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=sorted({*THRESHOLDS, settings.cascadeThreshold}), help="Confidence thresholds to try (default 0.5 to 0.99 and SENTIMENT_CASCADETHRESHOLD).")
+    parser.add_argument("--data", default=f"{dirPath}/testData.csv", help="CSV to evaluate on (default testData.csv).")
+    parser.add_argument("--review", default=REVIEW, help=f"Name of its review column (default {REVIEW}).")
+    args = parser.parse_args()
+    reviews = pd.read_csv(args.data, encoding="utf-8")[args.review].dropna().astype(str).tolist()
+    backend = getBackend()
+    predict(reviews, settings.batchSize, settings.lengthKey, backend) # Warm-up, not timed
+    start = t.perf_counter()
+    reference = np.array(predict(reviews, settings.batchSize, settings.lengthKey, backend), dtype=object)
+    referenceSeconds = t.perf_counter() - start
+    print(f"Reviews: {len(reviews)}, batch size {settings.batchSize}, classifier {settings.cascadeModel}")
+    print(f"transformer: {len(reviews) / referenceSeconds:.1f} reviews/second, {distribution(reference)}")
+    firstPass(reviews) # Loads the classifier, not timed
+    for threshold in args.thresholds:
+        start = t.perf_counter()
+        sentiments, settled = firstPass(reviews, threshold)
+        escalated = np.flatnonzero(~settled)
+        if len(escalated) > 0:
+            sentiments[escalated] = np.array(predict([reviews[i] for i in escalated], settings.batchSize, settings.lengthKey, backend), dtype=object)
+        seconds = t.perf_counter() - start
+        agree = sentiments == reference
+        settledAgreement = f"{agree[settled].mean():.1%}" if settled.any() else "-"
+        print(f"threshold {threshold}: escalated {len(escalated) / len(reviews):.1%}, agrees {agree.mean():.1%} (settled by first pass: {settledAgreement}), {distribution(sentiments)}, {len(reviews) / seconds:.1f} reviews/second ({referenceSeconds / seconds:.1f}x)")
+
+if __name__ == "__main__":
+    main()
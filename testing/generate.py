@@ -0,0 +1,63 @@
+'''
+Seeded generator of synthetic review CSVs shaped like dataset.csv, so benchmarks can run without it. The same arguments always give the same file.
+
+Usage: python generate.py [--rows N] [--products N] [--min-words N] [--max-words N] [--duplicates FRACTION] [--seed N] [--out PATH]
+'''
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+PRODUCT_NAME = "product_name"
+REVIEW = "Summary"
+RATE = "Rate"
+
+WORDS = [
+    # English
+    "good", "great", "bad", "terrible", "okay", "nice", "product", "quality", "fast", "slow", "delivery", "packaging",
+    "broken", "works", "price", "cheap", "expensive", "recommend", "seller", "refund", "not", "very", "really", "love",
+    # Malay / Indonesian
+    "bagus", "tidak", "sangat", "barang", "cepat", "lambat", "murah", "mahal", "terima", "kasih", "penghantaran", "rosak",
+    "sesuai", "kecewa", "puas", "kualiti", "harga", "memang", "okey", "berfungsi",
+]
+
+dirPath = os.path.dirname(os.path.realpath(__file__))
+
+def generate(rows: int, products: int = 500, minWords: int = 1, maxWords: int = 30, duplicates: float = 0.2, seed: int = 0) -> pd.DataFrame:
+    '''rows reviews spread over products products. Each review has between minWords and maxWords words; a duplicates fraction of the rows repeat the review of another row word for word.'''
+    rng = np.random.default_rng(seed)
+    names = np.array([f"Product {i:05d}" for i in range(products)], dtype=object)
+    # Skewed like real data: a few products get most of the reviews
+    weights = 1 / np.arange(1, products + 1)
+    productCodes = rng.choice(products, size=rows, p=weights / weights.sum())
+    counts = rng.integers(minWords, maxWords + 1, size=rows)
+    words = np.array(WORDS, dtype=object)[rng.integers(0, len(WORDS), size=int(counts.sum()))]
+    ends = np.cumsum(counts)
+    reviews = np.array([" ".join(words[end - count:end]) for count, end in zip(counts.tolist(), ends.tolist())], dtype=object)
+    repeated = rng.random(rows) < duplicates
+    originals = np.flatnonzero(~repeated)
+    if len(originals) > 0 and repeated.any():
+        reviews[repeated] = reviews[rng.choice(originals, size=int(repeated.sum()))]
+    return pd.DataFrame({
+        PRODUCT_NAME: names[productCodes],
+        REVIEW: reviews,
+        RATE: rng.integers(1, 6, size=rows),
+    })
+
+def generateCsv(rows: int, products: int = 500, minWords: int = 1, maxWords: int = 30, duplicates: float = 0.2, seed: int = 0) -> str:
+    '''Like generate(), but as CSV text.'''
+    return generate(rows, products, minWords, maxWords, duplicates, seed).to_csv(index=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic review CSV.")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--min-words", type=int, default=1)
+    parser.add_argument("--max-words", type=int, default=30)
+    parser.add_argument("--duplicates", type=float, default=0.2, help="Fraction of rows repeating another row's review.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=f"{dirPath}/synthetic.csv")
+    args = parser.parse_args()
+    generate(args.rows, args.products, args.min_words, args.max_words, args.duplicates, args.seed).to_csv(args.out, index=False)
+    print(f"Wrote {args.rows} rows to {args.out}")
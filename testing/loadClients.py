@@ -0,0 +1,109 @@
+'''
+Load test for websocket connection handling: holds many simulated browser clients open against a running server and checks that liveness pings keep up.
+
+Each client connects, takes its key and answers every callback ping, like the browser does. A fraction of them (--silent) never answer, and should be disconnected by the server after about two ping intervals. Start the server with a short ping interval so a run does not take long, e.g.
+
+    SENTIMENT_PINGINTERVAL=5 python server.py
+    python loadClients.py --clients 10000 --seconds 30 --interval 5
+
+The run reports how long connecting took, the gaps between pings each client saw (p50/p99/max; they should stay close to the interval however many clients there are), how many answering clients were wrongly dropped (should be 0) and how many silent ones were dropped (should be all, given a run of more than two intervals). <br />
+Every client is a socket in this process and one in the server's, so the open file limit (ulimit -n) of both must be above --clients.
+'''
+
+import sys
+import json
+import time as t
+import asyncio
+import argparse
+import websockets as ws
+from typing import Any
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+class Client:
+    def __init__(self, silent: bool):
+        self.silent = silent
+        self.pings: list[float] = []
+        self.connected: bool = False
+        self.dropped: bool = False
+        self.failed: str | None = None
+
+async def runClient(url: str, client: Client, stop: asyncio.Event, connecting: asyncio.Semaphore):
+    try:
+        async with connecting:
+            conn = await ws.connect(url, compression=None, open_timeout=60, ping_interval=None)
+        async with conn:
+            key = json.loads(await conn.recv())["clientKey"]
+            client.connected = True
+            receiving = asyncio.ensure_future(receive(conn, key, client))
+            stopping = asyncio.ensure_future(stop.wait())
+            await asyncio.wait([receiving, stopping], return_when=asyncio.FIRST_COMPLETED)
+            receiving.cancel()
+            stopping.cancel()
+    except Exception as e:
+        client.failed = f"{type(e).__name__}: {e}"
+
+async def receive(conn: Any, key: str, client: Client):
+    try:
+        async for message in conn:
+            header = json.loads(message)["header"]
+            if header == "callback_ping":
+                client.pings.append(t.monotonic())
+                if not client.silent:
+                    await conn.send(json.dumps({"header": "callback_ping", "clientKey": key}))
+            elif header == "close":
+                client.dropped = True
+                return
+    except ws.ConnectionClosed:
+        client.dropped = True
+
+def percentile(values: list[float], p: float) -> float:
+    '''Nearest-rank percentile of sorted values.'''
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))] if len(values) > 0 else float("nan")
+
+async def run(url: str, count: int, seconds: float, silentFraction: float, concurrency: int) -> list[Client]:
+    silentEvery = round(1 / silentFraction) if silentFraction > 0 else 0
+    clients = [Client(silentEvery > 0 and i % silentEvery == 0) for i in range(count)]
+    stop = asyncio.Event()
+    connecting = asyncio.Semaphore(concurrency)
+    start = t.perf_counter()
+    tasks = [asyncio.ensure_future(runClient(url, client, stop, connecting)) for client in clients]
+    while sum(client.connected or client.failed is not None for client in clients) < count:
+        await asyncio.sleep(0.2)
+    print(f"Connected {sum(client.connected for client in clients)} of {count} clients in {t.perf_counter() - start:.1f}s ({sum(client.failed is not None for client in clients)} failed)")
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+    return clients
+
+def main():
+    parser = argparse.ArgumentParser(description="Hold many websocket clients open against a running server and check liveness pings.")
+    parser.add_argument("--url", default="ws://localhost:5500", help="The server's websocket (default ws://localhost:5500).")
+    parser.add_argument("--clients", type=int, default=10_000, help="How many clients to hold open (default 10000).")
+    parser.add_argument("--seconds", type=float, default=30, help="How long to hold them once all are connected (default 30).")
+    parser.add_argument("--interval", type=float, default=60, help="The server's ping interval (SENTIMENT_PINGINTERVAL), to judge the gaps against (default 60).")
+    parser.add_argument("--silent", type=float, default=0.01, help="Fraction of clients that never answer pings (default 0.01).")
+    parser.add_argument("--concurrency", type=int, default=200, help="How many connections are opened at once (default 200).")
+    args = parser.parse_args()
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < args.clients + 100:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, args.clients + 100), hard))
+    clients = asyncio.run(run(args.url, args.clients, args.seconds, args.silent, args.concurrency))
+    gaps = sorted(b - a for client in clients if not client.silent for a, b in zip(client.pings, client.pings[1:]))
+    answering = [client for client in clients if client.connected and not client.silent]
+    silent = [client for client in clients if client.connected and client.silent]
+    print(f"Pings received: {sum(len(client.pings) for client in clients)}, by {sum(len(client.pings) > 0 for client in clients)} clients")
+    print(f"Gaps between pings (s): p50 {percentile(gaps, 50):.2f}, p99 {percentile(gaps, 99):.2f}, max {gaps[-1] if len(gaps) > 0 else float("nan"):.2f} (interval {args.interval})")
+    print(f"Answering clients dropped: {sum(client.dropped for client in answering)} of {len(answering)}")
+    print(f"Silent clients dropped: {sum(client.dropped for client in silent)} of {len(silent)}")
+    failures = [client.failed for client in clients if client.failed is not None]
+    if len(failures) > 0:
+        print(f"Failures: {len(failures)}, e.g. {failures[0]}")
+    return 1 if any(client.dropped for client in answering) or len(failures) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
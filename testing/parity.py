@@ -0,0 +1,57 @@
+'''
+Parity and speed check for the inference backends (see src/backends.py). <br />
+Every backend classifies the reviews of testData.csv. For each one, the script reports how often its labels and final sentiments agree with the "transformers" backend, and how many reviews it classifies per second.
+Backends that cannot be loaded (e.g. onnxruntime missing or no export made yet) are reported and skipped.
+
+Usage: python parity.py [backend ...] (default: all of them)
+'''
+
+import os
+import sys
+import time as t
+import pandas as pd
+
+dirPath = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(dirPath))
+
+from src.config import settings
+from src.inference import getBackend, lengths, mapLabels
+
+BACKENDS = ["transformers", "onnx", "onnx-int8"]
+REFERENCE = "transformers"
+REVIEW = "Summary"
+REPEATS = 3
+
+def run(name: str, reviews: list[str]) -> tuple[list[str], float]:
+    '''Labels from one backend, and its best throughput in reviews per second. The first (warm-up) run is not timed.'''
+    backend = getBackend(name)
+    keys = lengths(reviews, "chars", backend)
+    ordered = [reviews[i] for i in sorted(range(len(reviews)), key=keys.__getitem__)]
+    labels = backend.labels(ordered, settings.batchSize)
+    times = []
+    for _ in range(REPEATS):
+        start = t.perf_counter()
+        backend.labels(ordered, settings.batchSize)
+        times.append(t.perf_counter() - start)
+    unsorted = [""] * len(reviews)
+    for position, i in enumerate(sorted(range(len(reviews)), key=keys.__getitem__)):
+        unsorted[i] = labels[position]
+    return unsorted, len(reviews) / min(times)
+
+def agreement(a: list, b: list) -> float:
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+if __name__ == "__main__":
+    names = sys.argv[1:] if len(sys.argv) > 1 else BACKENDS
+    reviews = pd.read_csv(f"{dirPath}/testData.csv", encoding="utf-8")[REVIEW].dropna().astype(str).tolist()
+    print(f"Reviews: {len(reviews)}, batch size: {settings.batchSize}, best of {REPEATS}")
+    reference, referenceSpeed = run(REFERENCE, reviews)
+    for name in names:
+        try:
+            labels, speed = (reference, referenceSpeed) if name == REFERENCE else run(name, reviews)
+        except Exception as e:
+            print(f"{name}: skipped ({e})")
+            continue
+        labelAgreement = agreement(labels, reference)
+        sentimentAgreement = agreement(mapLabels(labels).tolist(), mapLabels(reference).tolist())
+        print(f"{name}: {speed:.1f} reviews/second, labels agree {labelAgreement:.2%}, sentiments agree {sentimentAgreement:.2%}")
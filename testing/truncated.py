@@ -0,0 +1,47 @@
+'''
+Check that reviews over the token budget are counted however they are classified: by the model, from the sentiment cache, or as repeats of another review in the same request (see src.inference.classify). Exits with an error if a count is off.
+
+Runs with a token budget of 16 (SENTIMENT_MAXTOKENS) so that reviews of a few sentences count as long, and a cache in a temporary directory, so the real one is left alone.
+
+Usage: python truncated.py
+'''
+
+import os
+import sys
+import tempfile
+
+dirPath = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(dirPath))
+
+from src.config import settings
+from src.inference import classify
+
+LONG = "The parcel arrived two weeks late, the box was crushed and the charger inside did not work at all, so I had to buy another one."
+OTHER_LONG = "Barang sampai dengan cepat dan dibungkus dengan rapi, kualiti pun bagus dan sama seperti dalam gambar, memang berbaloi dengan harga."
+SHORT = "good"
+
+def truncated(reviews: list[str]) -> int:
+    timings: dict[str, float] = {}
+    classify(reviews, timings=timings)
+    return int(timings.get("truncated", 0))
+
+def check(name: str, got: int, expected: int) -> bool:
+    print(f"{name}: {got} truncated (expected {expected})")
+    return got == expected
+
+def main() -> int:
+    settings.maxTokens = 16
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        for cacheEnabled in [True, False]:
+            settings.cacheEnabled = cacheEnabled
+            settings.cachePath = os.path.join(directory, "sentiments.db")
+            print(f"Cache {"on" if cacheEnabled else "off"}:")
+            ok &= check("  first upload", truncated([LONG, SHORT]), 1)
+            ok &= check("  same long review again", truncated([LONG, SHORT]), 1)
+            ok &= check("  long review three times, with another", truncated([LONG, SHORT, LONG, OTHER_LONG, LONG]), 4)
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())